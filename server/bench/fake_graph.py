@@ -0,0 +1,83 @@
+"""
+In-process stand-in for the O365 account used by the Microsoft Graph tools.
+
+It implements the parts of the O365 API the tools call (calendar events and inbox messages with queries)
+and sleeps `latency` seconds per page of results, like a blocking Graph round trip would. `install` makes the
+shared account provider hand it out instead of signing in to Microsoft.
+"""
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from src.tools.microsoft.account import microsoft_account
+
+class FakeQuery:
+    """
+    Accepts any chain of O365 query builder calls.
+    """
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def __and__(self, other):
+        return self
+
+
+class FakeFolder:
+    def __init__(self, account: "FakeAccount"):
+        self.account = account
+
+    def new_query(self, *args, **kwargs):
+        return FakeQuery()
+
+    def pages(self, items: list, limit: int=None, batch: int=None):
+        """
+        Yield up to `limit` items, sleeping once per page of `batch` items like paged Graph requests would.
+        """
+        items = items[:limit]
+        page_size = batch or len(items) or 1
+        for i, item in enumerate(items):
+            if i % page_size == 0:
+                time.sleep(self.account.latency)
+            yield item
+
+    def get_events(self, limit: int=25, batch: int=None, **kwargs):
+        start = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+        events = [SimpleNamespace(
+            object_id=f"event-{i + 1}",
+            subject=f"Meeting {i + 1}",
+            start=start + timedelta(hours=i),
+            end=start + timedelta(hours=i, minutes=30),
+            location={"displayName": f"Room {i + 1}"},
+            is_all_day=False,
+        ) for i in range(self.account.events)]
+        return self.pages(events, limit, batch)
+
+    def get_messages(self, limit: int=25, batch: int=None, **kwargs):
+        messages = [SimpleNamespace(
+            object_id=f"message-{i + 1}",
+            subject=f"Weekly report {i + 1}",
+            sender=SimpleNamespace(address=f"colleague{i + 1}@example.com"),
+            is_read=i % 2 == 0,
+            received=datetime.now() - timedelta(hours=i),
+        ) for i in range(self.account.messages)]
+        return self.pages(messages, limit, batch)
+
+
+class FakeAccount:
+    is_authenticated = True
+
+    def __init__(self, latency: float=0.2, events: int=5, messages: int=10):
+        self.latency = latency
+        self.events = events
+        self.messages = messages
+
+    def schedule(self):
+        return SimpleNamespace(get_default_calendar=lambda: FakeFolder(self))
+
+    def mailbox(self):
+        return SimpleNamespace(inbox_folder=lambda: FakeFolder(self))
+
+
+def install(latency: float=0.2, events: int=5, messages: int=10) -> FakeAccount:
+    account = FakeAccount(latency=latency, events=events, messages=messages)
+    microsoft_account._account = account
+    return account
@@ -0,0 +1,155 @@
+"""
+Stand-in for the Azure OpenAI chat completions API, so the server can be benchmarked offline.
+
+Answers routing prompts with a role, summary prompts with a short summary, and conversations with tool
+calls picked by a script of keyword rules, followed by a canned answer once the tool results are in.
+Supports streaming. Every response waits `latency` seconds (plus up to `jitter`) before the first byte,
+and a `stall_rate` share of them `stall` seconds more, like the stragglers of the real API.
+
+    python -m bench.fake_openai --port 8100 --latency 0.5
+
+Point the server at it with `endpoint = http://127.0.0.1:8100` under [azure-openai] in config.cfg.
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+def default_script() -> list:
+    today = date.today()
+    return [
+        {"match": "calendar", "tool": "microsoft_graph_calendar", "arguments": {
+            "start_time": f"{today.isoformat()}T00:00:00",
+            "end_time": f"{(today + timedelta(days=1)).isoformat()}T00:00:00",
+        }},
+        {"match": "email", "tool": "microsoft_graph_email", "arguments": {"keyword": "report"}},
+        {"match": "inbox", "tool": "microsoft_graph_email", "arguments": {"keyword": "report"}},
+    ]
+
+def estimate_tokens(value) -> int:
+    return max(1, len(json.dumps(value)) // 4)
+
+
+class FakeOpenAI:
+    def __init__(self, latency: float=0.5, jitter: float=0.0, chunk_delay: float=0.01, script: list=None, answer: str=None,
+                 stall_rate: float=0.0, stall: float=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.chunk_delay = chunk_delay
+        self.script = default_script() if script is None else script
+        self.answer = answer or "Here is what I found. Everything looks on track, and I will keep you posted on any changes."
+        self.requests = 0
+
+    def reply(self, messages: list, tools: list) -> dict:
+        """
+        The assistant message for a conversation: a tool call when the last user message matches a script
+        rule and the tool is offered, otherwise a text answer.
+        """
+        last = messages[-1]
+        content = last.get("content") or ""
+        if "Who should respond" in content:
+            role = "Engineering Manager" if any(word in content.lower().split("options:")[0] for word in ("jira", "sprint", "ticket", "deploy")) else "CEO Assistant"
+            return {"role": "assistant", "content": role}
+        if "Update the summary of a conversation" in content:
+            return {"role": "assistant", "content": "The CEO asked about their schedule and emails, and got answers."}
+        if last.get("role") == "user" and tools:
+            tool_names = {tool["function"]["name"] for tool in tools}
+            for rule in self.script:
+                if rule["match"].lower() in content.lower() and rule["tool"] in tool_names:
+                    return {"role": "assistant", "content": None, "tool_calls": [{
+                        "id": f"call_{uuid.uuid4().hex[:12]}",
+                        "type": "function",
+                        "function": {"name": rule["tool"], "arguments": json.dumps(rule["arguments"])},
+                    }]}
+        return {"role": "assistant", "content": self.answer}
+
+    async def wait(self):
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter) + (self.stall if random.random() < self.stall_rate else 0))
+
+    def create_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/openai/deployments/{deployment}/chat/completions")
+        async def chat_completions(deployment: str, request: Request):
+            body = await request.json()
+            self.requests += 1
+            message = self.reply(body["messages"], body.get("tools"))
+            await self.wait()
+            if body.get("stream"):
+                return StreamingResponse(self.stream(deployment, message), media_type="text/event-stream")
+            return {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": deployment,
+                "choices": [{"index": 0, "finish_reason": "tool_calls" if message.get("tool_calls") else "stop", "message": message}],
+                "usage": {
+                    "prompt_tokens": estimate_tokens(body["messages"]),
+                    "completion_tokens": estimate_tokens(message),
+                    "total_tokens": estimate_tokens(body["messages"]) + estimate_tokens(message),
+                },
+            }
+
+        return app
+
+    async def stream(self, model: str, message: dict):
+        def chunk(delta: dict, finish_reason: str=None) -> str:
+            return "data: " + json.dumps({
+                "id": "chatcmpl-stream",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }) + "\n\n"
+
+        yield chunk({"role": "assistant", "content": ""})
+        for index, tool_call in enumerate(message.get("tool_calls") or []):
+            yield chunk({"tool_calls": [{"index": index, "id": tool_call["id"], "type": "function", "function": {"name": tool_call["function"]["name"], "arguments": ""}}]})
+            yield chunk({"tool_calls": [{"index": index, "function": {"arguments": tool_call["function"]["arguments"]}}]})
+        for word in (message.get("content") or "").split(" "):
+            await asyncio.sleep(self.chunk_delay)
+            yield chunk({"content": word + " "})
+        yield chunk({}, "tool_calls" if message.get("tool_calls") else "stop")
+        yield "data: [DONE]\n\n"
+
+
+def serve_in_thread(fake: FakeOpenAI, port: int) -> uvicorn.Server:
+    """
+    Run the fake API in a daemon thread of the current process, for benchmarks that call the client directly.
+    """
+    server = uvicorn.Server(uvicorn.Config(fake.create_app(), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, up to this many seconds")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="share of responses that stall")
+    parser.add_argument("--stall", type=float, default=0.0, help="extra seconds a stalled response waits")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="seconds between streamed chunks")
+    parser.add_argument("--script", help="JSON file with [{\"match\": ..., \"tool\": ..., \"arguments\": {...}}] rules")
+    args = parser.parse_args()
+
+    script = None
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+    fake = FakeOpenAI(latency=args.latency, jitter=args.jitter, chunk_delay=args.chunk_delay, script=script,
+                      stall_rate=args.stall_rate, stall=args.stall)
+    uvicorn.run(fake.create_app(), host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+End-to-end load test of POST /messages -> reply, fully offline.
+
+Starts bench.fake_openai and the server (bench.serve, with the fake Graph backend) as subprocesses on a
+fresh SQLite database, then for each concurrency level runs that many simulated CEOs at once. Each one
+has its own meeting room, since replies within a room are processed one at a time, listens to the room's
+event stream and posts messages one after another, timing each until the agent's reply arrives.
+
+Reports per level the p50/p95/p99 end-to-end latency, replies per second, and DB contention: the mean
+time of DB writes and the number of failed DB writes and jobs, from the server's /metrics.
+
+    cd server && python -m bench.load_test --levels 1,4,16,64 --messages 5 --llm-latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+SERVER_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROMPTS = [
+    "What's on my calendar today?",
+    "Check my email inbox for the weekly report",
+    "Can you remind me what we agreed on last time?",
+    "How is the team doing on the current sprint tickets?",
+]
+
+def percentile(values: list, p: float) -> float:
+    """
+    Nearest-rank percentile.
+    """
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def parse_metrics(text: str) -> dict:
+    """
+    Sample values of a Prometheus text page, keyed by the sample line without its value.
+    """
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            samples[name] = float(value)
+    return samples
+
+def db_contention(before: dict, after: dict) -> dict:
+    def delta(pattern: str) -> float:
+        return sum(value - before.get(name, 0) for name, value in after.items() if re.fullmatch(pattern, name))
+    writes = delta(r'span_duration_seconds_count\{span="db\.[a-z_]+"\}')
+    write_seconds = delta(r'span_duration_seconds_sum\{span="db\.[a-z_]+"\}')
+    return {
+        "db_writes": int(writes),
+        "db_write_mean_ms": round(write_seconds / writes * 1000, 2) if writes else None,
+        "db_write_errors": int(delta(r'span_errors_total\{span="db\.[a-z_]+"\}')),
+        "job_errors": int(delta(r'span_errors_total\{span="job"\}')),
+    }
+
+def write_config(directory: str, llm_port: int, args, extra: str="") -> str:
+    """
+    Write a config.cfg for a server using the fake LLM and a database of its own, and return the
+    directory to run the server in. `extra` is appended to the config.
+    """
+    work_directory = os.path.join(directory, "work")
+    os.makedirs(work_directory)
+    database_url = args.database_url or f"sqlite+aiosqlite:///{os.path.join(work_directory, 'bench.db')}"
+    with open(os.path.join(directory, "config.cfg"), "w") as f:
+        f.write(f"""
+[app]
+ceoName = Bench CEO
+ceoEmail = ceo@example.com
+
+[openai]
+apiKey = bench
+
+[azure-openai]
+apiKey = bench
+endpoint = http://127.0.0.1:{llm_port}
+
+[azure]
+clientId = bench
+clientSecret = bench
+tenantId = bench
+graphUserScopes =
+
+[database]
+url = {database_url}
+
+[jobs]
+workers = {args.workers}
+
+[llm-cache]
+backend = none
+
+[telemetry]
+logLevel = WARNING
+""" + extra)
+    return work_directory
+
+async def wait_until_up(client: httpx.AsyncClient, url: str, process: subprocess.Popen, timeout: float=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"{url} did not come up within {timeout} seconds")
+
+async def simulate_ceo(client: httpx.AsyncClient, base_url: str, room_id: int, messages: int, timeout: float) -> tuple:
+    """
+    Post `messages` messages to a room one after another and time each until the reply arrives.
+    Returns the latencies and the number of replies that did not arrive within `timeout`.
+    """
+    await client.post(f"{base_url}/meeting_rooms", params={"id": room_id})
+    replies = asyncio.Queue()
+
+    async def listen():
+        # since=0 makes the server subscribe before reading the (empty) backlog, so no reply is missed
+        async with client.stream("GET", f"{base_url}/meeting_rooms/{room_id}/events", params={"since": 0}) as response:
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    message = json.loads(line[len("data: "):])
+                    if message.get("role") != "CEO":
+                        await replies.put(message)
+
+    listener = asyncio.create_task(listen())
+    latencies, timeouts = [], 0
+    try:
+        for i in range(messages):
+            started = time.perf_counter()
+            await client.post(f"{base_url}/messages", params={
+                "user_name": "Bench CEO",
+                "text": f"{PROMPTS[(room_id + i) % len(PROMPTS)]} ({room_id}-{i})",
+                "role": "CEO",
+                "meeting_room_id": room_id,
+            })
+            try:
+                await asyncio.wait_for(replies.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                timeouts += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+    finally:
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+    return latencies, timeouts
+
+async def run_level(client: httpx.AsyncClient, base_url: str, concurrency: int, first_room_id: int, args) -> dict:
+    before = parse_metrics((await client.get(f"{base_url}/metrics")).text)
+    started = time.perf_counter()
+    results = await asyncio.gather(*[simulate_ceo(client, base_url, first_room_id + i, args.messages, args.timeout) for i in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    after = parse_metrics((await client.get(f"{base_url}/metrics")).text)
+
+    latencies = [latency for room_latencies, _ in results for latency in room_latencies]
+    return {
+        "concurrency": concurrency,
+        "replies": len(latencies),
+        "timeouts": sum(timeouts for _, timeouts in results),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "replies_per_second": round(len(latencies) / elapsed, 2),
+        **db_contention(before, after),
+    }
+
+def print_table(rows: list):
+    columns = list(rows[0])
+    widths = [max(len(column), *(len(str(row[column])) for row in rows)) for column in columns]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[column]).rjust(width) for column, width in zip(columns, widths)))
+
+async def run(args):
+    processes = []
+    with tempfile.TemporaryDirectory() as directory:
+        work_directory = write_config(directory, args.llm_port, args)
+        environment = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [SERVER_DIRECTORY, os.environ.get("PYTHONPATH")]))}
+        output = None if args.verbose else subprocess.DEVNULL
+        try:
+            processes.append(subprocess.Popen([sys.executable, "-m", "bench.fake_openai", "--port", str(args.llm_port),
+                                               "--latency", str(args.llm_latency), "--jitter", str(args.llm_jitter)],
+                                              cwd=SERVER_DIRECTORY, stdout=output, stderr=output))
+            processes.append(subprocess.Popen([sys.executable, "-m", "bench.serve", "--port", str(args.port),
+                                               "--graph-latency", str(args.graph_latency)],
+                                              cwd=work_directory, env=environment, stdout=output, stderr=output))
+            base_url = f"http://127.0.0.1:{args.port}"
+            limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+            async with httpx.AsyncClient(timeout=httpx.Timeout(args.timeout, read=None), limits=limits) as client:
+                await wait_until_up(client, f"http://127.0.0.1:{args.llm_port}/docs", processes[0])
+                await wait_until_up(client, f"{base_url}/meeting_rooms", processes[1])
+
+                rows = []
+                first_room_id = 1000
+                for concurrency in args.levels:
+                    rows.append(await run_level(client, base_url, concurrency, first_room_id, args))
+                    first_room_id += concurrency
+                    print(json.dumps(rows[-1]), file=sys.stderr)
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+    print_table(rows)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", type=lambda value: [int(level) for level in value.split(",")], default=[1, 2, 4, 8, 16, 32],
+                        help="comma separated numbers of concurrent CEOs")
+    parser.add_argument("--messages", type=int, default=5, help="messages each CEO sends per level")
+    parser.add_argument("--workers", type=int, default=4, help="job queue workers of the server")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument("--graph-latency", type=float, default=0.2)
+    parser.add_argument("--database-url", help="database of the server, a fresh SQLite file by default")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--llm-port", type=int, default=8110)
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for a reply")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the server processes")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
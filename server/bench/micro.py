@@ -0,0 +1,263 @@
+"""
+Microbenchmarks of the server's hot spots, fully offline.
+
+    mouth_cues  generate_mouth_cues on synthetic speech of a few lengths
+    queries     message queries of the API and the context builder on databases of 10k to 1M messages
+    context     building the prompt in Agent.respond: first build over a long history (which summarizes),
+                rebuild after a restart (summary persisted) and the per-turn incremental build
+    memory      message index of 100k to 1M vectors: append throughput, search latency of the clustered
+                index against a full scan, and how many of the true top 10 it finds
+
+    cd server && python -m bench.micro mouth_cues queries --sizes 10000,100000,1000000
+"""
+import argparse
+import asyncio
+import math
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from pydub import AudioSegment
+
+FAKE_OPENAI_PORT = 8111
+os.environ.setdefault("AZURE_OPENAI_KEY", "bench")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", f"http://127.0.0.1:{FAKE_OPENAI_PORT}")
+
+from src.audio import audio
+from src.db import crud, database
+from src.agents.agent import AssistantAgent
+from src.agents.context import contexts
+from src.llm import openai_client
+from src.llm.hedging import LatencyTracker
+from src.memory.embedder import HashingEmbedder, normalize
+from src.memory.index import VectorIndex
+from .fake_openai import FakeOpenAI, serve_in_thread
+
+AGENT_ROLES = ["CEO Assistant", "Engineering Manager"]
+
+_fake_openai = None
+
+def fake_openai() -> FakeOpenAI:
+    """
+    The fake API every benchmark of this process talks to, started on first use.
+    """
+    global _fake_openai
+    if _fake_openai is None:
+        _fake_openai = FakeOpenAI(latency=0, chunk_delay=0)
+        serve_in_thread(_fake_openai, FAKE_OPENAI_PORT)
+    return _fake_openai
+
+def timed(function, repeats: int) -> dict:
+    durations = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - started)
+    return summarize(durations)
+
+async def timed_async(function, repeats: int) -> dict:
+    durations = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        await function()
+        durations.append(time.perf_counter() - started)
+    return summarize(durations)
+
+def summarize(durations: list) -> dict:
+    ordered = sorted(durations)
+    return {
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p95_ms": round(ordered[max(0, math.ceil(len(ordered) * 0.95) - 1)] * 1000, 3),
+        "runs": len(ordered),
+    }
+
+def report(name: str, result: dict):
+    print(f"{name:<56} " + "  ".join(f"{key}={value}" for key, value in result.items()))
+
+def synthetic_speech(seconds: float, sample_rate: int=24000) -> AudioSegment:
+    """
+    A voiced tone in syllable-length bursts with pauses in between, so every mouth shape branch is exercised.
+    """
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    envelope = np.clip(np.sin(2 * np.pi * 2.5 * t), 0, None)
+    signal = envelope * (0.4 * np.sin(2 * np.pi * (180 + 80 * np.sin(2 * np.pi * 0.7 * t)) * t) + 0.05 * rng.standard_normal(len(t)))
+    return AudioSegment((signal * 32767 * 0.8).astype(np.int16).tobytes(), frame_rate=sample_rate, sample_width=2, channels=1)
+
+def bench_mouth_cues(args):
+    for seconds in (5, 30, 120):
+        speech = synthetic_speech(seconds)
+        report(f"generate_mouth_cues {seconds}s", timed(lambda: audio.generate_mouth_cues(speech), args.repeats))
+
+def fill_messages(path: str, count: int, rooms: int=100, conversation_share: float=0.2):
+    """
+    Bulk insert `count` messages spread over `rooms` meeting rooms. About `conversation_share` of them
+    are between the CEO and the CEO Assistant, the rest between the CEO and the Engineering Manager.
+    """
+    connection = sqlite3.connect(path)
+    connection.executemany("INSERT OR IGNORE INTO meetingroom (id) VALUES (?)", [(room_id,) for room_id in range(1, rooms + 1)])
+    started = datetime.now() - timedelta(seconds=count)
+    rng = np.random.default_rng(0)
+    peers = np.where(rng.random(count // 2 + 1) < conversation_share, 0, 1)
+
+    def rows():
+        for i in range(count):
+            peer = AGENT_ROLES[peers[i // 2]]
+            role, to_role = ("CEO", peer) if i % 2 == 0 else (peer, "CEO")
+            yield ("Bench CEO" if role == "CEO" else role, f"Message {i} about the quarterly plan and the next steps.", role, to_role,
+                   (started + timedelta(seconds=i)).isoformat(sep=" "), (i // 2) % rooms + 1)
+
+    connection.executemany("INSERT INTO message (user_name, text, role, to_role, timestamp, meeting_room_id) VALUES (?, ?, ?, ?, ?, ?)", rows())
+    connection.commit()
+    connection.close()
+
+async def bench_queries(args):
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "bench.db")
+            database.configure(url=f"sqlite+aiosqlite:///{path}")
+            await database.create_db_and_tables()
+            started = time.perf_counter()
+            fill_messages(path, size)
+            print(f"inserted {size} messages in {time.perf_counter() - started:.1f}s")
+
+            async with database.get_session() as db:
+                middle = size // 2
+                recent = size - 100
+                queries = {
+                    "room, latest page": lambda: crud.messages(db, 50, limit=50),
+                    "room, page before the middle": lambda: crud.messages(db, 50, before_id=middle, limit=50),
+                    "room, poll since cursor": lambda: crud.messages(db, 50, after_id=recent),
+                    "between roles, latest page": lambda: crud.messages_between_roles(db, "CEO", "CEO Assistant", limit=50),
+                    "between roles, context sync since cursor": lambda: crud.messages_between_roles(db, "CEO Assistant", "CEO", after_id=recent),
+                }
+                for name, query in queries.items():
+                    report(f"{size:>8} rows  {name}", await timed_async(query, args.repeats))
+            await database.engine.dispose()
+
+async def bench_context(args):
+    fake_openai()
+    contexts.token_budget = args.token_budget
+    agent = AssistantAgent()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        database.configure(url=f"sqlite+aiosqlite:///{path}")
+        await database.create_db_and_tables()
+        fill_messages(path, args.history, rooms=1, conversation_share=1.0)
+
+        async with database.get_session() as db:
+            message = await crud.create_message(db, user_name="Bench CEO", text="What's on my calendar today?", role="CEO", to_role=agent.role, meeting_room_id=1)
+
+            async def first_build():
+                contexts._contexts.clear()
+                await agent.build_messages(message)
+
+            started = time.perf_counter()
+            await first_build()
+            report(f"first build over {args.history} messages", summarize([time.perf_counter() - started]))
+            report("rebuild after restart (summary persisted)", await timed_async(first_build, args.repeats))
+
+            async def next_turn():
+                await crud.create_message(db, user_name=agent.name, text="Here is what I found.", role=agent.role, to_role="CEO", meeting_room_id=1)
+                await agent.build_messages(message)
+
+            report("incremental build per turn", await timed_async(next_turn, args.repeats))
+        await database.engine.dispose()
+
+def synthetic_vectors(rng, centers: np.ndarray, count: int, noise: float=0.6) -> np.ndarray:
+    """
+    Unit vectors scattered around random topic centers, closer to embeddings of real messages than uniform noise.
+    """
+    return normalize(centers[rng.integers(len(centers), size=count)] + noise * rng.standard_normal((count, centers.shape[1]), dtype=np.float32) / np.sqrt(centers.shape[1]))
+
+def bench_memory(args):
+    embedder = HashingEmbedder(dimensions=args.dimensions)
+    report("hashing embedder, per message", timed(lambda: embedder.embed_one("Message 42 about the quarterly plan and the next steps."), args.repeats))
+    rng = np.random.default_rng(0)
+    centers = normalize(rng.standard_normal((4096, args.dimensions), dtype=np.float32))
+    queries = synthetic_vectors(rng, centers, args.repeats)
+    for size in args.memory_sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            index = VectorIndex(directory, args.dimensions, name="bench", probes=args.probes).open()
+            started = time.perf_counter()
+            for start in range(0, size, 65536):
+                index.append(list(range(start + 1, min(size, start + 65536) + 1)), synthetic_vectors(rng, centers, min(65536, size - start)))
+            print(f"appended {size} vectors in {time.perf_counter() - started:.1f}s (clustered: {index.trained})")
+
+            vectors = np.memmap(os.path.join(directory, index.vectors_file_name), dtype=np.float32, mode="r", shape=(size, args.dimensions))
+            def full_scan(query):
+                scores = np.concatenate([vectors[start:start + 65536] @ query for start in range(0, size, 65536)])
+                return set((np.argpartition(-scores, 9)[:10] + 1).tolist())
+            found = [len({message_id for message_id, _ in index.search(query, 10)} & full_scan(query)) / 10 for query in queries]
+            query = iter(queries)
+            report(f"{size:>8} vectors  search top 10", {**timed(lambda: index.search(next(query), 10), args.repeats), "recall_at_10": round(statistics.fmean(found), 3)})
+            query = iter(queries)
+            report(f"{size:>8} vectors  full scan top 10", timed(lambda: full_scan(next(query)), args.repeats))
+
+async def bench_llm(args):
+    fake = fake_openai()
+    fake.latency, fake.jitter, fake.stall_rate, fake.stall = args.llm_latency, args.llm_latency, args.stall_rate, args.stall
+    # Every prompt is distinct, but the cache would also answer the repeats of the second run
+    openai_client.response_cache.backend = None
+    # The fake answers in milliseconds, the default floor of a second would never let a hedge go out
+    openai_client.hedge_min_delay = 0
+    for hedge_percentile in (0, 95):
+        openai_client.hedge_percentile = hedge_percentile
+        openai_client.completion_latency = LatencyTracker(openai_client.completion_latency.histogram)
+        requests = fake.requests
+        durations = []
+        calls = iter(range(args.llm_calls))
+
+        async def caller():
+            for call in calls:
+                started = time.perf_counter()
+                await openai_client.respond_to_prompt(f"Call {call}: who should respond?", call_type="routing")
+                durations.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(caller() for _ in range(args.concurrency)))
+        ordered = sorted(durations)
+        stats = openai_client.completion_latency.stats()[openai_client.models["routing"]]
+        report(f"completions, hedging {'at p' + str(hedge_percentile) if hedge_percentile else 'off'}", {
+            **summarize(durations),
+            "p99_ms": round(ordered[max(0, math.ceil(len(ordered) * 0.99) - 1)] * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3),
+            "hedged": stats["hedged"],
+            "api_requests": fake.requests - requests,
+        })
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", choices=["mouth_cues", "queries", "context", "memory", "llm"],
+                        default=["mouth_cues", "queries", "context", "memory", "llm"])
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=[10_000, 100_000, 1_000_000],
+                        help="comma separated message counts for the query benchmark")
+    parser.add_argument("--history", type=int, default=2000, help="messages in the conversation for the context benchmark")
+    parser.add_argument("--token-budget", type=int, default=6000)
+    parser.add_argument("--memory-sizes", type=lambda value: [int(size) for size in value.split(",")], default=[100_000, 1_000_000],
+                        help="comma separated vector counts for the memory benchmark")
+    parser.add_argument("--dimensions", type=int, default=256, help="vector size for the memory benchmark")
+    parser.add_argument("--probes", type=int, default=16, help="clusters scored per search in the memory benchmark")
+    parser.add_argument("--llm-calls", type=int, default=1000, help="completions per run of the llm benchmark")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds per completion of the fake API, plus as much jitter")
+    parser.add_argument("--stall-rate", type=float, default=0.03, help="share of completions that stall in the llm benchmark")
+    parser.add_argument("--stall", type=float, default=1.0, help="extra seconds of a stalled completion")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent callers in the llm benchmark")
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    if "mouth_cues" in args.benchmarks:
+        bench_mouth_cues(args)
+    if "queries" in args.benchmarks:
+        asyncio.run(bench_queries(args))
+    if "context" in args.benchmarks:
+        asyncio.run(bench_context(args))
+    if "memory" in args.benchmarks:
+        bench_memory(args)
+    if "llm" in args.benchmarks:
+        asyncio.run(bench_llm(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Horizontal scaling benchmark: the load test against 1, 2, 4, ... server processes sharing one database.
+
+For each process count, a server with that many uvicorn workers is started on a fresh SQLite database,
+with [pubsub] pollInterval set so room events reach clients connected to any process. The same number of
+simulated CEOs then post messages, and the run reports replies per second, the speedup over a single
+process and the replies per CEO message, which has to be exactly 1: every message is answered, by one
+worker only.
+
+    cd server && python -m bench.scale --processes 1,2,4 --concurrency 32 --messages 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import httpx
+from .load_test import SERVER_DIRECTORY, print_table, run_level, wait_until_up, write_config
+
+async def replies_per_message(client: httpx.AsyncClient, base_url: str, room_ids: range) -> float:
+    messages, replies = 0, 0
+    for room_id in room_ids:
+        for message in (await client.get(f"{base_url}/messages", params={"meeting_room_id": room_id})).json():
+            if message["role"] == "CEO":
+                messages += 1
+            else:
+                replies += 1
+    return round(replies / messages, 3) if messages else float("nan")
+
+async def measure(processes: int, directory: str, environment: dict, args) -> dict:
+    work_directory = write_config(os.path.join(directory, str(processes)), args.llm_port, args,
+                                  extra=f"\n[pubsub]\npollInterval = {args.poll_interval}\n")
+    output = None if args.verbose else subprocess.DEVNULL
+    server = subprocess.Popen([sys.executable, "-m", "bench.serve", "--port", str(args.port), "--workers", str(processes),
+                               "--graph-latency", str(args.graph_latency)],
+                              cwd=work_directory, env=environment, stdout=output, stderr=output)
+    try:
+        base_url = f"http://127.0.0.1:{args.port}"
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(timeout=httpx.Timeout(args.timeout, read=None), limits=limits) as client:
+            await wait_until_up(client, f"{base_url}/meeting_rooms", server)
+            # Every worker process has to be up before the clock starts, not just the first one
+            await asyncio.sleep(args.settle * processes)
+            first_room_id = 1000
+            row = await run_level(client, base_url, args.concurrency, first_room_id, args)
+            # Give duplicate replies, if any, time to show up
+            await asyncio.sleep(args.settle)
+            row["replies_per_message"] = await replies_per_message(client, base_url, range(first_room_id, first_room_id + args.concurrency))
+    finally:
+        server.terminate()
+        server.wait()
+    # /metrics is answered by one process only, so its DB numbers cover only part of the workers
+    return {"processes": processes, **{key: row[key] for key in ("replies", "timeouts", "p50_ms", "p95_ms", "replies_per_second", "replies_per_message")}}
+
+async def run(args):
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        environment = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [SERVER_DIRECTORY, os.environ.get("PYTHONPATH")]))}
+        output = None if args.verbose else subprocess.DEVNULL
+        fake_llm = subprocess.Popen([sys.executable, "-m", "bench.fake_openai", "--port", str(args.llm_port),
+                                     "--latency", str(args.llm_latency), "--jitter", str(args.llm_jitter)],
+                                    cwd=SERVER_DIRECTORY, stdout=output, stderr=output)
+        try:
+            async with httpx.AsyncClient() as client:
+                await wait_until_up(client, f"http://127.0.0.1:{args.llm_port}/docs", fake_llm)
+            for processes in args.processes:
+                rows.append(await measure(processes, directory, environment, args))
+                rows[-1]["speedup"] = round(rows[-1]["replies_per_second"] / rows[0]["replies_per_second"], 2)
+                print(json.dumps(rows[-1]), file=sys.stderr)
+        finally:
+            fake_llm.terminate()
+            fake_llm.wait()
+    print_table(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=lambda value: [int(count) for count in value.split(",")], default=[1, 2, 4],
+                        help="comma separated numbers of server processes")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent CEOs, each in a meeting room of their own")
+    parser.add_argument("--messages", type=int, default=5, help="messages each CEO sends")
+    parser.add_argument("--workers", type=int, default=4, help="job queue workers per server process")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument("--graph-latency", type=float, default=0.2)
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="[pubsub] pollInterval of the server")
+    parser.add_argument("--settle", type=float, default=2, help="seconds per server process to wait for them to start")
+    parser.add_argument("--port", type=int, default=8030)
+    parser.add_argument("--llm-port", type=int, default=8130)
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for a reply")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the server processes")
+    args = parser.parse_args()
+    # write_config option of the load test
+    args.database_url = None
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+Run the server with the fake Graph backend, for load tests. Like `uvicorn src.main:app`, it reads
+../config.cfg relative to the working directory, so point [azure-openai] endpoint at bench.fake_openai.
+
+    python -m bench.serve --port 8000 --graph-latency 0.2 --workers 4
+"""
+import argparse
+import os
+import uvicorn
+from src import main as server
+from . import fake_graph
+
+# Worker processes import this module for the app, the Graph latency reaches them through the environment
+fake_graph.install(latency=float(os.environ.get("BENCH_GRAPH_LATENCY", 0.2)))
+app = server.app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--graph-latency", type=float, default=0.2, help="seconds per Graph request")
+    parser.add_argument("--workers", type=int, default=1, help="server processes")
+    args = parser.parse_args()
+
+    os.environ["BENCH_GRAPH_LATENCY"] = str(args.graph_latency)
+    fake_graph.install(latency=args.graph_latency)
+    if args.workers > 1:
+        uvicorn.run("bench.serve:app", host="127.0.0.1", port=args.port, workers=args.workers, log_level="warning")
+    else:
+        uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
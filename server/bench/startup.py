@@ -0,0 +1,119 @@
+"""
+Cold start benchmark: how long importing the server takes, how long a fresh server process takes until it
+answers requests, and how long the first reply takes after that, with and without background warm-up.
+
+Each run uses a new process, so nothing is shared between runs except the operating system's file cache.
+The server uses bench.fake_openai and the fake Graph backend, so only local start up work is measured.
+By default the first message is sent as soon as the server answers; use --idle to give the background
+warm-up time to finish first, as on a worker that is started ahead of traffic.
+
+    cd server && python -m bench.startup --runs 5 --profile
+"""
+import argparse
+import asyncio
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+import httpx
+from .load_test import SERVER_DIRECTORY, simulate_ceo, wait_until_up, write_config
+
+IMPORT_SCRIPT = "import time; started = time.perf_counter(); import src.main; print(time.perf_counter() - started)"
+
+def environment() -> dict:
+    return {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [SERVER_DIRECTORY, os.environ.get("PYTHONPATH")]))}
+
+def seconds(values: list) -> str:
+    return f"median={statistics.median(values) * 1000:.0f}ms  min={min(values) * 1000:.0f}ms  max={max(values) * 1000:.0f}ms"
+
+def measure_import(work_directory: str, runs: int) -> list:
+    durations = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=work_directory, env=environment(), capture_output=True, text=True, check=True)
+        durations.append(float(result.stdout.strip().splitlines()[-1]))
+    return durations
+
+def import_profile(work_directory: str, top: int) -> list:
+    """
+    Import time of src.main by top level package, from python -X importtime.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import src.main"], cwd=work_directory, env=environment(), capture_output=True, text=True, check=True)
+    by_package = Counter()
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+\d+ \|\s*(\S+)", line)
+        if match:
+            by_package[match.group(2).split(".")[0]] += int(match.group(1))
+    return by_package.most_common(top)
+
+async def measure_startup(work_directory: str, port: int, room_id: int, timeout: float, idle: float=0) -> tuple:
+    """
+    Start a server process and return the seconds until it answers, and the seconds the first reply takes after that.
+    """
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "bench.serve", "--port", str(port), "--graph-latency", "0"],
+                               cwd=work_directory, env=environment(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        async with httpx.AsyncClient(timeout=httpx.Timeout(timeout, read=None)) as client:
+            await wait_until_up(client, f"{base_url}/meeting_rooms", process, timeout=timeout)
+            ready = time.perf_counter() - started
+            await asyncio.sleep(idle)
+            latencies, _ = await simulate_ceo(client, base_url, room_id, 1, timeout)
+    finally:
+        process.terminate()
+        process.wait()
+    return ready, latencies[0] if latencies else float("nan")
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        fake_llm = subprocess.Popen([sys.executable, "-m", "bench.fake_openai", "--port", str(args.llm_port), "--latency", "0"],
+                                    cwd=SERVER_DIRECTORY, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            async with httpx.AsyncClient() as client:
+                await wait_until_up(client, f"http://127.0.0.1:{args.llm_port}/docs", fake_llm)
+
+            room_id = 1000
+            for index, warm_up in enumerate(args.warm_up):
+                work_directory = write_config(os.path.join(directory, str(index)), args.llm_port, args, extra=f"\n[startup]\nwarmUp = {warm_up}\n")
+                if index == 0:
+                    print(f"import src.main          {seconds(measure_import(work_directory, args.runs))}")
+                    if args.profile:
+                        for package, microseconds in import_profile(work_directory, args.top):
+                            print(f"    {package:<24} {microseconds / 1000:.0f}ms")
+
+                ready, first_reply = [], []
+                for _ in range(args.runs):
+                    ready_seconds, reply_seconds = await measure_startup(work_directory, args.port, room_id, args.timeout, args.idle)
+                    ready.append(ready_seconds)
+                    first_reply.append(reply_seconds)
+                    room_id += 1
+                print(f"warm-up: {warm_up or 'none'}")
+                print(f"    process start to ready {seconds(ready)}")
+                print(f"    first reply            {seconds(first_reply)}")
+        finally:
+            fake_llm.terminate()
+            fake_llm.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warm-up", action="append", help="[startup] warmUp setting to measure, can be repeated "
+                                                            "(default: none, then llm, graph, tokenizer)")
+    parser.add_argument("--profile", action="store_true", help="also show where import time goes, by package")
+    parser.add_argument("--top", type=int, default=15, help="packages shown by --profile")
+    parser.add_argument("--idle", type=float, default=0, help="seconds between the server being ready and the first message")
+    parser.add_argument("--port", type=int, default=8020)
+    parser.add_argument("--llm-port", type=int, default=8120)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+    args.warm_up = args.warm_up or ["", "llm, graph, tokenizer"]
+    # write_config options of the load test
+    args.workers, args.database_url = 4, None
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
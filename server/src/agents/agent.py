@@ -1,14 +1,25 @@
+import asyncio
+import logging
 from abc import ABC, abstractmethod
-from typing import Optional, Type
-from sqlalchemy.orm import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from textwrap import dedent
-from O365 import Account
 from ..db import crud
+from ..db.database import get_session
 from ..db.models import Message
+from ..jobs.job_queue import is_transient
+from .context import contexts, count_tokens
+from ..memory.memory import memory
 from ..llm.openai_client import respond_to_messages
-from ..tools.tool import BaseTool
+from ..tools.tool import BaseTool, ToolCallError, ToolRegistry
 from ..tools.microsoft.ms_graph_tool import MicrosoftGraphCalendarTool, MicrosoftGraphEmailTool
 
+logger = logging.getLogger(__name__)
+
+# Characters of each recalled message put in the prompt
+RECALLED_MESSAGE_LENGTH = 500
+# Tokens of the context budget kept for recalled messages
+RECALLED_TOKENS = 700
+
 class Agent(ABC):
     """
     Base class for all agents.
@@ -20,9 +31,24 @@ class Agent(ABC):
     3. If the agent needs to use a tool, the corresponding tool will be called to process the message.
     4. With the processed result of the tool, repeat step 2-4 until the final response can be generated and sent back.
     """
-    def __init__(self, db_session: Optional[Session]=None):
-        self.db_session = db_session
+    _keywords = ()
+    _intents = ()
+    # Tools the agent can use
+    tool_classes = ()
+
+    fallback_response = "I'm sorry, I'm not able to provide an answer at this time. Could you please clarify your question?"
+
+    def __init__(self, tool_registry: ToolRegistry=None):
         self.tool_call_limit = 3
+        self.tool_registry = tool_registry if tool_registry is not None else ToolRegistry([tool_class() for tool_class in self.tool_classes])
+
+    @property
+    def tools(self):
+        return list(self.tool_registry)
+
+    @tools.setter
+    def tools(self, tools: list[BaseTool]):
+        self.tool_registry = ToolRegistry(tools)
 
     @property
     def name(self):
@@ -36,62 +62,145 @@ class Agent(ABC):
     def responsibility(self):
         return self._responsibility
 
+    @property
+    def keywords(self):
+        """
+        Words that hint a message is meant for this agent, used by the local router in AgentManager.
+        """
+        return self._keywords
+
+    @property
+    def intents(self):
+        """
+        Words of requests only this agent's tools carry out, like sending an email. The local router never
+        confidently sends a message with one of them to another agent.
+        """
+        return self._intents
+
     @abstractmethod
     def system_message(self):
         pass
 
-    def respond(self, message: Message):
-        message_history = crud.messages_between_roles(self.db_session, role1=self.role, role2=message.role)
-        messages = []
-        messages.append({"role": "system", "content": self.system_message()})
-        for m in message_history:
-            if m.role == self.role:
-                messages.append({"role": "assistant", "content": m.text})
-            elif m.role == message.role:
-                messages.append({"role": "user", "content": m.text})
-
-        response = respond_to_messages(messages, tools=self.tools)
+    async def respond(self, message: Message):
+        """
+        Generate the reply to a message. No database session is held meanwhile, the LLM and tool calls take
+        seconds and each database access opens a short session of its own.
+        """
+        messages = await self.build_messages(message)
+        response = await respond_to_messages(messages, tools=self.tool_registry)
         if response.content is not None:
             return response.content
 
         tool_call_count = 0
         while tool_call_count < self.tool_call_limit:
-            for tool_call in response.tool_calls:
-                tool = self.get_tool_from_response(tool_call)
-                function_args = tool.parse_function_args(tool_call)
-                tool_exec_result = tool.run(**function_args)
-                tool_call_message = {
-                    "role": "tool",
-                    "name": tool.name,
-                    "tool_call_id": tool_call.id,
-                    "content": tool_exec_result,
-                }
-                messages.append(tool_call_message)
-
+            await self.run_tool_calls(messages, response.tool_calls)
             tool_call_count += 1
-            response = respond_to_messages(messages, tools=self.tools)
+            response = await respond_to_messages(messages, tools=self.tool_registry)
             if response.content is not None:
                 return response.content
 
-        return "I'm sorry, I'm not able to provide an answer at this time. Could you please clarify your question?"
-
-    def get_tool_from_response(self, tool_call) -> Type[BaseTool]:
-        tool_name = tool_call.function.name
-        for t in self.tools:
-            if t.name == tool_name:
-                return t
-        raise ValueError(f"Tool {tool_name} not found in tools list.")
-
-    def post_message(self, text: str, to_role:str=None, meeting_room_id: int=1):
-        if not self.db_session:
-            raise ValueError("Database session is not available for this agent.")
-
-        message = crud.create_message(self.db_session,
-                                      user_name=self.name,
-                                      text=text,
-                                      role=self.role,
-                                      to_role=to_role,
-                                      meeting_room_id=meeting_room_id)
+        return self.fallback_response
+
+    async def respond_stream(self, message: Message):
+        """
+        Same flow as `respond`, but yields the reply text as it is generated.
+        """
+        messages = await self.build_messages(message)
+        tool_call_count = 0
+        while True:
+            async for token in await respond_to_messages(messages, tools=self.tool_registry, stream=True):
+                yield token
+            response = messages[-1]
+            if response.content is not None:
+                return
+            if tool_call_count >= self.tool_call_limit:
+                break
+            await self.run_tool_calls(messages, response.tool_calls)
+            tool_call_count += 1
+
+        yield self.fallback_response
+
+    async def build_messages(self, message: Message):
+        context = contexts.get(self.role, message.role)
+        messages = await context.messages(self.system_message(), current=message, reserved_tokens=RECALLED_TOKENS if memory.enabled else 0)
+        recalled = await self.recall(message, exclude=context.message_ids)
+        header = "Earlier messages that may be relevant:"
+        lines = []
+        available = RECALLED_TOKENS - count_tokens(header)
+        for m in recalled:
+            line = f"- {m.timestamp:%Y-%m-%d %H:%M} {m.user_name} ({m.role}{f' to {m.to_role}' if m.to_role else ''}): {m.text[:RECALLED_MESSAGE_LENGTH]}"
+            # The recalled messages count against the context budget like the conversation does
+            available -= count_tokens(line)
+            if available < 0:
+                break
+            lines.append(line)
+        if lines:
+            # After the system message and the summary, before the conversation
+            position = next((i for i, m in enumerate(messages) if m["role"] != "system"), len(messages))
+            messages.insert(position, {"role": "system", "content": "\n".join([header, *lines])})
+        return messages
+
+    async def recall(self, message: Message, exclude: set=frozenset()):
+        """
+        The past messages most related to the message, other than those in `exclude`, oldest first.
+        """
+        try:
+            results = await memory.search(message.text, exclude=exclude | {message.id})
+        except Exception as e:
+            # A reply without recalled messages is better than no reply
+            logger.warning("Recalling messages failed: %r", e)
+            return []
+        if not results:
+            return []
+        async with get_session() as db:
+            recalled = await crud.get_messages_by_ids(db, [message_id for message_id, _ in results])
+        return sorted(recalled, key=lambda m: m.id)
+
+    async def run_tool_calls(self, messages, tool_calls):
+        """
+        Run all tool calls of a model turn concurrently and append their results in the original order.
+        """
+        results = await asyncio.gather(*[self.run_tool_call(tool_call) for tool_call in tool_calls])
+        for tool_call, tool_exec_result in zip(tool_calls, results):
+            tool_call_message = {
+                "role": "tool",
+                "name": tool_call.function.name,
+                "tool_call_id": tool_call.id,
+                "content": tool_exec_result,
+            }
+            messages.append(tool_call_message)
+
+    async def run_tool_call(self, tool_call):
+        try:
+            tool, function_args = self.tool_registry.resolve(tool_call)
+        except ToolCallError as e:
+            # Let the model correct the call instead of failing the whole reply
+            return str(e)
+        try:
+            return await tool.arun(**function_args)
+        except ToolCallError as e:
+            # Arguments can match the schema and still be unusable, like a malformed date
+            return str(e)
+        except asyncio.TimeoutError:
+            return f"The {tool.name} tool did not respond within {tool.timeout} seconds."
+        except Exception as e:
+            # A transient failure retries the job, anything else is reported to the model so it can answer without the tool
+            if is_transient(e):
+                raise
+            logger.warning("The %s tool failed: %r", tool.name, e)
+            return f"The {tool.name} tool failed: {e}"
+
+    def get_tool_from_response(self, tool_call) -> BaseTool:
+        return self.tool_registry.get(tool_call.function.name)
+
+    async def post_message(self, db: AsyncSession, text: str, to_role:str=None, meeting_room_id: int=1, claim=None):
+        message = await crud.create_message(db,
+                                            user_name=self.name,
+                                            text=text,
+                                            role=self.role,
+                                            to_role=to_role,
+                                            meeting_room_id=meeting_room_id,
+                                            claim=claim)
         return message
 
 
@@ -102,13 +211,12 @@ class AssistantAgent(Agent):
     _name = "Amy"
     _role = "CEO Assistant"
     _responsibility = "provide administrative support to the CEO and coordinate the CEO's schedule"
-
-    def __init__(self, db_session: Optional[Session]=None):
-        super().__init__(db_session=db_session)
-        self.tools = [
-            MicrosoftGraphCalendarTool(),
-            MicrosoftGraphEmailTool(),
-        ]
+    _keywords = ("calendar", "meeting", "meetings", "schedule", "appointment", "event", "today", "tomorrow", "week", "email", "emails", "inbox", "mail", "book", "reschedule", "availability")
+    _intents = ("email", "emails", "mail", "inbox", "send", "reply", "forward", "calendar", "schedule", "reschedule", "meeting", "meetings", "book", "invite", "appointment", "availability")
+    tool_classes = (
+        MicrosoftGraphCalendarTool,
+        MicrosoftGraphEmailTool,
+    )
 
     def system_message(self):
         return dedent(f"""
@@ -124,6 +232,7 @@ class EngineeringManagerAgent(Agent):
     _name = "Michael"
     _role = "Engineering Manager"
     _responsibility = "provide update on software development and release progress"
+    _keywords = ("engineering", "jira", "sprint", "ticket", "tickets", "bug", "bugs", "feature", "deploy", "deployment", "release", "roadmap", "code", "developer", "developers", "team", "milestone")
 
     def system_message(self):
         return dedent(f"""
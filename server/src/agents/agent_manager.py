@@ -1,24 +1,205 @@
-from typing import List
+import asyncio
+import logging
+import math
+import random
+import re
+from collections import Counter, OrderedDict
+from typing import List, Optional
 from textwrap import dedent
 from .agent import Agent
-from ..llm.openai_client import respond_to_prompt
+from ..llm.openai_client import LLMTimeoutError, respond_to_prompt
+from ..telemetry.tracing import tracer
 
-class AgentManager:
+logger = logging.getLogger(__name__)
+
+STOP_WORDS = frozenset("""
+a an and are as at be by can could did do does for from have how i in is it me my of on or our please
+provide should so that the their there this to up us was we what when where which who will with would you your
+""".split())
+
+def normalize_text(text: str) -> str:
+  return " ".join(re.findall(r"[a-z0-9']+", text.lower()))
+
+def tokenize(text: str) -> List[str]:
+  # Crude plural folding is enough for matching messages against a handful of role descriptions
+  words = [word for word in normalize_text(text).replace("'", "").split() if word not in STOP_WORDS]
+  return [word[:-1] if len(word) > 3 and word.endswith("s") else word for word in words]
+
+
+class RoleClassifier:
+  """
+  TF-IDF similarity between a message and each agent's role, responsibility, keywords and intents. Intents
+  count `intent_weight` times, a request for what an agent's tools do outweighs the topic it is about.
+  """
+  intent_weight = 3
+
+  def __init__(self, agents: List[Agent]):
+    intents = [Counter(tokenize(" ".join(agent.intents))) for agent in agents]
+    documents = [Counter(tokenize(" ".join([agent.role, agent.responsibility, *agent.keywords]))) + Counter({term: self.intent_weight for term in agent_intents})
+                 for agent, agent_intents in zip(agents, intents)]
+    document_frequency = Counter(term for document in documents for term in document)
+    self.idf = {term: math.log((1 + len(documents)) / (1 + df)) + 1 for term, df in document_frequency.items()}
+    self.roles = [agent.role for agent in agents]
+    self.vectors = [self._normalize({term: count * self.idf[term] for term, count in document.items()}) for document in documents]
+    self.intent_roles = {}
+    for agent, agent_intents in zip(self.roles, intents):
+      for term in agent_intents:
+        self.intent_roles.setdefault(term, set()).add(agent)
 
   @staticmethod
-  def analyze_message_for_agent(message_text: str, agents: List[Agent]) -> Agent:
+  def _normalize(vector: dict) -> dict:
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    return {term: v / norm for term, v in vector.items()} if norm else vector
+
+  def scores(self, message_text: str) -> List[tuple]:
+    terms = Counter(term for term in tokenize(message_text) if term in self.idf)
+    query = self._normalize({term: count * self.idf[term] for term, count in terms.items()})
+    scores = [(role, sum(weight * vector.get(term, 0.0) for term, weight in query.items())) for role, vector in zip(self.roles, self.vectors)]
+    return sorted(scores, key=lambda x: x[1], reverse=True)
+
+  def intended_roles(self, message_text: str) -> set:
+    """
+    Roles whose intents the message mentions.
+    """
+    return {role for term in tokenize(message_text) for role in self.intent_roles.get(term, ())}
+
+
+class AgentManager:
+  """
+  Routes CEO messages to an agent in three tiers: a cache of recent decisions, a local classifier, and only
+  when the classifier is not confident, a call to the LLM.
+
+  The LLM also checks a `shadow_rate` sample of the confident decisions in the background, which measures
+  the classifier's accuracy on the decisions it makes alone and corrects the cached ones it got wrong.
+  """
+  cache_size = 1024
+  min_score = 0.15
+  min_margin = 0.3
+  shadow_rate = 0.05
+
+  _route_cache = OrderedDict()
+  _classifiers = {}
+  _shadow_checks = set()
+  stats = Counter()
+
+  @classmethod
+  @tracer.traced("route")
+  async def analyze_message_for_agent(cls, message_text: str, agents: List[Agent]) -> Agent:
     """
     Determines if a specific role should respond to a message.
     """
-    agent_roles = [agent.role for agent in agents]
+    agents_by_role = {agent.role: agent for agent in agents}
+    key = normalize_text(message_text)
+    cached_role = cls._route_cache.get(key)
+    if cached_role in agents_by_role:
+      cls._route_cache.move_to_end(key)
+      cls.stats["cache_hits"] += 1
+      tracer.current().set(tier="cache")
+      return agents_by_role[cached_role]
+
+    role, confident = cls.classify(message_text, agents)
+    if confident:
+      cls.stats["classifier_hits"] += 1
+      tracer.current().set(tier="classifier")
+      if random.random() < cls.shadow_rate:
+        check = asyncio.create_task(cls._shadow_check(key, message_text, agents, role))
+        # Keep a reference, the event loop only holds weak ones to tasks
+        cls._shadow_checks.add(check)
+        check.add_done_callback(cls._shadow_checks.discard)
+    else:
+      try:
+        llm_role = await cls.ask_llm(message_text, agents)
+      except LLMTimeoutError:
+        if role is None:
+          raise
+        # Past the routing deadline the classifier's guess beats no reply, but it is not worth remembering
+        cls.stats["llm_timeouts"] += 1
+        tracer.current().set(tier="classifier_fallback")
+        return agents_by_role[role]
+      cls.stats["llm_calls"] += 1
+      tracer.current().set(tier="llm")
+      if role is not None and llm_role is not None:
+        # The LLM is the reference answer, track how often the classifier's best guess agreed with it
+        cls.stats["classifier_guesses"] += 1
+        cls.stats["classifier_agreements"] += int(role == llm_role)
+      if llm_role is None and role is None:
+        cls.stats["failures"] += 1
+        raise ValueError(f"Could not route message: {message_text}")
+      role = llm_role or role
+
+    cls._remember(key, role)
+    return agents_by_role[role]
+
+  @classmethod
+  def classify(cls, message_text: str, agents: List[Agent]) -> tuple:
+    """
+    Returns the best matching role, or None when nothing matched, and whether the match is confident.
+    """
+    roles = tuple(agent.role for agent in agents)
+    if roles not in cls._classifiers:
+      cls._classifiers[roles] = RoleClassifier(agents)
+    scores = cls._classifiers[roles].scores(message_text)
+    best_role, best_score = scores[0]
+    if best_score == 0:
+      return None, False
+    runner_up_score = scores[1][1] if len(scores) > 1 else 0.0
+    confident = best_score >= cls.min_score and (best_score - runner_up_score) / best_score >= cls.min_margin
+    intended_roles = cls._classifiers[roles].intended_roles(message_text)
+    if intended_roles and best_role not in intended_roles:
+      # The message asks for something another agent's tools do, like an email about engineering
+      confident = False
+    return best_role, confident
+
+  @classmethod
+  async def _shadow_check(cls, key: str, message_text: str, agents: List[Agent], role: str):
+    """
+    Ask the LLM about a message the classifier routed confidently, and remember its answer when it disagrees.
+    """
+    try:
+      llm_role = await cls.ask_llm(message_text, agents)
+    except Exception as e:
+      logger.warning("Shadow check of a routing decision failed: %r", e)
+      return
+    if llm_role is None:
+      return
+    cls.stats["shadow_checks"] += 1
+    cls.stats["shadow_agreements"] += int(llm_role == role)
+    if llm_role != role:
+      logger.info("The classifier routed %r to %s, the LLM to %s", message_text, role, llm_role)
+      cls._remember(key, llm_role)
+
+  @staticmethod
+  async def ask_llm(message_text: str, agents: List[Agent]) -> Optional[str]:
     agent_values = [{"name": agent.name, "role": agent.role, "responsibility": agent.responsibility} for agent in agents]
     prompt = dedent(f"""
     Who should respond to this message from the company's CEO: {message_text}
     Options: {agent_values}
     Only one role should respond. Please reply with the name of the role only. For example, "CEO Assistant".
     """)
-    response = respond_to_prompt(prompt=prompt)
-    if response in agent_roles:
-      return list(filter(lambda x: x.role == response, agents))[0]
-    else:
-      raise ValueError(f"Invalid role: {response}")
\ No newline at end of file
+    response = normalize_text(await respond_to_prompt(prompt=prompt, call_type="routing") or "")
+    # Tolerate punctuation, quotes and extra words around the role name
+    for agent in sorted(agents, key=lambda x: len(x.role), reverse=True):
+      if normalize_text(agent.role) in response:
+        return agent.role
+    return None
+
+  @classmethod
+  def _remember(cls, key: str, role: str):
+    cls._route_cache[key] = role
+    cls._route_cache.move_to_end(key)
+    while len(cls._route_cache) > cls.cache_size:
+      cls._route_cache.popitem(last=False)
+
+  @classmethod
+  def routing_stats(cls) -> dict:
+    routed = cls.stats["cache_hits"] + cls.stats["classifier_hits"] + cls.stats["llm_calls"]
+    return {
+      **cls.stats,
+      "routed": routed,
+      "cache_hit_rate": cls.stats["cache_hits"] / routed if routed else 0.0,
+      "llm_skip_rate": (routed - cls.stats["llm_calls"]) / routed if routed else 0.0,
+      # Confident decisions, checked by the LLM in the background
+      "classifier_accuracy": cls.stats["shadow_agreements"] / cls.stats["shadow_checks"] if cls.stats["shadow_checks"] else None,
+      # Best guesses when not confident, compared with the LLM's answer
+      "guess_accuracy": cls.stats["classifier_agreements"] / cls.stats["classifier_guesses"] if cls.stats["classifier_guesses"] else None,
+    }
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+from textwrap import dedent
+import tiktoken
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..db import crud
+from ..db.database import get_session
+from ..llm.openai_client import LLMTimeoutError, respond_to_prompt
+
+logger = logging.getLogger(__name__)
+
+# Every chat message costs a few tokens on top of its content for the role and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+
+
+class CharacterEstimate:
+    """
+    Stands in for the tiktoken encoding when it cannot be loaded, e.g. offline on a first run when it has to
+    be downloaded. English text averages about four characters per token.
+    """
+    chars_per_token = 4
+
+    def encode(self, text: str):
+        return range(-(-len(text) // self.chars_per_token))
+
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        except Exception as e:
+            logger.warning("Could not load the tokenizer, token counts are estimated from the text length: %r", e)
+            _encoding = CharacterEstimate()
+    return len(_encoding.encode(text or "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+class ConversationContext:
+    """
+    The part of the conversation between an agent and one peer role that is sent to the LLM.
+
+    Messages join a conversation when they are routed, which is not in id order when several jobs run at
+    once, so each turn loads the messages after the summary that are not in the window yet, in one small
+    query instead of reloading the full history. When the window grows past the token budget, the oldest
+    turns are folded into a rolling summary that is persisted, so the prompt size stays flat however long
+    the conversation runs. Every worker process keeps its own context, so each turn also picks up a summary
+    another process stored since, and a summary is only stored when it covers more than the stored one.
+    """
+    def __init__(self, agent_role: str, peer_role: str, token_budget: int, summary_chunk_tokens: int=8000, summary_chunks_per_turn: int=4):
+        self.agent_role = agent_role
+        self.peer_role = peer_role
+        self.token_budget = token_budget
+        # Tokens of turns folded into the summary per LLM call, and calls per turn at most
+        self.summary_chunk_tokens = summary_chunk_tokens
+        self.summary_chunks_per_turn = summary_chunks_per_turn
+        self.summary = None
+        # Id of the last message folded into the summary
+        self.summarized_through = 0
+        self.window = []  # (message id, chat message, token count), in id order
+        self.lock = asyncio.Lock()
+
+    @property
+    def message_ids(self):
+        return {message_id for message_id, _, _ in self.window}
+
+    @property
+    def window_tokens(self):
+        return sum(tokens for _, _, tokens in self.window)
+
+    def _turn(self, message):
+        chat_role = "assistant" if message.role == self.agent_role else "user"
+        return message.id, {"role": chat_role, "content": message.text}, count_tokens(message.text)
+
+    async def messages(self, system_message: str, current=None, reserved_tokens: int=0):
+        """
+        Returns the chat messages for the next completion, starting with the system message. The message
+        being answered, `current`, always comes last. `reserved_tokens` of the budget are left for content
+        the caller adds.
+        """
+        async with self.lock:
+            async with get_session() as db:
+                await self._sync(db)
+            budget = self.token_budget - count_tokens(system_message) - reserved_tokens
+            if self.window_tokens + count_tokens(self.summary) > budget:
+                await self._summarize(budget)
+
+            turns = [turn for turn in self.window if current is None or turn[0] != current.id]
+            if current is not None:
+                turns.append(self._turn(current))
+            # When the summary is behind, e.g. it failed, send the latest turns that fit instead of too many
+            available = budget - count_tokens(self.summary)
+            first = len(turns) - 1
+            while first > 0 and sum(tokens for _, _, tokens in turns[first - 1:]) <= available:
+                first -= 1
+
+            messages = [{"role": "system", "content": system_message}]
+            if self.summary:
+                messages.append({"role": "system", "content": f"Summary of the earlier conversation with the {self.peer_role}: {self.summary}"})
+            messages.extend(dict(message) for _, message, _ in turns[max(first, 0):])
+            return messages
+
+    async def _sync(self, db: AsyncSession):
+        self._adopt(await crud.get_conversation_summary(db, self.agent_role, self.peer_role))
+        new_turns = [self._turn(m) for m in await crud.messages_between_roles(db, role1=self.agent_role, role2=self.peer_role,
+                                                                             after_id=self.summarized_through, exclude=self.message_ids)]
+        if new_turns:
+            self.window = sorted(self.window + new_turns, key=lambda turn: turn[0])
+
+    def _adopt(self, db_summary):
+        """
+        Take over a stored summary that covers more of the conversation than this one.
+        """
+        if db_summary is None or db_summary.last_message_id <= self.summarized_through:
+            return
+        self.summary = db_summary.summary
+        self.summarized_through = db_summary.last_message_id
+        self.window = [turn for turn in self.window if turn[0] > self.summarized_through]
+
+    async def _summarize(self, budget: int):
+        # Fold down to half the budget so the summary is not rewritten on every turn, but always keep the latest message
+        summary_tokens = count_tokens(self.summary)
+        remaining_tokens = self.window_tokens
+        evicted = []
+        while len(evicted) < len(self.window) - 1 and remaining_tokens + summary_tokens > budget // 2:
+            evicted.append(self.window[len(evicted)])
+            remaining_tokens -= evicted[-1][2]
+
+        # A long history, like on the first load of an existing conversation, is folded in a few calls per turn
+        # that each fit the summary model, the rest on the next turns
+        for _ in range(self.summary_chunks_per_turn):
+            chunk = []
+            while evicted and (not chunk or sum(tokens for _, _, tokens in chunk) + evicted[0][2] <= self.summary_chunk_tokens):
+                chunk.append(evicted.pop(0))
+            if not chunk or not await self._fold(chunk):
+                return
+
+    async def _fold(self, turns: list) -> bool:
+        """
+        Fold the oldest turns of the window into the summary. Returns whether the summary moved on.
+        """
+        # A single turn longer than a chunk is cut, about four characters to a token
+        length = self.summary_chunk_tokens * 4
+        transcript = "\n".join(f"{self.agent_role if message['role'] == 'assistant' else self.peer_role}: {message['content'][:length]}" for _, message, _ in turns)
+        prompt = dedent(f"""
+        Update the summary of a conversation between the {self.agent_role} and the {self.peer_role} with the new messages below.
+        Keep names, dates, decisions and open questions. Reply with the updated summary only, in at most 200 words.
+        Current summary: {self.summary or "None"}
+        New messages:
+        """) + transcript
+        # The window only drops the folded turns once their summary is saved, so a failure or a cancelled turn
+        # loses nothing
+        try:
+            summary = await respond_to_prompt(prompt=prompt, call_type="summary")
+        except LLMTimeoutError:
+            # Send this turn with the latest turns that fit rather than wait, the summary is retried on the next turn
+            logger.warning("Summarizing the conversation between the %s and the %s timed out", self.agent_role, self.peer_role)
+            return False
+        except Exception as e:
+            # Same for a rejected or failed call, a conversation must not stop getting replies over its summary
+            logger.warning("Summarizing the conversation between the %s and the %s failed: %r", self.agent_role, self.peer_role, e)
+            return False
+        last_message_id = turns[-1][0]
+        # A session of its own, not one held open while the LLM writes the summary
+        async with get_session() as db:
+            if not await crud.save_conversation_summary(db, self.agent_role, self.peer_role, summary, last_message_id=last_message_id):
+                # Another process summarized further meanwhile, use its summary instead
+                self._adopt(await crud.get_conversation_summary(db, self.agent_role, self.peer_role))
+                return False
+        self.summary = summary
+        self.summarized_through = last_message_id
+        self.window = [turn for turn in self.window if turn[0] > last_message_id]
+        return True
+
+
+class ContextStore:
+    def __init__(self, token_budget: int=6000, summary_chunk_tokens: int=8000):
+        self.token_budget = token_budget
+        self.summary_chunk_tokens = summary_chunk_tokens
+        self._contexts = {}
+
+    async def warm_up(self):
+        """
+        Load the tokenizer in a worker thread, tiktoken reads (and on first run downloads) its encoding on first use.
+        """
+        await asyncio.to_thread(count_tokens, "")
+
+    def get(self, agent_role: str, peer_role: str) -> ConversationContext:
+        key = (agent_role, peer_role)
+        if key not in self._contexts:
+            self._contexts[key] = ConversationContext(agent_role, peer_role, self.token_budget, summary_chunk_tokens=self.summary_chunk_tokens)
+        return self._contexts[key]
+
+
+contexts = ContextStore()
@@ -0,0 +1,43 @@
+from typing import List, Type
+from .agent import Agent, AssistantAgent, EngineeringManagerAgent
+from ..tools.tool import BaseTool, ToolRegistry
+
+class AgentRegistry:
+    """
+    The agent types the server runs, and fresh agents built from them for each request.
+
+    Agents hold no state of their own between requests, the database session and message are passed to
+    each call, so every request or job gets its own agents and every worker process builds the same ones.
+    Tools are the exception: their result caches and their Graph connection are worth keeping, so each
+    tool is built once per process and shared by the agents of every request.
+    """
+    def __init__(self, agent_classes: List[Type[Agent]]=()):
+        self.agent_classes = list(agent_classes)
+        self._tools = {}
+        self._tool_registries = {}
+
+    def register(self, agent_class: Type[Agent]) -> Type[Agent]:
+        self.agent_classes.append(agent_class)
+        return agent_class
+
+    def tool(self, tool_class: Type[BaseTool]) -> BaseTool:
+        if tool_class not in self._tools:
+            self._tools[tool_class] = tool_class()
+        return self._tools[tool_class]
+
+    def tools(self) -> List[BaseTool]:
+        """
+        Every tool of the registered agents.
+        """
+        return list({id(tool): tool for agent_class in self.agent_classes for tool in self.tool_registry(agent_class)}.values())
+
+    def tool_registry(self, agent_class: Type[Agent]) -> ToolRegistry:
+        if agent_class not in self._tool_registries:
+            self._tool_registries[agent_class] = ToolRegistry([self.tool(tool_class) for tool_class in agent_class.tool_classes])
+        return self._tool_registries[agent_class]
+
+    def agents(self) -> List[Agent]:
+        return [agent_class(self.tool_registry(agent_class)) for agent_class in self.agent_classes]
+
+
+agent_registry = AgentRegistry([AssistantAgent, EngineeringManagerAgent])
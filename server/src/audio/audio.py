@@ -1,87 +1,134 @@
-import json
+import io
+import numpy as np
 from pydub import AudioSegment
-from pydub.silence import split_on_silence
-import whisper
-from openai import OpenAI
 
-def generate_mouth_cues(audio, threshold=-60, min_silence_len=100, chunk_length=150):
+# Rhubarb mouth shapes used by the avatar: X is the resting mouth used for silence
+SILENCE_SHAPE = "X"
+
+def audio_to_samples(audio: AudioSegment) -> np.ndarray:
+    """
+    Mono float samples in [-1, 1] from a pydub audio segment.
+    """
+    samples = np.asarray(audio.get_array_of_samples(), dtype=np.float32).reshape(-1, audio.channels).mean(axis=1)
+    return samples / audio.max_possible_amplitude
+
+def generate_mouth_cues_from_samples(samples: np.ndarray, sample_rate: int, threshold=-60, min_silence_len=100, frame_length=50, spectral=True):
     """
-    Generate mouth cues based on sound and silence.
+    Generate mouth cues from the loudness and brightness of the signal, computed for all frames at once.
     Parameters:
-    - audio: Loaded audio segment.
-    - threshold: Silence threshold in dB.
-    - min_silence_len: Minimum length of a silence to consider in milliseconds.
-    - chunk_length: Duration of each audio chunk analyzed for mouth shape alternation in milliseconds.
+    - samples: Mono samples in [-1, 1].
+    - sample_rate: Samples per second.
+    - threshold: Silence threshold in dBFS.
+    - min_silence_len: Minimum length of a silence to close the mouth for in milliseconds, shorter pauses keep it moving.
+    - frame_length: Duration of each analysis frame in milliseconds, the shortest possible cue.
+    - spectral: Use the spectral centroid to tell open vowels from rounded ones and fricatives, otherwise only loudness is used.
     Returns a list of mouth cues.
     """
-    # Split audio based on silence
-    chunks = split_on_silence(audio, silence_thresh=threshold, min_silence_len=min_silence_len, keep_silence=300)
-
-    cues = []
-    start_time = 0.0
-    mouth_shapes = ["A", "B", "C", "D", "E", "F", "G", "H"]
-    mouth_index = 0
-
-    for chunk in chunks:
-        # Calculate chunk duration
-        chunk_duration = len(chunk) / 1000.0
-
-        print(chunk_duration)
-
-        # Split chunk into smaller pieces
-        num_pieces = max(1, int(chunk_duration * 1000 / chunk_length))
-        piece_duration = chunk_duration / num_pieces
-
-        for i in range(num_pieces):
-            end_time = start_time + piece_duration
-            cue = {
-                "start": round(start_time, 2),
-                "end": round(end_time, 2),
-                "value": mouth_shapes[mouth_index]
-            }
-            cues.append(cue)
-            start_time = end_time
-            mouth_index = (mouth_index + 1) % len(mouth_shapes)
-
-        # Assume a short silence after each chunk before the next chunk (or end)
-        if start_time < len(audio) / 1000.0:
-            end_time = start_time + 0.1 # 0.1 second of silence
-            cue = {
-                "start": round(start_time, 2),
-                "end": round(end_time, 2),
-                "value": "X" # Closed mouth for silence
-            }
-            cues.append(cue)
-            start_time = end_time
-
-    return cues
+    frame_size = max(1, int(sample_rate * frame_length / 1000))
+    frame_count = len(samples) // frame_size
+    if frame_count == 0:
+        return []
+    frames = samples[:frame_count * frame_size].reshape(frame_count, frame_size)
 
-def generate_json_from_mp3(mp3_path):
-    audio = AudioSegment.from_mp3(mp3_path)
-    duration_seconds = len(audio) / 1000.0
-    mouth_cues = generate_mouth_cues(audio)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    db = 20 * np.log10(np.maximum(rms, 1e-10))
+    voiced = db > threshold
+
+    # Reopen the mouth over pauses shorter than min_silence_len
+    min_silence_frames = max(1, int(np.ceil(min_silence_len / frame_length)))
+    edges = np.flatnonzero(np.diff(np.concatenate(([1], voiced.astype(np.int8), [1]))))
+    gap_starts, gap_ends = edges[0::2], edges[1::2]
+    short_gaps = (gap_ends - gap_starts < min_silence_frames) & (gap_starts > 0) & (gap_ends < frame_count)
+    if short_gaps.any():
+        fill = np.zeros(frame_count + 1, dtype=np.int32)
+        np.add.at(fill, gap_starts[short_gaps], 1)
+        np.add.at(fill, gap_ends[short_gaps], -1)
+        voiced |= np.cumsum(fill[:-1]) > 0
 
-    data = {
+    # Loudness relative to the loudest frame: 0 at the silence threshold, 1 at the peak
+    peak = db[voiced].max() if voiced.any() else threshold
+    loudness = np.clip((db - threshold) / max(peak - threshold, 1e-6), 0, 1)
+    if spectral:
+        spectrum = np.abs(np.fft.rfft(frames * np.hanning(frame_size), axis=1))
+        frequencies = np.fft.rfftfreq(frame_size, d=1.0 / sample_rate)
+        centroid = (spectrum @ frequencies) / np.maximum(spectrum.sum(axis=1), 1e-10)
+    else:
+        centroid = np.full(frame_count, 1500.0)
+
+    shapes = np.select(
+        [
+            ~voiced,
+            loudness < 0.35,                         # closed lips: M, B, P
+            centroid > 3500,                         # hiss and teeth: S, T, K
+            (centroid > 2500) & (loudness < 0.6),    # lower lip on teeth: F, V
+            (loudness > 0.8) & (centroid < 1800),    # wide open: AA
+            loudness > 0.6,                          # open: EH, AE
+            centroid < 700,                          # puckered: UW, OW, W
+            centroid < 1100,                         # rounded: AO, ER
+        ],
+        [SILENCE_SHAPE, "A", "B", "G", "D", "C", "F", "E"],
+        default="H",                                 # tongue up: L
+    )
+
+    # One cue per run of identical shapes
+    changes = np.flatnonzero(shapes[1:] != shapes[:-1]) + 1
+    starts = np.concatenate(([0], changes))
+    ends = np.concatenate((changes, [frame_count]))
+    seconds_per_frame = frame_size / sample_rate
+    return [
+        {"start": round(float(start * seconds_per_frame), 2), "end": round(float(end * seconds_per_frame), 2), "value": str(shapes[start])}
+        for start, end in zip(starts, ends)
+    ]
+
+def generate_mouth_cues(audio, threshold=-60, min_silence_len=100, frame_length=50):
+    """
+    Generate mouth cues for a loaded audio segment, see `generate_mouth_cues_from_samples`.
+    """
+    return generate_mouth_cues_from_samples(audio_to_samples(audio), audio.frame_rate, threshold=threshold, min_silence_len=min_silence_len, frame_length=frame_length)
+
+def generate_lipsync(audio, sound_file: str) -> dict:
+    """
+    Lip-sync data in the format the avatar reads: the mouth cues plus the sound file they belong to.
+    """
+    return {
         "metadata": {
-            "soundFile": mp3_path,
-            "duration": duration_seconds
+            "soundFile": sound_file,
+            "duration": len(audio) / 1000.0
         },
-        "mouthCues": mouth_cues
+        "mouthCues": generate_mouth_cues(audio)
     }
-    print(json.dumps(data))
+
+def generate_json_from_mp3(mp3_path):
+    return generate_lipsync(AudioSegment.from_mp3(mp3_path), mp3_path)
+
+def decode_mp3(data: bytes) -> AudioSegment:
+    return AudioSegment.from_file(io.BytesIO(data), format="mp3")
 
 
 def speech_to_text(mp3_path: str) -> str:
+    # Imported here since whisper pulls in torch, which takes seconds to import
+    import whisper
     model = whisper.load_model("small.en")
     result = model.transcribe(mp3_path, fp16=False)
     return(result["text"])
 
-def text_to_speech(text: str, file_path: str) -> None:
-    client = OpenAI()
-    response = client.audio.speech.create(
-        model="tts-1",
-        voice="alloy",
+_openai_client = None
+
+def synthesize_speech(text: str, voice: str="alloy", model: str="tts-1") -> bytes:
+    """
+    Returns the MP3 audio for the text.
+    """
+    global _openai_client
+    if _openai_client is None:
+        from openai import OpenAI
+        _openai_client = OpenAI()
+    response = _openai_client.audio.speech.create(
+        model=model,
+        voice=voice,
         input=text
     )
-    response.write_to_file(file_path)
+    return response.content
 
+def text_to_speech(text: str, file_path: str) -> None:
+    with open(file_path, "wb") as f:
+        f.write(synthesize_speech(text))
@@ -0,0 +1,148 @@
+import asyncio
+import base64
+import logging
+import re
+from typing import AsyncIterator
+from .tts_cache import SpeechCache
+
+logger = logging.getLogger(__name__)
+
+# A sentence ends at terminal punctuation (optionally followed by closing quotes or brackets) and whitespace, or at a line break
+SENTENCE_END = re.compile(r"""[.!?]+["')\]]*\s+|\n+""")
+# The word, or dotted abbreviation like "e.g", before a period
+LAST_WORD = re.compile(r"([\w.]*\w)$")
+# Abbreviations whose period does not end the sentence. Single letters, like initials, never do either.
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "mt", "vs", "e.g", "i.e", "a.m", "p.m",
+                 "inc", "ltd", "co", "corp", "dept", "approx", "fig"}
+
+def is_abbreviation(text: str) -> bool:
+    """
+    Whether the period right after `text` belongs to an abbreviation.
+    """
+    match = LAST_WORD.search(text)
+    if match is None:
+        return False
+    word = match.group(1).lower()
+    return word in ABBREVIATIONS or all(len(part) == 1 for part in word.split("."))
+
+def find_sentence_end(text: str, start: int):
+    """
+    The first match of SENTENCE_END in `text` from `start` on that is not the period of an abbreviation.
+    """
+    for match in SENTENCE_END.finditer(text, start):
+        if match.group().startswith(".") and not match.group().startswith("..") and is_abbreviation(text[:match.start()]):
+            continue
+        return match
+    return None
+
+async def split_sentences(chunks: AsyncIterator[str], min_length: int=20) -> AsyncIterator[str]:
+    """
+    Regroup streamed text into sentences as soon as each one is complete. Sentences shorter than
+    `min_length` characters are joined with the next one, and the periods of abbreviations like "Dr." or
+    "e.g." do not end a sentence.
+    """
+    buffer = ""
+    async for chunk in chunks:
+        buffer += chunk
+        while True:
+            match = find_sentence_end(buffer, min_length)
+            if match is None:
+                break
+            sentence, buffer = buffer[:match.end()].strip(), buffer[match.end():]
+            if sentence:
+                yield sentence
+    if buffer.strip():
+        yield buffer.strip()
+
+async def stream_speech(chunks: AsyncIterator[str], speech_cache: SpeechCache, concurrency: int=3) -> AsyncIterator[tuple]:
+    """
+    Speak streamed text sentence by sentence. Up to `concurrency` sentences are synthesized at once, and
+    ("speech", segment) pairs are yielded in order with their mouth cues shifted to the segment's place in
+    the reply. A sentence that fails to synthesize is skipped with a ("speech_error", ...) pair.
+    """
+    pending = asyncio.Queue(maxsize=concurrency)
+
+    async def synthesize():
+        try:
+            async for sentence in split_sentences(chunks):
+                await pending.put((sentence, asyncio.ensure_future(speech_cache.get(sentence))))
+        finally:
+            await pending.put(None)
+
+    producer = asyncio.create_task(synthesize())
+    offset = 0.0
+    index = 0
+    try:
+        while (item := await pending.get()) is not None:
+            sentence, task = item
+            try:
+                mp3, lipsync = await task
+            except Exception as e:
+                logger.warning("Synthesizing sentence %d failed: %r", index, e)
+                yield "speech_error", {"index": index, "text": sentence, "error": str(e)}
+                index += 1
+                continue
+            duration = lipsync["metadata"]["duration"]
+            yield "speech", {
+                "index": index,
+                "text": sentence,
+                "offset": round(offset, 2),
+                "duration": duration,
+                "audio": base64.b64encode(mp3).decode("ascii"),
+                "mouthCues": [{**cue, "start": round(cue["start"] + offset, 2), "end": round(cue["end"] + offset, 2)} for cue in lipsync["mouthCues"]],
+            }
+            offset += duration
+            index += 1
+        await producer
+    finally:
+        producer.cancel()
+
+async def with_speech(events: AsyncIterator[tuple], speech_cache: SpeechCache) -> AsyncIterator[tuple]:
+    """
+    Pass through the (event, data) pairs of a streamed reply and interleave ("speech", segment) events for
+    the reply tokens as soon as each segment is synthesized, ending with ("speech_done", {"segments": count}).
+    A sentence that fails to synthesize gets a ("speech_error", ...) event instead, and the text goes on.
+    """
+    tokens = asyncio.Queue()
+    # Events and segments in the order they are ready, and each of the two tasks once it is done
+    merged = asyncio.Queue()
+
+    async def token_stream():
+        while (token := await tokens.get()) is not None:
+            yield token
+
+    async def forward():
+        try:
+            async for event, data in events:
+                if event == "token":
+                    tokens.put_nowait(data)
+                merged.put_nowait((event, data))
+        finally:
+            tokens.put_nowait(None)
+
+    async def speak():
+        async for event, data in stream_speech(token_stream(), speech_cache):
+            merged.put_nowait((event, data))
+
+    tasks = [asyncio.create_task(forward()), asyncio.create_task(speak())]
+    for task in tasks:
+        task.add_done_callback(merged.put_nowait)
+    count = 0
+    try:
+        running = len(tasks)
+        while running:
+            item = await merged.get()
+            if isinstance(item, asyncio.Task):
+                running -= 1
+                # Surface errors of the reply stream and of synthesis
+                item.result()
+                continue
+            if item[0] == "speech":
+                count += 1
+            yield item
+        yield "speech_done", {"segments": count}
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Let the reply stream clean up, e.g. release its claim on the message
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,173 @@
+import asyncio
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+from ..telemetry.tracing import tracer
+
+WHISPER_SAMPLE_RATE = 16000
+
+
+class AudioDecodeError(ValueError):
+    """
+    A clip that is not audio in a format ffmpeg can read.
+    """
+
+
+def decode_audio(data: bytes) -> np.ndarray:
+    """
+    Decode an audio file held in memory into 16 kHz mono float samples, the input whisper expects.
+    """
+    try:
+        audio = AudioSegment.from_file(io.BytesIO(data))
+    except CouldntDecodeError as e:
+        raise AudioDecodeError(f"Could not decode the audio: {str(e).strip().splitlines()[0]}") from e
+    audio = audio.set_frame_rate(WHISPER_SAMPLE_RATE).set_channels(1)
+    return np.asarray(audio.get_array_of_samples(), dtype=np.float32) / audio.max_possible_amplitude
+
+
+class SpeechToTextService:
+    """
+    Keeps whisper models resident and transcribes queued clips in batches.
+
+    Each worker thread loads the model once. Clips are queued as they arrive and a free worker takes up
+    to `batch_size` of them at a time; clips of up to 30 seconds are decoded together in one batched
+    forward pass, longer clips go through whisper's regular sliding-window transcription. A clip that cannot
+    be decoded fails with AudioDecodeError on its own, the rest of its batch is transcribed.
+    """
+    def __init__(self, model_name: str="small.en", workers: int=1, batch_size: int=8, batch_window: float=0.05):
+        self.model_name = model_name
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stt")
+        self._local = threading.local()
+        self._queue = None
+        self._slots = None
+        self._dispatcher = None
+        # Batches in flight, the event loop only keeps weak references to tasks
+        self._batches = set()
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        tasks = [self._dispatcher, *self._batches] if self._dispatcher is not None else list(self._batches)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def warm_up(self):
+        """
+        Load the model in every worker and run a short silent clip through it, so the first request does not pay for it.
+        """
+        loop = asyncio.get_running_loop()
+        silence = np.zeros(WHISPER_SAMPLE_RATE, dtype=np.float32)
+        await asyncio.gather(*[loop.run_in_executor(self._executor, self._transcribe_samples, [silence]) for _ in range(self.workers)])
+
+    async def transcribe(self, data: bytes) -> dict:
+        """
+        Transcribe an in-memory audio file. Returns the text with the time spent waiting in the queue and in inference.
+        Raises AudioDecodeError when the data is not audio ffmpeg can read.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((data, future, time.perf_counter()))
+        return await future
+
+    async def _dispatch(self):
+        while True:
+            # Wait for a free worker first, so clips that arrive meanwhile end up in the same batch
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+            deadline = time.perf_counter() + self.batch_window
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, batch):
+        started = time.perf_counter()
+        try:
+            texts = await asyncio.get_running_loop().run_in_executor(self._executor, self._transcribe_batch, [data for data, _, _ in batch])
+        except asyncio.CancelledError:
+            for _, future, _ in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            finished = time.perf_counter()
+            tracer.record("stt.inference", finished - started, batch_size=len(batch))
+            for text, (_, future, enqueued) in zip(texts, batch):
+                tracer.record("stt.queue", started - enqueued)
+                if future.done():
+                    continue
+                if isinstance(text, AudioDecodeError):
+                    future.set_exception(text)
+                else:
+                    future.set_result({
+                        "text": text,
+                        "queue_ms": round((started - enqueued) * 1000, 1),
+                        "inference_ms": round((finished - started) * 1000, 1),
+                        "batch_size": len(batch),
+                    })
+        finally:
+            self._slots.release()
+
+    def _model(self):
+        model = getattr(self._local, "model", None)
+        if model is None:
+            # Imported here since whisper pulls in torch, which takes seconds to import
+            import whisper
+            model = self._local.model = whisper.load_model(self.model_name)
+        return model
+
+    def _transcribe_batch(self, clips):
+        """
+        The text of each clip, or the AudioDecodeError of a clip that could not be decoded.
+        """
+        results = [None] * len(clips)
+        decoded, samples = [], []
+        for i, data in enumerate(clips):
+            try:
+                samples.append(decode_audio(data))
+                decoded.append(i)
+            except AudioDecodeError as e:
+                results[i] = e
+        if samples:
+            for i, text in zip(decoded, self._transcribe_samples(samples)):
+                results[i] = text
+        return results
+
+    def _transcribe_samples(self, samples):
+        import torch
+        import whisper
+        model = self._model()
+        texts = [None] * len(samples)
+        short = [i for i, s in enumerate(samples) if len(s) <= whisper.audio.N_SAMPLES]
+        if short:
+            mel = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(samples[i])), model.dims.n_mels) for i in short])
+            options = whisper.DecodingOptions(language="en", fp16=False, without_timestamps=True)
+            for i, result in zip(short, whisper.decode(model, mel.to(model.device), options)):
+                texts[i] = result.text
+        for i, s in enumerate(samples):
+            if texts[i] is None:
+                texts[i] = model.transcribe(s, fp16=False)["text"]
+        return texts
@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from . import audio
+from ..telemetry.tracing import tracer
+
+class SpeechCache:
+    """
+    Content-addressed cache of synthesized speech and its lip-sync data.
+
+    Entries are keyed by a hash of (text, voice, model) and stored as `<key>.mp3` and `<key>.json` side by
+    side in `directory`, with an index of sizes and last access times. When the total size exceeds
+    `max_bytes`, the least recently used entries are removed. Concurrent requests for the same speech wait
+    for a single synthesis.
+    """
+    index_file_name = "index.json"
+
+    def __init__(self, directory: str="./tts_cache", max_bytes: int=200 * 1024 * 1024, voice: str="alloy", model: str="tts-1"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.voice = voice
+        self.model = model
+        self._index = None
+        self._in_flight = {}
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text: str, voice: str, model: str) -> str:
+        return hashlib.sha256(json.dumps([text, voice, model]).encode("utf-8")).hexdigest()
+
+    async def get(self, text: str, voice: str=None, model: str=None) -> tuple:
+        """
+        Returns the MP3 bytes and lip-sync data for the text, synthesizing them on a miss.
+        """
+        voice, model = voice or self.voice, model or self.model
+        key = self.key(text, voice, model)
+        index = await self._load_index()
+        if key in index:
+            try:
+                mp3, lipsync = await asyncio.to_thread(self._read, key)
+            except FileNotFoundError:
+                index.pop(key, None)
+            else:
+                index[key]["last_access"] = time.time()
+                self.hits += 1
+                return mp3, lipsync
+
+        task = self._in_flight.get(key)
+        if task is None:
+            self.misses += 1
+            task = self._in_flight[key] = asyncio.ensure_future(self._create(key, text, voice, model))
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _create(self, key: str, text: str, voice: str, model: str) -> tuple:
+        with tracer.span("tts.synthesize", model=model, characters=len(text)):
+            mp3 = await asyncio.to_thread(audio.synthesize_speech, text, voice, model)
+        with tracer.span("tts.lipsync"):
+            lipsync = await asyncio.to_thread(lambda: audio.generate_lipsync(audio.decode_mp3(mp3), f"{key}.mp3"))
+        await asyncio.to_thread(self._write, key, mp3, lipsync)
+        async with self._lock:
+            self._index[key] = {"size": len(mp3) + len(json.dumps(lipsync)), "last_access": time.time()}
+            evicted = self._evict()
+            await asyncio.to_thread(self._remove_and_save, evicted, dict(self._index))
+        return mp3, lipsync
+
+    async def _load_index(self) -> dict:
+        if self._index is None:
+            async with self._lock:
+                if self._index is None:
+                    self._index = await asyncio.to_thread(self._read_index)
+        return self._index
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.directory, file_name)
+
+    def _read_index(self) -> dict:
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self._path(self.index_file_name)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _read(self, key: str) -> tuple:
+        with open(self._path(f"{key}.mp3"), "rb") as f:
+            mp3 = f.read()
+        with open(self._path(f"{key}.json")) as f:
+            lipsync = json.load(f)
+        return mp3, lipsync
+
+    def _write(self, key: str, mp3: bytes, lipsync: dict):
+        with open(self._path(f"{key}.mp3"), "wb") as f:
+            f.write(mp3)
+        with open(self._path(f"{key}.json"), "w") as f:
+            json.dump(lipsync, f)
+
+    def _evict(self) -> list:
+        total = sum(entry["size"] for entry in self._index.values())
+        evicted = []
+        for key, entry in sorted(self._index.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            total -= entry["size"]
+            evicted.append(key)
+            del self._index[key]
+        return evicted
+
+    def _remove_and_save(self, evicted: list, index: dict):
+        for key in evicted:
+            for file_name in (f"{key}.mp3", f"{key}.json"):
+                try:
+                    os.remove(self._path(file_name))
+                except FileNotFoundError:
+                    pass
+        # Write to a temporary file first so a crash never leaves a truncated index behind
+        temporary_path = self._path(f"{self.index_file_name}.tmp")
+        with open(temporary_path, "w") as f:
+            json.dump(index, f)
+        os.replace(temporary_path, self._path(self.index_file_name))
+
+    def stats(self) -> dict:
+        index = self._index or {}
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(index),
+            "bytes": sum(entry["size"] for entry in index.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,60 +1,460 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_
-from datetime import datetime
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from contextlib import asynccontextmanager
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import or_, and_, exists, func, union_all, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from datetime import datetime, timedelta
 from typing import List
 from ..agents.agent import Agent
 from ..agents.agent_manager import AgentManager
+from .database import get_session
+from ..memory.memory import memory
+from ..pubsub.room_hub import room_hub
+from ..telemetry.tracing import tracer
 from . import models
 
+logger = logging.getLogger(__name__)
 
-def meeting_rooms(db: Session):
-    return db.query(models.MeetingRoom).all()
+async def meeting_rooms(db: AsyncSession):
+    return (await db.exec(select(models.MeetingRoom))).all()
 
-def get_meeting_room_by_id(db: Session, id: int):
-    return db.query(models.MeetingRoom).filter(models.MeetingRoom.id==id).first()
+async def get_meeting_room_by_id(db: AsyncSession, id: int):
+    return (await db.exec(select(models.MeetingRoom).where(models.MeetingRoom.id==id))).first()
 
-def create_meeting_room(db: Session, id: int):
+@tracer.traced("db.create_meeting_room")
+async def create_meeting_room(db: AsyncSession, id: int):
     db_room = models.MeetingRoom(id=id, messages=[])
     db.add(db_room)
-    db.commit()
-    db.refresh(db_room)
+    await db.commit()
     return db_room
 
-def create_message(db: Session, user_name: str, text: str, role: str, to_role: str, meeting_room_id: int):
+async def get_message_by_id(db: AsyncSession, id: int):
+    return (await db.exec(select(models.Message).where(models.Message.id==id))).first()
+
+@tracer.traced("db.create_message")
+async def create_message(db: AsyncSession, user_name: str, text: str, role: str, to_role: str, meeting_room_id: int, claim: "MessageClaim"=None):
+    """
+    Store a message. With `claim`, the message is the reply to the claimed message, which is marked processed
+    in the same transaction. When the claim is no longer held nothing is stored and ClaimLostError is raised,
+    so a message never gets two replies.
+    """
+    if claim is not None:
+        result = await db.execute(update(models.Message)
+                                  .where(models.Message.id == claim.message_id,
+                                         models.Message.claimed_by == claim.token,
+                                         models.Message.processed_at.is_(None))
+                                  .values(processed_at=datetime.now(), lease_expires_at=None))
+        if result.rowcount != 1:
+            await db.rollback()
+            raise ClaimLostError(f"Lost the claim on message {claim.message_id}, its reply is dropped")
     db_message = models.Message(user_name=user_name, text=text, role=role, timestamp=datetime.now(), to_role=to_role, meeting_room_id=meeting_room_id)
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    # Every column is set here and the id comes back with the insert, so there is nothing to refresh
+    await db.commit()
+    room_hub.publish(db_message)
+    memory.add(db_message)
     return db_message
 
-def update_message_to_role(db: Session, message_id: int, to_role: str):
-    db_message = db.query(models.Message).filter(models.Message.id == message_id).first()
-    db_message.to_role = to_role
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
-    return db_message
+async def get_messages_by_ids(db: AsyncSession, ids: List[int]):
+    """
+    The messages with the given ids, in the order of `ids`. Ids without a message are left out.
+    """
+    by_id = {m.id: m for m in (await db.exec(select(models.Message).where(models.Message.id.in_(ids)))).all()} if ids else {}
+    return [by_id[id] for id in ids if id in by_id]
+
+@tracer.traced("db.update_message_to_role")
+async def update_message_to_role(db: AsyncSession, message_id: int, to_role: str):
+    await db.execute(update(models.Message).where(models.Message.id == message_id).values(to_role=to_role))
+    await db.commit()
+
+async def paginated_messages(db: AsyncSession, query, before_id: int=None, after_id: int=None, limit: int=None):
+    """
+    Keyset pagination on message id. With `after_id`, returns the first `limit` messages after it;
+    otherwise the last `limit` messages, before `before_id` if given. Always ordered oldest first.
+    """
+    if after_id is not None:
+        query = query.where(models.Message.id > after_id)
+    if before_id is not None:
+        query = query.where(models.Message.id < before_id)
+    if limit is None or after_id is not None:
+        return (await db.exec(query.order_by(models.Message.id).limit(limit))).all()
+    rows = (await db.exec(query.order_by(models.Message.id.desc()).limit(limit))).all()
+    return rows[::-1]
+
+async def messages(db: AsyncSession, meeting_room_id: int, before_id: int=None, after_id: int=None, limit: int=None):
+    query = select(models.Message).where(models.Message.meeting_room_id==meeting_room_id)
+    return await paginated_messages(db, query, before_id=before_id, after_id=after_id, limit=limit)
+
+async def messages_between_roles(db: AsyncSession, role1: str, role2: str, before_id: int=None, after_id: int=None, limit: int=None, exclude: set=frozenset()):
+    """
+    The messages between two roles in either direction, paginated like `paginated_messages`. Each direction
+    is read separately in id order from the (role, to_role, id) index, at most `limit` messages each, so the
+    database neither combines two index scans with an OR nor sorts the whole conversation.
+    """
+    newest_first = limit is not None and after_id is None
+
+    def direction(role: str, to_role: str):
+        query = select(models.Message.id).where(models.Message.role == role, models.Message.to_role == to_role)
+        if exclude:
+            query = query.where(models.Message.id.not_in(exclude))
+        if after_id is not None:
+            query = query.where(models.Message.id > after_id)
+        if before_id is not None:
+            query = query.where(models.Message.id < before_id)
+        query = query.order_by(models.Message.id.desc() if newest_first else models.Message.id).limit(limit).subquery()
+        return select(query.c.id)
+
+    ids = union_all(direction(role1, role2), direction(role2, role1)).subquery()
+    query = select(models.Message).where(models.Message.id.in_(select(ids.c.id)))
+    return await paginated_messages(db, query, before_id=before_id, after_id=after_id, limit=limit)
+
+async def get_conversation_summary(db: AsyncSession, agent_role: str, peer_role: str):
+    return (await db.exec(select(models.ConversationSummary)
+                          .where(models.ConversationSummary.agent_role==agent_role, models.ConversationSummary.peer_role==peer_role))).first()
+
+@tracer.traced("db.save_conversation_summary")
+async def save_conversation_summary(db: AsyncSession, agent_role: str, peer_role: str, summary: str, last_message_id: int) -> bool:
+    """
+    Store the summary of a conversation up to `last_message_id`, unless another worker stored one covering
+    as much or more of it. Returns whether it was stored.
+    """
+    values = {"summary": summary, "last_message_id": last_message_id, "updated_at": datetime.now()}
+    pair = (models.ConversationSummary.agent_role == agent_role, models.ConversationSummary.peer_role == peer_role)
+    for _ in range(2):
+        result = await db.execute(update(models.ConversationSummary)
+                                  .where(*pair, models.ConversationSummary.last_message_id < last_message_id)
+                                  .values(**values))
+        await db.commit()
+        if result.rowcount == 1:
+            return True
+        if (await db.exec(select(models.ConversationSummary.id).where(*pair))).first() is not None:
+            # A newer summary is stored already
+            return False
+        db.add(models.ConversationSummary(agent_role=agent_role, peer_role=peer_role, **values))
+        try:
+            await db.commit()
+            return True
+        except IntegrityError:
+            # Another worker inserted the first summary meanwhile, compare with theirs
+            await db.rollback()
+    return False
+
+def worker_id() -> str:
+    """
+    Identifies this process in message claims.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+# Seconds a claim on a message lasts. It is renewed while the reply is generated, so it only runs out when
+# the worker holding it died or could not reach the database.
+claim_lease = 60
+
+
+class ClaimLostError(Exception):
+    """
+    A worker's claim on a message ran out or was taken over while it was replying.
+    """
+
+
+class MessageBusyError(Exception):
+    """
+    A message has no reply yet but another worker holds the claim on it, e.g. a stream that is replying.
+    """
+
+
+@tracer.traced("db.claim_message")
+async def claim_message(db: AsyncSession, message_id: int, token: str, lease: float) -> bool:
+    """
+    Claim a message for replying to it. Only succeeds while the message has no reply and is unclaimed or
+    its claim ran out.
+    """
+    now = datetime.now()
+    result = await db.execute(update(models.Message)
+                              .where(models.Message.id == message_id,
+                                     models.Message.processed_at.is_(None),
+                                     or_(models.Message.claimed_by.is_(None), models.Message.lease_expires_at < now))
+                              .values(claimed_by=token, lease_expires_at=now + timedelta(seconds=lease)))
+    await db.commit()
+    return result.rowcount == 1
+
+@tracer.traced("db.renew_message_claim")
+async def renew_message_claim(db: AsyncSession, message_id: int, token: str, lease: float) -> bool:
+    result = await db.execute(update(models.Message)
+                              .where(models.Message.id == message_id, models.Message.claimed_by == token, models.Message.processed_at.is_(None))
+                              .values(lease_expires_at=datetime.now() + timedelta(seconds=lease)))
+    await db.commit()
+    return result.rowcount == 1
+
+@tracer.traced("db.release_message_claim")
+async def release_message_claim(db: AsyncSession, message_id: int, token: str):
+    """
+    Give up a claim on a message that was not replied to, so another worker can try.
+    """
+    await db.execute(update(models.Message)
+                     .where(models.Message.id == message_id, models.Message.claimed_by == token, models.Message.processed_at.is_(None))
+                     .values(claimed_by=None, lease_expires_at=None))
+    await db.commit()
 
-def messages(db: Session, meeting_room_id: int):
-    return db.query(models.Message).filter(models.Message.meeting_room_id==meeting_room_id).order_by(models.Message.timestamp).all()
 
-def messages_between_roles(db: Session, role1: str, role2: str):
-    return db.query(models.Message)\
-             .filter(or_(and_(models.Message.role==role1, models.Message.to_role==role2), and_(models.Message.role==role2, models.Message.to_role==role1)))\
-             .order_by(models.Message.timestamp).all()
+class MessageClaim:
+    """
+    A held claim on a message. The work done under it goes through `guard` or `iterate`, which cancel it
+    with ClaimLostError as soon as the claim cannot be renewed, since another worker may be replying by then.
+    The reply itself is stored with `create_message(..., claim=claim)`, which checks the claim again.
+    """
+    def __init__(self, message_id: int, token: str):
+        self.message_id = message_id
+        self.token = token
+        self.lost = asyncio.Event()
 
-def process_message(db: Session, message_id: int, agents: List[Agent]):
-    message = db.query(models.Message).filter(models.Message.id == message_id).first()
-    if not message:
+    async def guard(self, awaitable):
+        """
+        Await `awaitable`, cancelling it and raising ClaimLostError if the claim is lost first.
+        """
+        work = asyncio.ensure_future(awaitable)
+        lost = asyncio.ensure_future(self.lost.wait())
+        try:
+            await asyncio.wait({work, lost}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            lost.cancel()
+            if not work.done():
+                work.cancel()
+                await asyncio.gather(work, return_exceptions=True)
+        if work.cancelled() and self.lost.is_set():
+            raise ClaimLostError(f"Lost the claim on message {self.message_id}")
+        return work.result()
+
+    async def iterate(self, items):
+        """
+        Iterate the async iterator `items`, each step guarded like `guard`.
+        """
+        iterator = items.__aiter__()
+
+        async def next_item():
+            try:
+                return True, await iterator.__anext__()
+            except StopAsyncIteration:
+                return False, None
+
+        try:
+            while True:
+                more, item = await self.guard(next_item())
+                if not more:
+                    return
+                yield item
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    async def renew(self):
+        """
+        Renew the claim every third of the lease until cancelled. Sets `lost` when another worker took the
+        message over, or when renewing kept failing for two thirds of the lease.
+        """
+        loop = asyncio.get_running_loop()
+        renewed_at = loop.time()
+        while True:
+            await asyncio.sleep(claim_lease / 3)
+            try:
+                async with get_session() as db:
+                    held = await renew_message_claim(db, self.message_id, self.token, claim_lease)
+            except Exception as e:
+                if loop.time() - renewed_at < claim_lease * 2 / 3:
+                    logger.warning("Could not renew the claim on message %d: %r", self.message_id, e)
+                    continue
+                logger.error("Giving up the claim on message %d, it could not be renewed for %.0f seconds", self.message_id, loop.time() - renewed_at, exc_info=e)
+                held = False
+            if not held:
+                logger.warning("Lost the claim on message %d", self.message_id)
+                self.lost.set()
+                return
+            renewed_at = loop.time()
+
+@asynccontextmanager
+async def message_claim(message_id: int):
+    """
+    Claim a message for the duration of the block, which gets the MessageClaim, or None when the message is
+    replied to or claimed by another worker. The claim is renewed meanwhile. If the block ends without
+    storing a reply, the message is released for another try.
+    """
+    claim = MessageClaim(message_id, f"{worker_id()}:{uuid.uuid4().hex}")
+    async with get_session() as db:
+        claimed = await claim_message(db, message_id, claim.token, claim_lease)
+    if not claimed:
+        yield None
         return
 
+    renewal = asyncio.create_task(claim.renew())
+    try:
+        yield claim
+    finally:
+        renewal.cancel()
+        await asyncio.gather(renewal, return_exceptions=True)
+        async with get_session() as db:
+            await release_message_claim(db, message_id, claim.token)
+
+async def process_message(message_id: int, agents: List[Agent]):
+    """
+    Route a CEO message to an agent and post the agent's reply. Runs as a background job with its own
+    sessions, since the session of the request that created the message is closed by the time this runs.
+    Messages that are replied to are skipped, MessageBusyError is raised for messages claimed by another
+    worker so the job can check again once that claim ran out.
+
+    Sessions are only opened around each database access, never across the LLM and tool calls, so a reply
+    in flight does not hold a pooled connection for seconds.
+    """
+    async with get_session() as db:
+        message = await get_message_by_id(db, message_id)
     # Do not reply unless the message is from the CEO to avoid agents talking to each other in a loop
-    if message.role != "CEO":
+    if not message or message.role != "CEO":
+        return
+
+    async with message_claim(message_id) as claim:
+        if claim is None:
+            async with get_session() as db:
+                message = await get_message_by_id(db, message_id)
+            if message.processed_at is None:
+                raise MessageBusyError(f"Message {message_id} is claimed by {message.claimed_by}")
+            return
+        responding_agent = await claim.guard(AgentManager.analyze_message_for_agent(message.text, agents))
+        async with get_session() as db:
+            await update_message_to_role(db, message_id, responding_agent.role)
+        agent_response = await claim.guard(responding_agent.respond(message))
+        async with get_session() as db:
+            await responding_agent.post_message(db, agent_response, to_role=message.role, meeting_room_id=message.meeting_room_id, claim=claim)
+
+async def stream_message(message_id: int, agents: List[Agent]):
+    """
+    Streaming counterpart of `process_message`. Yields ("agent", agent), then ("token", text) for each
+    piece of the reply as it is generated, and finally ("reply", message) once the full reply is stored.
+    """
+    async with get_session() as db:
+        message = await get_message_by_id(db, message_id)
+    if not message or message.role != "CEO":
         return
 
-    responding_agent = AgentManager.analyze_message_for_agent(message.text, agents)
+    async with message_claim(message_id) as claim:
+        if claim is None:
+            return
+        responding_agent = await claim.guard(AgentManager.analyze_message_for_agent(message.text, agents))
+        async with get_session() as db:
+            await update_message_to_role(db, message_id, responding_agent.role)
+        yield "agent", responding_agent
+
+        reply = []
+        async for token in claim.iterate(responding_agent.respond_stream(message)):
+            reply.append(token)
+            yield "token", token
+        async with get_session() as db:
+            agent_message = await responding_agent.post_message(db, "".join(reply), to_role=message.role, meeting_room_id=message.meeting_room_id, claim=claim)
+        yield "reply", agent_message
+
+@tracer.traced("db.create_message_with_job")
+async def create_message_with_job(db: AsyncSession, user_name: str, text: str, role: str, to_role: str, meeting_room_id: int, delay: float=0):
+    """
+    Store a message and the job replying to it, runnable after `delay` seconds, in one transaction, so a
+    stored message always has a job.
+    """
+    now = datetime.now()
+    db_message = models.Message(user_name=user_name, text=text, role=role, timestamp=now, to_role=to_role, meeting_room_id=meeting_room_id)
+    db.add(db_message)
+    await db.flush()
+    db_job = models.Job(message_id=db_message.id, meeting_room_id=meeting_room_id, status="pending", available_at=now + timedelta(seconds=delay), created_at=now, updated_at=now)
+    db.add(db_job)
+    await db.commit()
+    room_hub.publish(db_message)
+    memory.add(db_message)
+    return db_message, db_job
+
+async def jobs(db: AsyncSession, status: str=None, limit: int=100):
+    query = select(models.Job)
+    if status is not None:
+        query = query.where(models.Job.status==status)
+    return (await db.exec(query.order_by(models.Job.id.desc()).limit(limit))).all()
+
+async def job_counts(db: AsyncSession):
+    rows = (await db.exec(select(models.Job.status, func.count(models.Job.id)).group_by(models.Job.status))).all()
+    return {status: count for status, count in rows}
+
+async def claim_next_job(db: AsyncSession):
+    """
+    Claim the oldest runnable job. A job is only runnable when no other job in the same meeting room is
+    running or queued ahead of it, which keeps replies within a room in order.
+    """
+    now = datetime.now()
+    other = aliased(models.Job)
+    blocked = exists().where(
+        other.meeting_room_id == models.Job.meeting_room_id,
+        other.id != models.Job.id,
+        or_(other.status == "running", and_(other.status == "pending", other.id < models.Job.id)),
+    )
+    candidates = (await db.exec(select(models.Job.id)
+                                .where(models.Job.status == "pending", models.Job.available_at <= now, ~blocked)
+                                .order_by(models.Job.id)
+                                .limit(10))).all()
+    for job_id in candidates:
+        # Only one claimer can move the job out of "pending", and not again once it was deferred back to it
+        result = await db.execute(update(models.Job)
+                                  .where(models.Job.id == job_id, models.Job.status == "pending", models.Job.available_at <= now)
+                                  .values(status="running", attempts=models.Job.attempts + 1, updated_at=now))
+        await db.commit()
+        if result.rowcount == 1:
+            return await db.get(models.Job, job_id, populate_existing=True)
+    return None
+
+@tracer.traced("db.complete_job")
+async def complete_job(db: AsyncSession, job_id: int):
+    await db.execute(update(models.Job).where(models.Job.id == job_id).values(status="done", last_error=None, updated_at=datetime.now()))
+    await db.commit()
+
+@tracer.traced("db.fail_job")
+async def fail_job(db: AsyncSession, job: models.Job, error: str, max_attempts: int, retry_delay: float):
+    now = datetime.now()
+    if job.attempts >= max_attempts:
+        values = {"status": "failed"}
+    else:
+        # Exponential backoff: retry_delay, 2 * retry_delay, 4 * retry_delay, ...
+        values = {"status": "pending", "available_at": now + timedelta(seconds=retry_delay * 2 ** (job.attempts - 1))}
+    await db.execute(update(models.Job).where(models.Job.id == job.id).values(last_error=error, updated_at=now, **values))
+    await db.commit()
+
+@tracer.traced("db.release_job")
+async def release_job(db: AsyncSession, job_id: int, done: bool):
+    """
+    Settle a job that was held back while a stream replied to its message: complete it, or make it runnable
+    now. Jobs a worker already picked up are left to that worker.
+    """
+    values = {"status": "done"} if done else {"available_at": datetime.now()}
+    await db.execute(update(models.Job).where(models.Job.id == job_id, models.Job.status == "pending").values(updated_at=datetime.now(), **values))
+    await db.commit()
+
+@tracer.traced("db.defer_job")
+async def defer_job(db: AsyncSession, job_id: int, delay: float):
+    """
+    Put a running job back in the queue for `delay` seconds without counting the attempt.
+    """
+    now = datetime.now()
+    await db.execute(update(models.Job)
+                     .where(models.Job.id == job_id, models.Job.status == "running")
+                     .values(status="pending", attempts=models.Job.attempts - 1, available_at=now + timedelta(seconds=delay), updated_at=now))
+    await db.commit()
 
-    if responding_agent is not None:
-        update_message_to_role(db, message_id, responding_agent.role)
-        agent_response = responding_agent.respond(message)
-        responding_agent.post_message(agent_response, to_role=message.role, meeting_room_id=message.meeting_room_id)
+async def requeue_running_jobs(db: AsyncSession, min_age: float=0):
+    """
+    Put jobs whose worker went down back in the queue. Jobs whose message is claimed by a live worker, in
+    any process, are left running, and so are jobs that started less than `min_age` seconds ago, whose
+    worker may be about to claim the message or complete the job.
+    """
+    now = datetime.now()
+    claimed = exists().where(models.Message.id == models.Job.message_id, models.Message.lease_expires_at > now)
+    result = await db.execute(update(models.Job)
+                              .where(models.Job.status == "running", models.Job.updated_at <= now - timedelta(seconds=min_age), ~claimed)
+                              .values(status="pending", updated_at=now))
+    await db.commit()
+    return result.rowcount
@@ -0,0 +1,60 @@
+import time
+from sqlalchemy import or_
+from .models import Message
+
+
+class MessageCursor:
+    """
+    Position of a reader following new messages in id order, which also catches messages committed late.
+
+    Ids are handed out when a message is inserted but the message only becomes visible when its transaction
+    commits, and with several writers, as on Postgres, that is not always in id order: a reader that saw
+    id 12 would never read an 11 committed after it. The cursor therefore remembers the ids it skipped, up
+    to `max_gap` below each id read, and reads them again every time until they show up or `gap_timeout`
+    seconds have passed, as they do for rolled back inserts.
+    """
+    def __init__(self, position: int=0, gap_timeout: float=60, max_gap: int=1000):
+        self.position = position
+        self.gap_timeout = gap_timeout
+        self.max_gap = max_gap
+        self._gaps = {}  # skipped id -> time it was skipped
+
+    @property
+    def gaps(self) -> list:
+        self._expire()
+        return sorted(self._gaps)
+
+    @property
+    def resume_position(self) -> int:
+        """
+        Position for readers that can only read the messages after an id: below the oldest skipped id, so
+        reading from it may repeat messages but misses none.
+        """
+        gaps = self.gaps
+        return gaps[0] - 1 if gaps else self.position
+
+    def condition(self):
+        """
+        Where clause for the messages a read should return: those after the position and the skipped ones.
+        """
+        self._expire()
+        if self._gaps:
+            return or_(Message.id > self.position, Message.id.in_(self.gaps))
+        return Message.id > self.position
+
+    def advance(self, ids: list):
+        """
+        Record the ids of the messages a read returned, in ascending order.
+        """
+        now = time.monotonic()
+        for id in ids:
+            if id > self.position:
+                for skipped in range(max(self.position + 1, id - self.max_gap), id):
+                    self._gaps[skipped] = now
+                self.position = id
+            else:
+                self._gaps.pop(id, None)
+
+    def _expire(self):
+        expired = time.monotonic() - self.gap_timeout
+        self._gaps = {id: skipped_at for id, skipped_at in self._gaps.items() if skipped_at > expired}
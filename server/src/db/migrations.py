@@ -0,0 +1,47 @@
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+from sqlmodel import SQLModel
+
+logger = logging.getLogger(__name__)
+
+def add_missing_columns(conn: Connection):
+    """
+    `create_all` does not alter existing tables either. Columns added to a model later must be nullable or
+    have a server default, so existing rows are valid.
+    """
+    existing_tables = set(inspect(conn).get_table_names())
+    preparer = conn.dialect.identifier_preparer
+    for table in SQLModel.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column["name"] for column in inspect(conn).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                logger.info("Adding column %s to %s", column.name, table.name)
+                conn.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=conn.dialect)}"))
+
+def add_missing_indexes(conn: Connection):
+    """
+    `create_all` skips tables that already exist, indexes included, so indexes added to a model
+    later have to be created separately on existing databases.
+    """
+    existing_tables = set(inspect(conn).get_table_names())
+    for table in SQLModel.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_indexes = {index["name"] for index in inspect(conn).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                logger.info("Creating index %s on %s", index.name, table.name)
+                index.create(conn)
+
+# Run in order on every startup, each step must be safe to run again
+MIGRATIONS = [
+    add_missing_columns,
+    add_missing_indexes,
+]
+
+def migrate(conn: Connection):
+    for migration in MIGRATIONS:
+        migration(conn)
@@ -1,4 +1,5 @@
 from datetime import datetime
+from sqlalchemy import Index
 from sqlmodel import Field, SQLModel, Relationship
 from typing import Optional
 
@@ -7,6 +8,13 @@ class MeetingRoom(SQLModel, table=True):
     messages: list["Message"] = Relationship(back_populates="meeting_room")
 
 class Message(SQLModel, table=True):
+    # Messages are paged by id, which follows insertion order, so every access path ends with it
+    __table_args__ = (
+        Index("ix_message_meeting_room_id_id", "meeting_room_id", "id"),
+        Index("ix_message_role_to_role_id", "role", "to_role", "id"),
+        Index("ix_message_timestamp", "timestamp"),
+    )
+
     id: int = Field(default=None, primary_key=True)
     user_name: str
     text: str
@@ -15,3 +23,35 @@ class Message(SQLModel, table=True):
     timestamp: datetime = Field(default=None)
     meeting_room_id: int = Field(default=None, foreign_key="meetingroom.id")
     meeting_room: MeetingRoom = Relationship(back_populates="messages")
+    # Claim of the worker replying to the message, so only one worker process replies to it
+    claimed_by: Optional[str] = Field(default=None)
+    lease_expires_at: Optional[datetime] = Field(default=None)
+    processed_at: Optional[datetime] = Field(default=None)
+
+class Job(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_job_status_available_at", "status", "available_at"),
+        Index("ix_job_meeting_room_id_status", "meeting_room_id", "status"),
+    )
+
+    id: int = Field(default=None, primary_key=True)
+    message_id: int = Field(foreign_key="message.id")
+    meeting_room_id: int = Field(default=None, foreign_key="meetingroom.id")
+    status: str = Field(default="pending")  # pending, running, done, failed
+    attempts: int = Field(default=0)
+    last_error: Optional[str] = Field(default=None)
+    available_at: datetime = Field(default=None)
+    created_at: datetime = Field(default=None)
+    updated_at: datetime = Field(default=None)
+
+class ConversationSummary(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_conversationsummary_agent_role_peer_role", "agent_role", "peer_role", unique=True),
+    )
+
+    id: int = Field(default=None, primary_key=True)
+    agent_role: str
+    peer_role: str
+    summary: str
+    last_message_id: int = Field(default=0)
+    updated_at: datetime = Field(default=None)
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+from sqlalchemy import exc
+from ..db import crud
+from ..db.database import get_session
+from ..db.models import Job
+from ..llm import openai_client
+from ..telemetry.tracing import tracer
+from ..tools.microsoft import account
+
+logger = logging.getLogger(__name__)
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Whether a failed job is worth retrying: the LLM, Microsoft Graph or the database timed out, could not be
+    reached or was overloaded, or the worker lost its claim on the message. Anything else, like a bug, fails
+    the same way on every attempt.
+    """
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError, exc.OperationalError, exc.TimeoutError, crud.ClaimLostError)):
+        return True
+    return openai_client.is_transient_error(error) or account.is_transient_error(error)
+
+
+class JobQueue:
+    """
+    Durable queue of message processing jobs, backed by the job table.
+
+    A fixed pool of workers pulls jobs from the table, so at most `workers` replies are generated at once
+    no matter how many messages come in. Jobs in the same meeting room run one at a time in the order they
+    were queued. Jobs failing for a reason `retry_on` deems transient are retried with exponential backoff
+    until `max_attempts` is reached, other failures are final. Jobs that were running when the process
+    stopped are picked up again on the next start, and every `reap_interval` seconds the jobs of workers in
+    processes that died meanwhile are queued again once their claim on the message ran out, so they do not
+    block their meeting room until a restart. A job whose message is claimed by another worker waits for
+    that claim to run out, without using up an attempt.
+    """
+    def __init__(self, handler: Callable[[int], Awaitable[None]], workers: int=4, max_attempts: int=3, retry_delay: float=2.0, poll_interval: float=1.0,
+                 reap_interval: float=30, retry_on: Callable[[BaseException], bool]=is_transient):
+        self.handler = handler
+        self.retry_on = retry_on
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.reap_interval = reap_interval
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    async def start(self):
+        async with get_session() as db:
+            await crud.requeue_running_jobs(db)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        if self.reap_interval:
+            self._tasks.append(asyncio.create_task(self._reap()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self, job: Job, delay: float=0):
+        """
+        Wake a worker for a job just queued with crud.create_message_with_job, unless it only runs after a
+        `delay`. A stream replying to the message itself queues its job with a delay and releases it when
+        done, so the reply is still generated by a worker if the stream never finishes.
+        """
+        if not delay:
+            self._wakeup.set()
+
+    async def release(self, job: Job, replied: bool):
+        """
+        Complete a job queued with a delay once its message was replied to, or run it right away.
+        """
+        async with get_session() as db:
+            await crud.release_job(db, job.id, done=replied)
+        if not replied:
+            self._wakeup.set()
+
+    async def _work(self):
+        while True:
+            async with get_session() as db:
+                job = await crud.claim_next_job(db)
+            if job is None:
+                await self._wait()
+                continue
+
+            try:
+                with tracer.span("job", job_id=job.id, message_id=job.message_id, attempt=job.attempts):
+                    await self.handler(job.message_id)
+            except crud.MessageBusyError as e:
+                logger.info("Job %d waits for the claim on message %d to run out: %s", job.id, job.message_id, e)
+                async with get_session() as db:
+                    await crud.defer_job(db, job.id, crud.claim_lease)
+            except Exception as e:
+                if self.retry_on(e):
+                    logger.warning("Job %d for message %d failed on attempt %d: %r", job.id, job.message_id, job.attempts, e)
+                    max_attempts = self.max_attempts
+                else:
+                    logger.error("Job %d for message %d failed and is not retried", job.id, job.message_id, exc_info=e)
+                    max_attempts = job.attempts
+                async with get_session() as db:
+                    await crud.fail_job(db, job, repr(e), max_attempts, self.retry_delay)
+            else:
+                async with get_session() as db:
+                    await crud.complete_job(db, job.id)
+            # A finished job may unblock the next one in its meeting room
+            self._wakeup.set()
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                async with get_session() as db:
+                    # A job is claimed before its message is, give the worker a lease to do so
+                    requeued = await crud.requeue_running_jobs(db, min_age=crud.claim_lease)
+            except Exception as e:
+                logger.warning("Requeuing stale jobs failed: %r", e)
+                continue
+            if requeued:
+                logger.warning("Requeued %d jobs whose worker stopped", requeued)
+                self._wakeup.set()
+
+    async def _wait(self):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
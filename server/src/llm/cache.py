@@ -0,0 +1,126 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+def to_dict(message) -> dict:
+    return message.model_dump(exclude_none=True) if hasattr(message, "model_dump") else message
+
+def cache_key(model: str, messages: list, tools: Optional[list], temperature: float) -> str:
+    """
+    Canonical hash of everything that determines a completion.
+    """
+    payload = {"model": model, "messages": [to_dict(m) for m in messages], "tools": tools, "temperature": temperature}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    def __init__(self, ttl: float=3600, max_size: int=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (expires at, value)
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    async def set(self, key: str, value: dict):
+        self._entries[key] = (time.time() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class SQLiteCacheBackend:
+    """
+    Cache kept in a SQLite file, so it survives restarts and is shared by worker processes on one host.
+    """
+    def __init__(self, path: str="./llm_cache.db", ttl: float=86400):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._conn.commit()
+
+    def _get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM llm_cache WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set(self, key: str, value: dict):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)", (key, json.dumps(value), time.time() + self.ttl))
+            self._conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),))
+            self._conn.commit()
+
+    async def get(self, key: str):
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: dict):
+        await asyncio.to_thread(self._set, key, value)
+
+
+class LLMCache:
+    """
+    Completion cache with single-flight: identical requests that arrive while the first one is still
+    running share its result instead of each calling the API. Set `backend` to None to disable caching.
+    """
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.saved_tokens = 0
+
+    async def get_or_create(self, key: str, create: Callable[[], Awaitable[dict]]) -> dict:
+        """
+        `create` returns the completion as a dict with the message under "message" and the tokens it cost under "total_tokens".
+        """
+        if self.backend is None:
+            return await create()
+
+        value = await self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            self.saved_tokens += value.get("total_tokens", 0)
+            return value
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            value = await asyncio.shield(task)
+            self.saved_tokens += value.get("total_tokens", 0)
+            return value
+
+        self.misses += 1
+        task = self._in_flight[key] = asyncio.ensure_future(self._create_and_store(key, create))
+        task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _create_and_store(self, key: str, create: Callable[[], Awaitable[dict]]) -> dict:
+        value = await create()
+        await self.backend.set(key, value)
+        return value
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "backend": type(self.backend).__name__ if self.backend else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "saved_tokens": self.saved_tokens,
+        }
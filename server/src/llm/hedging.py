@@ -0,0 +1,107 @@
+import asyncio
+import threading
+from collections import Counter, deque
+from typing import Awaitable, Callable, Optional
+from ..telemetry.metrics import Histogram
+
+
+class LLMTimeoutError(TimeoutError):
+    """
+    An LLM call that did not answer within its deadline.
+    """
+
+
+class LatencyTracker:
+    """
+    Recent latencies of each model, for its tail percentiles and the delay after which a request is hedged.
+
+    Only the last `window` calls of a model count, so the percentiles follow the API as it speeds up or
+    slows down. Every latency also feeds `histogram`, labelled by model.
+    """
+    def __init__(self, histogram: Histogram, window: int=500):
+        self.histogram = histogram
+        self.window = window
+        self._samples = {}  # model -> deque of seconds
+        self._counts = {}  # model -> Counter of requests, hedged, hedge_wins, timeouts and errors
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(model, deque(maxlen=self.window)).append(seconds)
+        self.histogram.observe(seconds, model=model)
+
+    def count(self, model: str, event: str):
+        with self._lock:
+            self._counts.setdefault(model, Counter())[event] += 1
+
+    def percentile(self, model: str, percentile: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def hedge_delay(self, model: str, percentile: float=95, min_samples: int=20, min_delay: float=1.0) -> Optional[float]:
+        """
+        Seconds after which a second request is sent: the model's `percentile` latency, but no less than
+        `min_delay`. None, so no hedging, until `min_samples` calls give a percentile worth trusting.
+        """
+        with self._lock:
+            samples = len(self._samples.get(model, ()))
+        if samples < min_samples:
+            return None
+        return max(min_delay, self.percentile(model, percentile))
+
+    def stats(self) -> dict:
+        with self._lock:
+            models = set(self._samples) | set(self._counts)
+            counts = {model: dict(self._counts.get(model, {})) for model in models}
+        return {model: {
+            "requests": counts[model].get("requests", 0),
+            "hedged": counts[model].get("hedged", 0),
+            "hedge_wins": counts[model].get("hedge_wins", 0),
+            "timeouts": counts[model].get("timeouts", 0),
+            "errors": counts[model].get("errors", 0),
+            "p50_seconds": self.percentile(model, 50),
+            "p95_seconds": self.percentile(model, 95),
+            "p99_seconds": self.percentile(model, 99),
+        } for model in models}
+
+
+async def hedged(attempt: Callable[[], Awaitable], deadline: float, hedge_after: Optional[float]=None,
+                 discard: Callable[[object], Awaitable]=None) -> tuple:
+    """
+    Await `attempt()` and, if it has not finished after `hedge_after` seconds, a second `attempt()` next to
+    it. Returns the result of whichever succeeds first, whether the second attempt was sent and whether it
+    won. The other attempt is cancelled, or passed to `discard` if it finished too, e.g. to close a stream.
+    An attempt that fails before the hedge is sent is not retried, its error is raised. Raises
+    LLMTimeoutError when no attempt succeeded within `deadline` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    give_up_at = started + deadline
+    tasks = [asyncio.ensure_future(attempt())]
+    winner = None
+    try:
+        while True:
+            running = [task for task in tasks if not task.done()]
+            if not running:
+                # Every attempt failed
+                raise tasks[-1].exception()
+            hedge_at = started + hedge_after if hedge_after is not None and len(tasks) == 1 else None
+            wait_until = min(give_up_at, hedge_at) if hedge_at is not None else give_up_at
+            done, _ = await asyncio.wait(running, timeout=max(0, wait_until - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    return task.result(), len(tasks) > 1, task is not tasks[0]
+            if loop.time() >= give_up_at:
+                raise LLMTimeoutError(f"No response within {deadline:g} seconds")
+            if hedge_at is not None and loop.time() >= hedge_at and not tasks[0].done():
+                tasks.append(asyncio.ensure_future(attempt()))
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif task is not winner and discard is not None and not task.cancelled() and task.exception() is None:
+                await discard(task.result())
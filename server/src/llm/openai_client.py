@@ -1,35 +1,258 @@
-from openai import AzureOpenAI
-from typing import Type
-from ..tools.tool import BaseTool
+from ..tools.tool import ToolRegistry
+from ..telemetry.metrics import metrics
+from ..telemetry.tracing import tracer, log_payload
+from .cache import LLMCache, MemoryCacheBackend, cache_key, to_dict
+from .hedging import LatencyTracker, LLMTimeoutError, hedged
+import asyncio
+import logging
 import os
+import threading
+import time
 
-OPENAI_AUTH = str(os.environ["AZURE_OPENAI_KEY"])
-client = AzureOpenAI(
-    api_key=OPENAI_AUTH,
-    api_version="2023-07-01-preview",
-    azure_endpoint="https://genai-engx.openai.azure.com",
-)
+logger = logging.getLogger(__name__)
 
-def respond_to_prompt(prompt: str):
-    llm_completion = client.chat.completions.create(
-        model="gpt-35-turbo-16k",
+prompt_tokens = metrics.counter("llm_prompt_tokens_total", "Prompt tokens sent to the LLM.", labels=("model",))
+completion_tokens = metrics.counter("llm_completion_tokens_total", "Completion tokens generated by the LLM.", labels=("model",))
+completion_latency = LatencyTracker(metrics.histogram("llm_completion_seconds", "Time until a completion is received, hedging included.", labels=("model",)))
+first_token_latency = LatencyTracker(metrics.histogram("llm_first_token_seconds", "Time until the first token of a streamed completion.", labels=("model",)))
+
+# Deployment answering each kind of call: routing and summaries are short prompts a small, fast model
+# handles, chat turns and turns that may call tools get the larger one. Set from [llm] in config.cfg.
+models = {
+    "routing": "gpt-35-turbo-16k",
+    "summary": "gpt-35-turbo-16k",
+    "chat": "gpt-35-turbo-16k",
+    "tools": "gpt-35-turbo-16k",
+}
+# Seconds each kind of call may take, hedged request included, before LLMTimeoutError. For a streamed
+# completion the deadline covers the first token, the rest is already on its way to the user.
+deadlines = {
+    "routing": 10.0,
+    "summary": 30.0,
+    "chat": 30.0,
+    "tools": 30.0,
+}
+# A call that has not answered after the model's hedge_percentile latency, and at least hedge_min_delay
+# seconds, is sent a second time and the first answer wins. 0 disables hedging.
+hedge_percentile = 95
+hedge_min_delay = 1.0
+
+# HTTP connection pool and retries of the client, read when it is created
+max_connections = 100
+max_keepalive_connections = 20
+keepalive_expiry = 30.0
+connect_timeout = 5.0
+read_timeout = 30.0
+max_retries = 1
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    The Azure OpenAI client, created on first use rather than at import, since importing openai takes most
+    of a second and the key is only needed once the LLM is called.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import httpx
+                from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+                _client = AsyncAzureOpenAI(
+                    api_key=os.environ["AZURE_OPENAI_KEY"],
+                    api_version="2023-07-01-preview",
+                    azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT", "https://genai-engx.openai.azure.com"),
+                    # Retries stay within the deadline of the call, which cancels them once it has passed
+                    max_retries=max_retries,
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                    http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(
+                        max_connections=max_connections,
+                        max_keepalive_connections=max_keepalive_connections,
+                        keepalive_expiry=keepalive_expiry,
+                    )),
+                )
+    return _client
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Whether an LLM call failed in a way a later retry may not: a timeout, a connection error, rate limiting or a server error.
+    """
+    if isinstance(error, LLMTimeoutError):
+        return True
+    import openai
+    return isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError))
+
+async def warm_up():
+    """
+    Import openai and create the client in a worker thread, so the first LLM call does not wait for it.
+    """
+    def load():
+        get_client()
+        import openai.types.chat
+    await asyncio.to_thread(load)
+
+async def _request(call_type: str, model: str, attempt, tracker: LatencyTracker, discard=None):
+    """
+    Run an API request under the deadline of its call type, hedged once the model's latency is known.
+    """
+    hedge_after = tracker.hedge_delay(model, hedge_percentile, min_delay=hedge_min_delay) if hedge_percentile else None
+    tracker.count(model, "requests")
+    started = time.perf_counter()
+    try:
+        result, hedge_sent, hedge_won = await hedged(attempt, deadlines[call_type], hedge_after, discard)
+    except LLMTimeoutError:
+        tracker.count(model, "timeouts")
+        # The latency is at least the deadline, leaving it out would hide the tail
+        tracker.observe(model, time.perf_counter() - started)
+        logger.warning("%s call to %s timed out after %gs", call_type, model, deadlines[call_type])
+        raise
+    except Exception:
+        tracker.count(model, "errors")
+        raise
+    elapsed = time.perf_counter() - started
+    tracker.observe(model, elapsed)
+    if hedge_sent:
+        tracker.count(model, "hedged")
+    if hedge_won:
+        tracker.count(model, "hedge_wins")
+    span = tracer.current()
+    if span is not None:
+        span.set(call_type=call_type, hedged=hedge_sent, hedge_won=hedge_won)
+    return result
+
+# Only deterministic (temperature 0) completions are cached
+response_cache = LLMCache(MemoryCacheBackend())
+
+async def create_completion(call_type: str, messages: list, tools: list=None, temperature: float=0):
+    """
+    Chat completion from the model of `call_type`, through the response cache. Returns the assistant message as a dict.
+    """
+    model = models[call_type]
+
+    async def attempt():
+        return await get_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            tools=tools,
+            temperature=temperature,
+        )
+
+    async def create():
+        with tracer.span("llm.completion", model=model) as span:
+            llm_completion = await _request(call_type, model, attempt, completion_latency)
+            usage = llm_completion.usage
+            if usage:
+                span.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+                prompt_tokens.inc(usage.prompt_tokens, model=model)
+                completion_tokens.inc(usage.completion_tokens, model=model)
+        return {"message": to_dict(llm_completion.choices[0].message), "total_tokens": usage.total_tokens if usage else 0}
+
+    if temperature != 0:
+        return (await create())["message"]
+    return (await response_cache.get_or_create(cache_key(model, messages, tools, temperature), create))["message"]
+
+async def respond_to_prompt(prompt: str, call_type: str="chat"):
+    """
+    Complete a single prompt, e.g. with call_type "routing" or "summary" for the small model.
+    """
+    llm_response = (await create_completion(
+        call_type,
         messages=[{"role": "user", "content": prompt}],
-    )
-    llm_response = llm_completion.choices[0].message.content
-    print(f"LLM Prompt: {prompt}\nLLM Completion: {llm_response}")
+    )).get("content")
+    log_payload(logger, "LLM Prompt: %s\nLLM Completion: %s", prompt, llm_response)
     return llm_response
 
-def respond_to_messages(messages, tools: list[Type[BaseTool]]=None):
-    if tools is not None:
-        tools = [tool.openai_schema for tool in tools]
+async def respond_to_messages(messages, tools: ToolRegistry=None, stream: bool=False):
+    """
+    Get the next assistant message for a conversation and append it to `messages`.
+
+    With `stream=True` this returns an async iterator of content deltas instead, and the assembled message
+    (including any tool calls) is appended to `messages` once the stream is exhausted. Turns that offer
+    tools go to the "tools" model, the others to the "chat" model.
+    """
+    from openai.types.chat import ChatCompletionMessage
+    tools = tools.schemas() if tools else None
+    call_type = "tools" if tools else "chat"
+    if stream:
+        return _stream_messages(call_type, messages, tools)
 
-    llm_completion = client.chat.completions.create(
-        model="gpt-35-turbo-16k",
+    llm_response = ChatCompletionMessage.model_validate(await create_completion(
+        call_type,
         messages=messages,
         tools=tools,
         temperature=0,
-    )
-    llm_response = llm_completion.choices[0].message
-    print(f"LLM Messages: {messages}\nLLM Completion: {llm_response}")
+    ))
+    log_payload(logger, "LLM Messages: %s\nLLM Completion: %s", messages, llm_response)
     messages.append(llm_response)
     return llm_response
+
+async def _open_stream(model: str, messages, tools) -> tuple:
+    """
+    Start a streamed completion and wait for its first token. Returns the stream, its chunk iterator and the chunks read so far.
+    """
+    llm_stream = await get_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        tools=tools,
+        temperature=0,
+        stream=True,
+    )
+    try:
+        chunks = llm_stream.__aiter__()
+        first_chunks = []
+        async for chunk in chunks:
+            first_chunks.append(chunk)
+            # Skip past Azure's content filter chunk to the first one with a token
+            if chunk.choices:
+                break
+        return llm_stream, chunks, first_chunks
+    except BaseException:
+        # Also when cancelled because the hedged request answered first
+        await llm_stream.close()
+        raise
+
+async def _close_stream(opened: tuple):
+    await opened[0].close()
+
+async def _chain(first_chunks: list, chunks):
+    for chunk in first_chunks:
+        yield chunk
+    async for chunk in chunks:
+        yield chunk
+
+async def _stream_messages(call_type: str, messages, tools):
+    model = models[call_type]
+    with tracer.span("llm.stream", model=model) as span:
+        _, rest, first_chunks = await _request(call_type, model, lambda: _open_stream(model, messages, tools), first_token_latency, _close_stream)
+        content = []
+        tool_calls = {}
+        chunks = 0
+        async for chunk in _chain(first_chunks, rest):
+            # Azure sends a leading chunk with only content filter results and no choices
+            if not chunk.choices:
+                continue
+            chunks += 1
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content.append(delta.content)
+                yield delta.content
+            for tool_call_delta in delta.tool_calls or []:
+                tool_call = tool_calls.setdefault(tool_call_delta.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+                if tool_call_delta.id:
+                    tool_call["id"] = tool_call_delta.id
+                if tool_call_delta.function is not None:
+                    tool_call["function"]["name"] += tool_call_delta.function.name or ""
+                    tool_call["function"]["arguments"] += tool_call_delta.function.arguments or ""
+        # Streamed responses carry no usage, but each chunk holds one token
+        span.set(completion_tokens=chunks)
+        completion_tokens.inc(chunks, model=model)
+
+    from openai.types.chat import ChatCompletionMessage
+    llm_response = ChatCompletionMessage.model_validate({
+        "role": "assistant",
+        "content": "".join(content) if content else None,
+        "tool_calls": [tool_calls[index] for index in sorted(tool_calls)] or None,
+    })
+    log_payload(logger, "LLM Messages: %s\nLLM Completion: %s", messages, llm_response)
+    messages.append(llm_response)
@@ -1,101 +1,484 @@
 import asyncio
+import base64
 import configparser
+import json
+import logging
 import os
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from sqlmodel import Session, SQLModel, create_engine
-from O365 import Account
-import readline
+import time
+from collections import deque
+from fastapi import FastAPI, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy.exc import IntegrityError
 
 # Config Initialization
 config = configparser.ConfigParser()
 config.read(["../config.cfg"])
 os.environ["OPENAI_API_KEY"] = config["openai"]["apiKey"]
 os.environ["AZURE_OPENAI_KEY"] = config["azure-openai"]["apiKey"]
+os.environ["AZURE_OPENAI_ENDPOINT"] = config.get("azure-openai", "endpoint", fallback="https://genai-engx.openai.azure.com")
 os.environ["MS_CLIENT_ID"] = config["azure"]["clientId"]
 os.environ["MS_CLIENT_SECRET"] = config["azure"]["clientSecret"]
 
 # from .audio import audio
+from .audio.stt import AudioDecodeError, SpeechToTextService
+from .audio.tts_cache import SpeechCache
+from .audio.speech_stream import with_speech
 from .db import crud
-from .agents.agent import AssistantAgent, EngineeringManagerAgent
+from .db import database
+from .db.cursor import MessageCursor
+from .db.database import get_session, create_db_and_tables
+from .jobs.job_queue import JobQueue
+from .pubsub.room_hub import room_hub, Subscription
+from .agents.agent_manager import AgentManager
+from .agents.context import contexts
+from .agents.registry import agent_registry
+from .tools.microsoft.account import microsoft_account
+from .tools.tool import BaseTool, tool_executor
+from .llm import openai_client
+from .memory.embedder import HashingEmbedder, OpenAIEmbedder
+from .memory.memory import memory
+from .llm.cache import MemoryCacheBackend, SQLiteCacheBackend
 from .llm.openai_client import respond_to_prompt
+from .telemetry import tracing
+from .telemetry.metrics import metrics
+from .telemetry.tracing import tracer
 
+logger = logging.getLogger(__name__)
 
 # FastAPI Initialization
 app = FastAPI()
 
 # Database Initialization
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite:///./{sqlite_file_name}"
-engine = create_engine(
-    sqlite_url, echo=False, connect_args={"check_same_thread": False}
+database.configure(
+    url=config.get("database", "url", fallback=database.sqlite_url),
+    pool_size=config.getint("database", "poolSize", fallback=5),
+    max_overflow=config.getint("database", "maxOverflow", fallback=10),
+    pool_timeout=config.getfloat("database", "poolTimeout", fallback=30),
+    busy_timeout_ms=config.getint("database", "busyTimeoutMs", fallback=5000),
 )
 
-# Agent Initialization
-agents = []
-
 ceo_name = config["app"]["ceoName"]
 ceo_email = config["app"]["ceoEmail"]
 
+contexts.token_budget = config.getint("context", "tokenBudget", fallback=6000)
+contexts.summary_chunk_tokens = config.getint("context", "summaryChunkTokens", fallback=8000)
+room_hub.max_queue = config.getint("pubsub", "maxQueue", fallback=100)
+room_hub.poll_interval = config.getfloat("pubsub", "pollInterval", fallback=0)
+
+# LLM Response Cache Initialization
+llm_cache_backend = config.get("llm-cache", "backend", fallback="memory")
+if llm_cache_backend == "sqlite":
+    openai_client.response_cache.backend = SQLiteCacheBackend(path=config.get("llm-cache", "path", fallback="./llm_cache.db"), ttl=config.getfloat("llm-cache", "ttl", fallback=3600))
+elif llm_cache_backend == "memory":
+    openai_client.response_cache.backend = MemoryCacheBackend(ttl=config.getfloat("llm-cache", "ttl", fallback=3600), max_size=config.getint("llm-cache", "maxSize", fallback=1024))
+else:
+    openai_client.response_cache.backend = None
+
+# Tool Initialization
+BaseTool.timeout = config.getfloat("tools", "timeout", fallback=30)
+tool_executor.workers = config.getint("tools", "workers", fallback=16)
+microsoft_account.pool_size = config.getint("azure", "connectionPoolSize", fallback=10)
+microsoft_account.request_retries = config.getint("azure", "requestRetries", fallback=2)
+# By default every attempt, and the backoff before a retry, fits in the tool timeout
+microsoft_account.timeout = config.getfloat("azure", "requestTimeout", fallback=BaseTool.timeout / (microsoft_account.request_retries + 2))
+
+# LLM Client Initialization
+for call_type in openai_client.models:
+    openai_client.models[call_type] = config.get("llm", f"{call_type}Model", fallback=openai_client.models[call_type])
+    openai_client.deadlines[call_type] = config.getfloat("llm", f"{call_type}Deadline", fallback=openai_client.deadlines[call_type])
+openai_client.hedge_percentile = config.getfloat("llm", "hedgePercentile", fallback=95)
+openai_client.hedge_min_delay = config.getfloat("llm", "hedgeMinDelay", fallback=1.0)
+openai_client.max_connections = config.getint("llm", "maxConnections", fallback=100)
+openai_client.max_keepalive_connections = config.getint("llm", "maxKeepaliveConnections", fallback=20)
+openai_client.keepalive_expiry = config.getfloat("llm", "keepaliveExpiry", fallback=30)
+openai_client.connect_timeout = config.getfloat("llm", "connectTimeout", fallback=5)
+openai_client.read_timeout = config.getfloat("llm", "readTimeout", fallback=30)
+openai_client.max_retries = config.getint("llm", "maxRetries", fallback=1)
+
+# Message Memory Initialization
+memory_embedder = config.get("memory", "embedder", fallback="none")
+if memory_embedder == "openai":
+    memory.embedder = OpenAIEmbedder(model=config.get("memory", "model", fallback="text-embedding-ada-002"), dimensions=config.getint("memory", "dimensions", fallback=1536))
+elif memory_embedder == "hashing":
+    memory.embedder = HashingEmbedder(dimensions=config.getint("memory", "dimensions", fallback=256))
+else:
+    memory.embedder = None
+memory.directory = config.get("memory", "directory", fallback="./memory_index")
+memory.top_k = config.getint("memory", "topK", fallback=5)
+memory.min_score = config.getfloat("memory", "minScore", fallback=0.25)
+memory.lists = config.getint("memory", "lists", fallback=1024)
+memory.probes = config.getint("memory", "probes", fallback=16)
+
+# Job Queue Initialization
+crud.claim_lease = config.getfloat("jobs", "claimLease", fallback=60)
+job_queue = JobQueue(
+    handler=lambda message_id: crud.process_message(message_id, agent_registry.agents()),
+    workers=config.getint("jobs", "workers", fallback=4),
+    max_attempts=config.getint("jobs", "maxAttempts", fallback=3),
+    retry_delay=config.getfloat("jobs", "retryDelay", fallback=2.0),
+    reap_interval=config.getfloat("jobs", "reapInterval", fallback=30),
+)
+# Replies generated inline by /messages/stream at once, further streams wait for a slot
+stream_slots = asyncio.Semaphore(config.getint("jobs", "maxStreams", fallback=64))
+
+# Speech To Text Initialization
+stt_service = SpeechToTextService(
+    model_name=config.get("stt", "model", fallback="small.en"),
+    workers=config.getint("stt", "workers", fallback=1),
+    batch_size=config.getint("stt", "batchSize", fallback=8),
+    batch_window=config.getfloat("stt", "batchWindowMs", fallback=50) / 1000,
+)
+
+# Text To Speech Initialization
+speech_cache = SpeechCache(
+    directory=config.get("tts", "cacheDir", fallback="./tts_cache"),
+    max_bytes=config.getint("tts", "cacheMaxMb", fallback=200) * 1024 * 1024,
+    voice=config.get("tts", "voice", fallback="alloy"),
+    model=config.get("tts", "model", fallback="tts-1"),
+)
+
+# Warm-up Initialization
+# Subsystems are set up on first use, these hooks set them up in the background right after startup instead
+warm_up_hooks = {
+    "llm": openai_client.warm_up,
+    "graph": microsoft_account.warm_up,
+    "tokenizer": contexts.warm_up,
+    "stt": stt_service.warm_up,
+    "memory": memory.warm_up,
+}
+warm_ups = [name.strip() for name in config.get("startup", "warmUp", fallback="llm, graph, tokenizer, memory").split(",") if name.strip()]
+for name in warm_ups:
+    if name not in warm_up_hooks:
+        raise ValueError(f"Unknown warm-up {name!r} in [startup] warmUp, expected some of {', '.join(warm_up_hooks)}")
+
+warm_up_tasks = []
+
+async def warm_up(name: str):
+    started = time.perf_counter()
+    try:
+        await warm_up_hooks[name]()
+    except Exception as e:
+        logger.warning("Warm-up of %s failed, it will be set up on first use: %r", name, e)
+    else:
+        logger.info("Warmed up %s in %.2fs", name, time.perf_counter() - started)
+
+# Telemetry Initialization
+logging.basicConfig(level=config.get("telemetry", "logLevel", fallback="INFO").upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+tracing.payload_sample_rate = config.getfloat("telemetry", "payloadSampleRate", fallback=0.1)
+tracer.configure(trace_file=config.get("telemetry", "traceFile", fallback=None))
+AgentManager.shadow_rate = config.getfloat("router", "shadowRate", fallback=0.05)
+metrics.add_stats("router", AgentManager.routing_stats)
+metrics.add_stats("tool_cache", lambda: {tool.name: tool.cache.stats() for tool in agent_registry.tools() if tool.cache is not None}, label="tool")
+metrics.add_stats("llm_cache", openai_client.response_cache.stats)
+metrics.add_stats("llm_latency", openai_client.completion_latency.stats, label="model")
+metrics.add_stats("llm_first_token_latency", openai_client.first_token_latency.stats, label="model")
+metrics.add_stats("speech_cache", speech_cache.stats)
+metrics.add_stats("room_hub", room_hub.stats)
+metrics.add_stats("memory", memory.stats)
+job_gauge = metrics.gauge("jobs", "Jobs in the queue by status.", labels=("status",))
+
 
 @app.on_event("startup")
-def on_startup():
-    SQLModel.metadata.create_all(engine)
-    with Session(engine) as db:
-        default_meeting_room = crud.get_meeting_room_by_id(db, id=1)
+async def on_startup():
+    await create_db_and_tables()
+    async with get_session() as db:
+        default_meeting_room = await crud.get_meeting_room_by_id(db, id=1)
         if not default_meeting_room:
-            crud.create_meeting_room(db, id=1)
+            try:
+                await crud.create_meeting_room(db, id=1)
+            except IntegrityError:
+                # Another worker process created it first
+                pass
+
+    await room_hub.start()
+    await job_queue.start()
+    await stt_service.start()
+    await memory.start()
+    # Requests arriving before a warm-up is done set the subsystem up themselves, or wait for it
+    warm_up_tasks.extend(asyncio.create_task(warm_up(name)) for name in warm_ups)
 
-        assistant_agent = AssistantAgent(db_session=db)
-        engineering_manager_agent = EngineeringManagerAgent(db_session=db)
-        agents.append(assistant_agent)
-        agents.append(engineering_manager_agent)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await job_queue.stop()
+    await stt_service.stop()
+    await memory.stop()
+    await room_hub.stop()
+    tool_executor.shutdown()
+    tracer.close()
 
 
 @app.get("/meeting_rooms")
-def meeting_rooms():
-    with Session(engine) as db:
-        db_room = crud.meeting_rooms(db)
+async def meeting_rooms():
+    async with get_session() as db:
+        db_room = await crud.meeting_rooms(db)
         if db_room is None:
             raise HTTPException(status_code=404, detail="Meeting room not found")
         return db_room
 
 @app.post("/meeting_rooms")
-def create_meeting_room(id: int):
-    with Session(engine) as db:
-        db_room = crud.create_meeting_room(db, id=id)
+async def create_meeting_room(id: int):
+    async with get_session() as db:
+        db_room = await crud.create_meeting_room(db, id=id)
         return db_room
 
+def set_cursor(response: Response, db_messages, since: int=None):
+    """
+    Clients poll with ?since=<X-Cursor of the previous response> to fetch only new messages.
+    """
+    cursor = db_messages[-1].id if db_messages else since
+    if cursor is not None:
+        response.headers["X-Cursor"] = str(cursor)
+
 @app.get("/messages")
-def messages(meeting_room_id: int=1):
-    with Session(engine) as db:
-        db_messages = crud.messages(db, meeting_room_id)
+async def messages(response: Response, meeting_room_id: int=1, before_id: int=None, after_id: int=None, since: int=None, limit: int=Query(default=None, ge=1, le=1000)):
+    after_id = since if since is not None else after_id
+    async with get_session() as db:
+        db_messages = await crud.messages(db, meeting_room_id, before_id=before_id, after_id=after_id, limit=limit)
         if db_messages is None:
             raise HTTPException(status_code=404, detail=f"Messages not found for meeting room {meeting_room_id}")
+        set_cursor(response, db_messages, since=after_id)
         return db_messages
 
 @app.post("/messages")
-def create_message(user_name: str, text: str, role: str, background_tasks: BackgroundTasks, to_role: str=None, meeting_room_id: int=1):
-    with Session(engine) as db:
-        db_message = crud.create_message(db, user_name=user_name, text=text, role=role, to_role=to_role, meeting_room_id=meeting_room_id)
-        background_tasks.add_task(crud.process_message, db, db_message.id, agents)
-        return db_message
+async def create_message(user_name: str, text: str, role: str, to_role: str=None, meeting_room_id: int=1):
+    async with get_session() as db:
+        db_message, job = await crud.create_message_with_job(db, user_name=user_name, text=text, role=role, to_role=to_role, meeting_room_id=meeting_room_id)
+    job_queue.notify(job)
+    return db_message
+
+async def create_streamed_message(user_name: str, text: str, role: str, to_role: str=None, meeting_room_id: int=1):
+    """
+    Store a message to be replied to by a stream, with a job that only runs once the claim of the stream ran
+    out, in case the client disconnects or the process stops before the reply is stored.
+    """
+    async with get_session() as db:
+        db_message, job = await crud.create_message_with_job(db, user_name=user_name, text=text, role=role, to_role=to_role, meeting_room_id=meeting_room_id,
+                                                             delay=crud.claim_lease)
+    job_queue.notify(job, delay=crud.claim_lease)
+    return db_message, job
+
+async def stream_events(message, job, speech: bool=False):
+    """
+    Yield the stored message, the routing decision, the reply tokens and the stored reply as (event, data) pairs.
+    With `speech`, the reply is also spoken sentence by sentence in "speech" events as it is generated.
+    The message's job is completed once the reply is stored, and handed to the workers otherwise.
+    """
+    replied = False
+    try:
+        yield "message", message
+        async with stream_slots:
+            events = crud.stream_message(message.id, agent_registry.agents())
+            if speech:
+                events = with_speech(events, speech_cache)
+            async for event, data in events:
+                if event == "agent":
+                    data = {"name": data.name, "role": data.role}
+                elif event == "reply":
+                    replied = True
+                yield event, data
+    finally:
+        # Shielded so a disconnecting client does not cancel it, should it fail the job runs once its delay is up
+        await asyncio.shield(job_queue.release(job, replied))
+
+@app.post("/messages/stream")
+async def create_message_stream(user_name: str, text: str, role: str, to_role: str=None, meeting_room_id: int=1, speech: bool=False):
+    """
+    Like POST /messages, but the reply is generated inline and pushed to the client as Server-Sent Events.
+    With `speech`, audio and mouth cues for each sentence are pushed as soon as the sentence is synthesized.
+    """
+    db_message, job = await create_streamed_message(user_name=user_name, text=text, role=role, to_role=to_role, meeting_room_id=meeting_room_id)
+
+    async def sse():
+        async for event, data in stream_events(db_message, job, speech=speech):
+            yield f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+    return StreamingResponse(sse(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.websocket("/messages/stream")
+async def message_stream(websocket: WebSocket):
+    """
+    Each JSON object received with the POST /messages parameters is answered with a stream of
+    {"event": ..., "data": ...} objects, ending with the stored reply in a "reply" event.
+    """
+    await websocket.accept()
+    try:
+        while True:
+            params = await websocket.receive_json()
+            db_message, job = await create_streamed_message(user_name=params["user_name"],
+                                                            text=params["text"],
+                                                            role=params["role"],
+                                                            to_role=params.get("to_role"),
+                                                            meeting_room_id=params.get("meeting_room_id", 1))
+            async for event, data in stream_events(db_message, job, speech=params.get("speech", False)):
+                await websocket.send_json({"event": event, "data": jsonable_encoder(data)})
+    except WebSocketDisconnect:
+        pass
+
+async def room_events(meeting_room_id: int, since: int=None, keepalive: float=15, max_delivered: int=1000):
+    """
+    Yield ("message", message) for every new message in the room, starting after `since` when given.
+    Yields ("resync", {"since": cursor}) when the subscriber fell behind and should refetch
+    GET /messages?since=cursor, which can repeat messages already yielded, and ("ping", None) after
+    `keepalive` seconds without messages.
+    """
+    # Messages commit out of id order, so a message committed late has a lower id than ones yielded before it.
+    # Messages already yielded are therefore recognized by their id among the last `max_delivered`, and the
+    # cursor keeps the ids it skipped so a resync refetches the messages that may still arrive late.
+    delivered, delivered_ids = deque(), set()
+    cursor = MessageCursor(since) if since is not None else None
+
+    def first_delivery(message) -> bool:
+        nonlocal cursor
+        if message.id in delivered_ids:
+            return False
+        delivered.append(message.id)
+        delivered_ids.add(message.id)
+        if len(delivered) > max_delivered:
+            delivered_ids.discard(delivered.popleft())
+        if cursor is None:
+            cursor = MessageCursor(message.id - 1)
+        cursor.advance([message.id])
+        return True
+
+    # Subscribe before reading the backlog so nothing posted in between is missed
+    subscription = room_hub.subscribe(meeting_room_id)
+    try:
+        if since is not None:
+            async with get_session() as db:
+                for message in await crud.messages(db, meeting_room_id, after_id=since):
+                    if first_delivery(message):
+                        yield "message", message
+        while True:
+            message = await subscription.get(timeout=keepalive)
+            if message is None:
+                yield "ping", None
+            elif message is Subscription.RESYNC:
+                yield "resync", {"since": cursor.resume_position if cursor is not None else None}
+            elif first_delivery(message):
+                yield "message", message
+    finally:
+        room_hub.unsubscribe(subscription)
+
+@app.get("/meeting_rooms/{meeting_room_id}/events")
+async def meeting_room_events(request: Request, meeting_room_id: int, since: int=None):
+    """
+    Server-Sent Events stream of new messages in the room. Reconnecting clients resume from the Last-Event-ID header.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if since is None and last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+
+    async def sse():
+        async for event, data in room_events(meeting_room_id, since=since):
+            if event == "ping":
+                yield ": keepalive\n\n"
+            elif event == "message":
+                yield f"id: {data.id}\nevent: message\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+            else:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(sse(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.websocket("/meeting_rooms/{meeting_room_id}/ws")
+async def meeting_room_socket(websocket: WebSocket, meeting_room_id: int, since: int=None):
+    """
+    WebSocket stream of new messages in the room as {"event": ..., "data": ...} objects.
+    """
+    await websocket.accept()
+    try:
+        async for event, data in room_events(meeting_room_id, since=since):
+            await websocket.send_json({"event": event, "data": jsonable_encoder(data)})
+    except WebSocketDisconnect:
+        pass
 
 @app.get("/new_user_message")
-def new_user_message(text: str, background_tasks: BackgroundTasks):
-    return create_message(text=text, user_name=ceo_name, role="CEO", background_tasks=background_tasks, meeting_room_id=1)
+async def new_user_message(text: str):
+    return await create_message(text=text, user_name=ceo_name, role="CEO", meeting_room_id=1)
 
 @app.get("/messages_between_roles")
-def messages_between_roles(role1: str, role2: str):
-    with Session(engine) as db:
-        db_messages = crud.messages_between_roles(db, role1, role2)
+async def messages_between_roles(response: Response, role1: str, role2: str, before_id: int=None, after_id: int=None, since: int=None, limit: int=Query(default=None, ge=1, le=1000)):
+    after_id = since if since is not None else after_id
+    async with get_session() as db:
+        db_messages = await crud.messages_between_roles(db, role1, role2, before_id=before_id, after_id=after_id, limit=limit)
         if db_messages is None:
             raise HTTPException(status_code=404, detail=f"Messages not found between roles {role1} and {role2}")
+        set_cursor(response, db_messages, since=after_id)
         return db_messages
 
+@app.get("/search")
+async def search(q: str, k: int=Query(default=10, ge=1, le=100), min_score: float=None):
+    """
+    The past messages most similar to the query text, most similar first, each with its cosine similarity as "score".
+    """
+    if not memory.enabled:
+        raise HTTPException(status_code=503, detail="Message memory is disabled")
+    results = await memory.search(q, k=k, min_score=min_score)
+    async with get_session() as db:
+        db_messages = {m.id: m for m in await crud.get_messages_by_ids(db, [message_id for message_id, _ in results])}
+    return [{"score": round(score, 4), "message": db_messages[message_id]} for message_id, score in results if message_id in db_messages]
+
+@app.get("/jobs")
+async def jobs(status: str=None, limit: int=100):
+    async with get_session() as db:
+        counts = await crud.job_counts(db)
+        db_jobs = await crud.jobs(db, status=status, limit=limit)
+        return {"workers": job_queue.workers, "counts": counts, "jobs": db_jobs}
+
+@app.get("/router/stats")
+def router_stats():
+    return AgentManager.routing_stats()
+
+@app.get("/tools/cache")
+def tool_cache_stats():
+    return {tool.name: tool.cache.stats() for tool in agent_registry.tools() if tool.cache is not None}
+
+@app.post("/speech_to_text")
+async def speech_to_text(request: Request):
+    """
+    Transcribe the audio file sent as the request body, in any format ffmpeg can read.
+    """
+    data = await request.body()
+    if not data:
+        raise HTTPException(status_code=400, detail="Request body must contain audio data")
+    try:
+        return await stt_service.transcribe(data)
+    except AudioDecodeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/speech")
+async def speech(text: str, voice: str=None):
+    """
+    Spoken audio for the text together with its lip-sync cues, so the avatar needs a single round trip.
+    The MP3 is returned base64 encoded in "audio" and the cues in "lipsync".
+    """
+    mp3, lipsync = await speech_cache.get(text, voice=voice)
+    return {"audio": base64.b64encode(mp3).decode("ascii"), "lipsync": lipsync}
+
+@app.get("/speech/cache")
+def speech_cache_stats():
+    return speech_cache.stats()
+
+@app.get("/llm/cache")
+def llm_cache_stats():
+    return openai_client.response_cache.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """
+    Latency, token and cache metrics in the Prometheus text format.
+    """
+    async with get_session() as db:
+        counts = await crud.job_counts(db)
+    for status in ("pending", "running", "done", "failed"):
+        job_gauge.set(counts.get(status, 0), status=status)
+    return metrics.render()
+
 
 @app.post("/test_prompt")
-def test_prompt(prompt:str=None):
-    return respond_to_prompt(prompt=prompt)
+async def test_prompt(prompt:str=None):
+    return await respond_to_prompt(prompt=prompt)
 
 # @app.get("/")
 # def read_root():
@@ -104,11 +487,3 @@ def test_prompt(prompt:str=None):
 # @app.get("/generate_json_from_mp3")
 # def mouth_shapes():
 #     return audio.generate_json_from_mp3("/Users/shawnsun/github/3d-ai-agent/react/public/audios/newMessage.mp3")
-
-# @app.get("/speech_to_text")
-# def speech_to_text():
-#     return audio.speech_to_text("/Users/shawnsun/github/3d-ai-agent/react/public/audios/newMessage.mp3")
-
-# @app.get("/text_to_speech")
-# def text_to_speech():
-#     return audio.text_to_speech("Hello, how are you?", "/Users/shawnsun/github/3d-ai-agent/react/public/audios/greeting.mp3")
@@ -0,0 +1,79 @@
+import hashlib
+import re
+from abc import ABC, abstractmethod
+import numpy as np
+from ..telemetry.tracing import tracer
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale rows to unit length, so a dot product is the cosine similarity. All-zero rows stay zero.
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.where(norms == 0, 1, norms)).astype(np.float32, copy=False)
+
+
+class Embedder(ABC):
+    """
+    Turns texts into unit length float32 vectors of `dimensions` numbers. `name` identifies the vector space,
+    vectors from embedders with different names are not comparable.
+    """
+    name = None
+    dimensions = None
+
+    @abstractmethod
+    async def embed(self, texts: list) -> np.ndarray:
+        pass
+
+
+class HashingEmbedder(Embedder):
+    """
+    Local, deterministic embedder for development, tests and benchmarks. Words and word pairs are hashed
+    into signed buckets, so texts sharing words are similar. It knows nothing about meaning, but needs no
+    model and no API calls, and gives the same vector for the same text in every process.
+    """
+    stop_words = frozenset("the and for are but not you your with this that was were have has had what when who how can "
+                           "could would should will from they them their there about into our out any all its".split())
+
+    def __init__(self, dimensions: int=256):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+    def features(self, text: str) -> list:
+        words = [word for word in re.findall(r"\w+", (text or "").lower()) if len(word) > 2 and word not in self.stop_words]
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def embed_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for feature in self.features(text):
+            # Python's hash() is salted per process, blake2b gives the same bucket everywhere
+            h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            vector[h % self.dimensions] += 1 if h >> 63 else -1
+        return vector
+
+    async def embed(self, texts: list) -> np.ndarray:
+        with tracer.span("memory.embed", embedder=self.name, texts=len(texts)):
+            return normalize(np.stack([self.embed_one(text) for text in texts])) if texts else np.zeros((0, self.dimensions), dtype=np.float32)
+
+
+class OpenAIEmbedder(Embedder):
+    """
+    Embeddings from an Azure OpenAI embedding deployment.
+    """
+    # Inputs per request accepted by Azure OpenAI embedding deployments
+    max_batch = 16
+
+    def __init__(self, model: str="text-embedding-ada-002", dimensions: int=1536):
+        self.model = model
+        self.dimensions = dimensions
+        self.name = f"openai-{model}-{dimensions}"
+
+    async def embed(self, texts: list) -> np.ndarray:
+        from ..llm.openai_client import get_client
+        vectors = []
+        with tracer.span("memory.embed", embedder=self.name, texts=len(texts)):
+            for start in range(0, len(texts), self.max_batch):
+                # Empty inputs are rejected by the API
+                batch = [text or " " for text in texts[start:start + self.max_batch]]
+                response = await get_client().embeddings.create(model=self.model, input=batch)
+                vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        return normalize(np.asarray(vectors, dtype=np.float32).reshape(len(texts), self.dimensions))
@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import threading
+from array import array
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Rows scored per matrix product when comparing a query with every vector
+SCAN_CHUNK_ROWS = 65536
+
+class VectorIndex:
+    """
+    Append-only index of unit vectors tagged with message ids, searched by cosine similarity.
+
+    Vectors, ids and list numbers live in flat files in `directory` that are only ever appended to. The
+    vectors are memory-mapped, so opening the index reads only the ids and list numbers, and the vectors
+    do not have to fit in memory. Up to `exact_limit` vectors a search scores every vector. Past that,
+    k-means centroids are trained once on a sample and each vector goes to the list of its nearest of
+    `lists` centroids. A search then scores only the vectors in the `probes` lists whose centroids are
+    closest to the query: a few thousand vectors instead of millions, at the price of now and then missing
+    a match filed under another list.
+    """
+    meta_file_name = "meta.json"
+    vectors_file_name = "vectors.f32"
+    ids_file_name = "ids.i64"
+    lists_file_name = "lists.i32"
+    centroids_file_name = "centroids.npy"
+
+    def __init__(self, directory: str, dimensions: int, name: str=None, lists: int=1024, probes: int=16, exact_limit: int=50_000, kmeans_iterations: int=10):
+        self.directory = directory
+        self.dimensions = dimensions
+        self.name = name
+        self.lists = lists
+        self.probes = probes
+        self.exact_limit = exact_limit
+        self.kmeans_iterations = kmeans_iterations
+        self._lock = threading.Lock()
+        self._count = 0
+        self._ids = array("q")
+        self._vectors = None
+        self._centroids = None
+        self._members = []
+        self._meta_matches = False
+        self.max_id = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def trained(self) -> bool:
+        return self._centroids is not None
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.directory, file_name)
+
+    def open(self, writable: bool=True):
+        """
+        Load the index from `directory`. A writable index built by another embedder is discarded, it is
+        rebuilt from the messages. A read-only index stays empty until the writer has rebuilt it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        meta = {"name": self.name, "dimensions": self.dimensions, "lists": self.lists}
+        try:
+            with open(self._path(self.meta_file_name)) as f:
+                stored_meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            stored_meta = None
+        self._meta_matches = stored_meta == meta
+        if not self._meta_matches and not writable:
+            self._load(0, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), None)
+            return self
+        if not self._meta_matches:
+            if stored_meta is not None:
+                logger.warning("Discarding the message index in %s, it was built with %s", self.directory, stored_meta)
+            for file_name in (self.vectors_file_name, self.ids_file_name, self.lists_file_name, self.centroids_file_name):
+                if os.path.exists(self._path(file_name)):
+                    os.remove(self._path(file_name))
+            with open(self._path(self.meta_file_name), "w") as f:
+                json.dump(meta, f)
+            self._meta_matches = True
+
+        # The centroids are read first, since they are written after the list numbers they belong to
+        centroids = np.load(self._path(self.centroids_file_name)) if os.path.exists(self._path(self.centroids_file_name)) else None
+        count = self._stored_count()
+        ids = self._read(self.ids_file_name, np.int64, count)
+        list_numbers = self._read(self.lists_file_name, np.int32, count)
+        if writable:
+            # Appends write the vectors, ids and list numbers one after another, a crash in between leaves a partial row
+            for file_name, row_bytes in ((self.vectors_file_name, 4 * self.dimensions), (self.ids_file_name, 8), (self.lists_file_name, 4)):
+                with open(self._path(file_name), "ab") as f:
+                    f.truncate(count * row_bytes)
+        self._load(count, ids, list_numbers, centroids)
+        return self
+
+    def _load(self, count: int, ids: np.ndarray, list_numbers: np.ndarray, centroids: np.ndarray):
+        with self._lock:
+            self._count = count
+            self._ids = array("q", ids.tobytes())
+            self.max_id = int(ids.max()) if count else 0
+            self._centroids = centroids
+            self._members = self._group(list_numbers) if centroids is not None else []
+            self._map_vectors()
+
+    def refresh(self):
+        """
+        Pick up the vectors another process appended to the index since it was opened or last refreshed.
+        """
+        if not self._meta_matches or (self._centroids is None and os.path.exists(self._path(self.centroids_file_name))):
+            return self.open(writable=False)
+        count = self._stored_count()
+        if count <= self._count:
+            return self
+        first_row = self._count
+        ids = self._read(self.ids_file_name, np.int64, count, offset=first_row)
+        list_numbers = self._read(self.lists_file_name, np.int32, count, offset=first_row)
+        with self._lock:
+            self._ids.extend(ids.tolist())
+            self.max_id = max(self.max_id, int(ids.max()))
+            if self._centroids is not None:
+                for row, list_number in enumerate(list_numbers.tolist(), start=first_row):
+                    self._members[list_number].append(row)
+            self._count = count
+            self._map_vectors()
+        return self
+
+    def _stored_count(self) -> int:
+        """
+        Rows completely written to all three files.
+        """
+        sizes = [os.path.getsize(self._path(file_name)) // row_bytes if os.path.exists(self._path(file_name)) else 0
+                 for file_name, row_bytes in ((self.vectors_file_name, 4 * self.dimensions), (self.ids_file_name, 8), (self.lists_file_name, 4))]
+        return min(sizes)
+
+    def _read(self, file_name: str, dtype, count: int, offset: int=0) -> np.ndarray:
+        """
+        Rows `offset` up to `count` of a file of numbers.
+        """
+        if count <= offset:
+            return np.zeros(0, dtype=dtype)
+        return np.fromfile(self._path(file_name), dtype=dtype, count=count - offset, offset=offset * np.dtype(dtype).itemsize)
+
+    def _group(self, list_numbers: np.ndarray) -> list:
+        """
+        Rows of each list, from the list number of every row.
+        """
+        order = np.argsort(list_numbers, kind="stable")
+        bounds = np.searchsorted(list_numbers[order], np.arange(self.lists + 1))
+        return [array("q", order[bounds[i]:bounds[i + 1]].astype(np.int64).tobytes()) for i in range(self.lists)]
+
+    def _map_vectors(self):
+        self._vectors = np.memmap(self._path(self.vectors_file_name), dtype=np.float32, mode="r", shape=(self._count, self.dimensions)) if self._count else None
+
+    def _assign(self, vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        return np.concatenate([np.argmax(vectors[start:start + SCAN_CHUNK_ROWS] @ centroids.T, axis=1)
+                               for start in range(0, len(vectors), SCAN_CHUNK_ROWS)]).astype(np.int32) if len(vectors) else np.zeros(0, dtype=np.int32)
+
+    def append(self, ids: list, vectors: np.ndarray):
+        """
+        Add vectors with their message ids. Only one thread may append at a time, searches can run meanwhile.
+        """
+        if not len(ids):
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(ids), self.dimensions)
+        centroids = self._centroids
+        list_numbers = self._assign(vectors, centroids) if centroids is not None else np.full(len(ids), -1, dtype=np.int32)
+        for file_name, data in ((self.vectors_file_name, vectors), (self.ids_file_name, np.asarray(ids, dtype=np.int64)), (self.lists_file_name, list_numbers)):
+            with open(self._path(file_name), "ab") as f:
+                f.write(data.tobytes())
+
+        with self._lock:
+            first_row = self._count
+            self._count += len(ids)
+            self._ids.extend(ids)
+            self.max_id = max(self.max_id, max(ids))
+            if centroids is not None:
+                for row, list_number in enumerate(list_numbers.tolist(), start=first_row):
+                    self._members[list_number].append(row)
+            self._map_vectors()
+
+        if centroids is None and self.lists and self._count >= self.exact_limit:
+            self.train()
+
+    def train(self):
+        """
+        Train the centroids with spherical k-means on a sample of the vectors and file every vector under its list.
+        """
+        with self._lock:
+            vectors, count = self._vectors, self._count
+        rng = np.random.default_rng(0)
+        # About 64 vectors per list is plenty to place the centroids
+        sample = np.asarray(vectors[np.sort(rng.choice(count, size=min(count, self.lists * 64), replace=False))])
+        centroids = sample[rng.choice(len(sample), size=self.lists, replace=len(sample) < self.lists)].copy()
+        for _ in range(self.kmeans_iterations):
+            labels = self._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=self.lists) == 0
+            # Restart lists that lost all their vectors from random vectors
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = (sums / np.where(norms == 0, 1, norms)).astype(np.float32)
+
+        list_numbers = self._assign(vectors, centroids)
+        with open(self._path(self.lists_file_name), "wb") as f:
+            f.write(list_numbers.tobytes())
+        # Written last: an index with centroids has every vector filed under a list
+        with open(self._path(self.centroids_file_name), "wb") as f:
+            np.save(f, centroids)
+        with self._lock:
+            self._members = self._group(list_numbers)
+            self._centroids = centroids
+        logger.info("Trained %d lists on %d of %d vectors in the message index", self.lists, len(sample), count)
+
+    def search(self, query: np.ndarray, k: int, exclude: set=frozenset()) -> list:
+        """
+        The `k` most similar vectors to a unit length query as (message id, cosine similarity) pairs, most similar first.
+        Ids in `exclude` are skipped.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        with self._lock:
+            vectors, count, centroids = self._vectors, self._count, self._centroids
+            if centroids is not None:
+                closest = np.argsort(-(centroids @ query))[:self.probes]
+                rows = np.sort(np.concatenate([np.frombuffer(self._members[i], dtype=np.int64) for i in closest]))
+        if not count:
+            return []
+
+        if centroids is None:
+            rows = None
+            scores = np.empty(count, dtype=np.float32)
+            for start in range(0, count, SCAN_CHUNK_ROWS):
+                scores[start:start + SCAN_CHUNK_ROWS] = vectors[start:start + SCAN_CHUNK_ROWS] @ query
+        else:
+            scores = vectors[rows] @ query if len(rows) else np.zeros(0, dtype=np.float32)
+
+        wanted = min(k + len(exclude), len(scores))
+        if not wanted:
+            return []
+        top = np.argpartition(-scores, wanted - 1)[:wanted]
+        top = top[np.argsort(-scores[top])]
+        with self._lock:
+            ids = [self._ids[row] for row in (rows[top] if rows is not None else top).tolist()]
+        return [(message_id, float(score)) for message_id, score in zip(ids, scores[top].tolist()) if message_id not in exclude][:k]
+
+    def stats(self) -> dict:
+        return {"vectors": self._count, "trained": self.trained, "lists": self.lists if self.trained else 0}
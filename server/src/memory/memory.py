@@ -0,0 +1,166 @@
+import asyncio
+import fcntl
+import logging
+import os
+from sqlmodel import select
+from ..db import models
+from ..db.cursor import MessageCursor
+from ..db.database import get_session
+from ..telemetry.tracing import tracer
+from .embedder import Embedder
+from .index import VectorIndex
+
+logger = logging.getLogger(__name__)
+
+
+class MessageMemory:
+    """
+    Long-term memory over every message, for finding past messages related to a text.
+
+    Messages are embedded in the background and appended to a VectorIndex. The indexer reads the messages
+    newer than the newest indexed one from the database, right after this process wrote a message and
+    every `poll_interval` seconds for messages of other processes, so it also catches up on messages
+    written while the server was down or before memory was enabled. A MessageCursor, starting after the
+    newest indexed message, also picks up the messages that committed after messages with higher ids.
+
+    With several worker processes, the one holding the lock file in `directory` indexes and the others
+    only search, picking up its appends as they go. When the indexing process stops, another takes over.
+    Without an embedder memory is off: nothing is indexed and searches find nothing.
+    """
+    lock_file_name = "writer.lock"
+
+    def __init__(self, embedder: Embedder=None, directory: str="./memory_index", top_k: int=5, min_score: float=0.25,
+                 lists: int=1024, probes: int=16, batch_size: int=64, batch_window: float=0.05, poll_interval: float=2.0):
+        self.embedder = embedder
+        self.directory = directory
+        self.top_k = top_k
+        self.min_score = min_score
+        self.lists = lists
+        self.probes = probes
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.poll_interval = poll_interval
+        self.index = None
+        self.searches = 0
+        self._load_lock = asyncio.Lock()
+        self._lock_file = None
+        self._wakeup = asyncio.Event()
+        self._indexer = None
+        self._cursor = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.embedder is not None
+
+    @property
+    def writer(self) -> bool:
+        return self._lock_file is not None
+
+    async def _get_index(self) -> VectorIndex:
+        if self.index is None:
+            async with self._load_lock:
+                if self.index is None:
+                    index = VectorIndex(self.directory, self.embedder.dimensions, name=self.embedder.name, lists=self.lists, probes=self.probes)
+                    self.index = await asyncio.to_thread(index.open, self.writer)
+        return self.index
+
+    def _acquire_writer_lock(self) -> bool:
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(os.path.join(self.directory, self.lock_file_name), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    async def start(self):
+        if self.enabled:
+            self._indexer = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._indexer is not None:
+            self._indexer.cancel()
+            await asyncio.gather(self._indexer, return_exceptions=True)
+            self._indexer = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def warm_up(self):
+        """
+        Open the index, so the first search does not wait for it.
+        """
+        if self.enabled:
+            await self._get_index()
+
+    def add(self, message: models.Message):
+        """
+        Index a newly written message soon.
+        """
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if not self.writer and self._acquire_writer_lock():
+                # Reopen writable, the index may have been read while another process was writing it
+                self.index = None
+                self._cursor = None
+            if self.writer:
+                try:
+                    await self._index_new_messages(await self._get_index())
+                except Exception as e:
+                    # Messages that failed are retried on the next round
+                    logger.warning("Indexing messages failed: %r", e)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                # Let messages written close together share a batch
+                await asyncio.sleep(self.batch_window)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _index_new_messages(self, index: VectorIndex):
+        if self._cursor is None:
+            self._cursor = MessageCursor(index.max_id)
+        while True:
+            async with get_session() as db:
+                rows = (await db.exec(select(models.Message.id, models.Message.text)
+                                      .where(self._cursor.condition())
+                                      .order_by(models.Message.id)
+                                      .limit(self.batch_size))).all()
+            if not rows:
+                return
+            vectors = await self.embedder.embed([text for _, text in rows])
+            with tracer.span("memory.append", vectors=len(rows)):
+                await asyncio.to_thread(index.append, [message_id for message_id, _ in rows], vectors)
+            self._cursor.advance([message_id for message_id, _ in rows])
+            if len(rows) < self.batch_size:
+                return
+
+    async def search(self, text: str, k: int=None, exclude: set=frozenset(), min_score: float=None) -> list:
+        """
+        Ids of the `k` messages most similar to the text as (message id, similarity) pairs, most similar first.
+        """
+        if not self.enabled:
+            return []
+        k = k or self.top_k
+        min_score = self.min_score if min_score is None else min_score
+        index = await self._get_index()
+        query = (await self.embedder.embed([text]))[0]
+        with tracer.span("memory.search", k=k, vectors=len(index)):
+            results = await asyncio.to_thread(lambda: (index if self.writer else index.refresh()).search(query, k, exclude))
+        self.searches += 1
+        return [(message_id, score) for message_id, score in results if score >= min_score]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "writer": self.writer,
+            "searches": self.searches,
+            **(self.index.stats() if self.index is not None else {}),
+        }
+
+
+memory = MessageMemory()
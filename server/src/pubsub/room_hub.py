@@ -0,0 +1,122 @@
+import asyncio
+import logging
+from collections import defaultdict
+from sqlmodel import select
+from ..db.cursor import MessageCursor
+from ..db.database import get_session
+from ..db.models import Message
+
+logger = logging.getLogger(__name__)
+
+class Subscription:
+    """
+    A subscriber's bounded queue of new messages in one meeting room.
+
+    When a slow consumer lets the queue fill up, further messages are dropped instead of growing memory
+    or blocking the publisher, and the subscriber gets a single resync marker telling it to catch up
+    from the database with its cursor.
+    """
+    RESYNC = object()
+
+    def __init__(self, meeting_room_id: int, max_queue: int):
+        self.meeting_room_id = meeting_room_id
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.overflowed = False
+        self.dropped = 0
+
+    def put(self, message: Message):
+        if self.overflowed:
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            self.dropped += 1
+
+    async def get(self, timeout: float=None):
+        """
+        Returns the next message, RESYNC after an overflow, or None when nothing arrived within `timeout` seconds.
+        """
+        if self.queue.empty() and self.overflowed:
+            self.overflowed = False
+            return self.RESYNC
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class RoomHub:
+    """
+    In-process pub/sub of new messages per meeting room, so clients get pushed deltas instead of polling.
+
+    With several worker processes a message is often written by another process than the one holding
+    the subscriber's connection. With `poll_interval` set, messages are therefore published from the
+    database instead: one query every `poll_interval` seconds for the messages after the last one seen,
+    which covers messages of every process in id order. A MessageCursor also picks up the messages that
+    committed after messages with higher ids.
+    """
+    # Messages published per poll at most, the rest follow in the next poll
+    poll_batch = 1000
+
+    def __init__(self, max_queue: int=100, poll_interval: float=0):
+        self.max_queue = max_queue
+        self.poll_interval = poll_interval
+        self._subscriptions = defaultdict(set)
+        self._poller = None
+
+    async def start(self):
+        if self.poll_interval:
+            async with get_session() as db:
+                last_id = (await db.exec(select(Message.id).order_by(Message.id.desc()).limit(1))).first() or 0
+            self._poller = asyncio.create_task(self._poll(MessageCursor(last_id)))
+
+    async def stop(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+
+    async def _poll(self, cursor: MessageCursor):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                async with get_session() as db:
+                    messages = (await db.exec(select(Message).where(cursor.condition()).order_by(Message.id).limit(self.poll_batch))).all()
+            except Exception as e:
+                logger.warning("Polling for new messages failed: %r", e)
+                continue
+            for message in messages:
+                self._deliver(message)
+            cursor.advance([message.id for message in messages])
+
+    def subscribe(self, meeting_room_id: int) -> Subscription:
+        subscription = Subscription(meeting_room_id, self.max_queue)
+        self._subscriptions[meeting_room_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.meeting_room_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.meeting_room_id]
+
+    def publish(self, message: Message):
+        # When polling, the poller publishes every message, this process's included
+        if self._poller is None:
+            self._deliver(message)
+
+    def _deliver(self, message: Message):
+        for subscription in self._subscriptions.get(message.meeting_room_id, ()):
+            subscription.put(message)
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self._subscriptions),
+            "subscribers": sum(len(subscriptions) for subscriptions in self._subscriptions.values()),
+        }
+
+
+room_hub = RoomHub()
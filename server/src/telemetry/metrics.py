@@ -0,0 +1,132 @@
+import threading
+from typing import Callable
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_sample(name: str, labels: dict, value) -> str:
+    if labels:
+        name += "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items()) + "}"
+    return f"{name} {float(value):g}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(label, "") for label in self.labels)
+
+    def inc(self, amount: float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Counter):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple=(), buckets: tuple=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ((0,) * len(self.buckets), 0.0, 0))
+            counts = tuple(n + 1 if value <= bound else n for n, bound in zip(counts, self.buckets))
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, (counts, total, count) in values.items():
+            labels = dict(zip(self.labels, key))
+            for bound, n in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", {**labels, "le": f"{bound:g}"}, n
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class MetricsRegistry:
+    """
+    Process wide metrics, rendered in the Prometheus text format by the /metrics endpoint.
+
+    Besides the counters and histograms recorded on the hot path, components that already keep their own
+    statistics (caches, router, pub/sub hub) register a stats function that is read at scrape time, and
+    every numeric value of it is exported as a gauge.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._stats = []
+
+    def _get_or_create(self, cls, name: str, help: str, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, help, **kwargs)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple=()) -> Counter:
+        return self._get_or_create(Counter, name, help, labels=labels)
+
+    def gauge(self, name: str, help: str, labels: tuple=()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labels=labels)
+
+    def histogram(self, name: str, help: str, labels: tuple=(), buckets: tuple=DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labels=labels, buckets=buckets)
+
+    def add_stats(self, prefix: str, stats: Callable[[], dict], label: str=None):
+        """
+        Export the numbers returned by `stats` as `<prefix>_<key>` gauges. With `label`, `stats` returns
+        one dict per label value, e.g. one per tool.
+        """
+        self._stats.append((prefix, stats, label))
+
+    def _stats_samples(self) -> dict:
+        gauges = {}
+        for prefix, stats, label in self._stats:
+            groups = stats().items() if label else [(None, stats())]
+            for label_value, values in groups:
+                labels = {label: label_value} if label else {}
+                for key, value in values.items():
+                    # Booleans are numbers in Python, but None and strings have no Prometheus value
+                    if isinstance(value, (int, float)):
+                        gauges.setdefault(f"{prefix}_{key}", []).append((labels, value))
+        return gauges
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(format_sample(*sample) for sample in metric.samples())
+        for name, samples in self._stats_samples().items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(format_sample(name, labels, value) for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,126 @@
+import contextvars
+import functools
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from .metrics import metrics
+
+span_duration = metrics.histogram("span_duration_seconds", "Time spent in each traced stage.", labels=("span",))
+span_errors = metrics.counter("span_errors_total", "Traced stages that raised an exception.", labels=("span",))
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name: str, parent: "Span"=None, attributes: dict=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes or {}
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """
+    Times the stages of handling a message. Every span feeds the `span_duration_seconds` histogram, and
+    when a trace file is configured it is also written there as one JSON line, linked to its parent span
+    so a whole reply can be followed from routing to the stored message.
+    """
+    def __init__(self):
+        self.trace_file = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def configure(self, trace_file: str=None):
+        self.close()
+        self.trace_file = trace_file or None
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def current(self) -> Span:
+        return _current_span.get()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        span = Span(name, _current_span.get(), attributes)
+        token = _current_span.set(span)
+        started, start_time = time.perf_counter(), time.time()
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            try:
+                _current_span.reset(token)
+            except ValueError:
+                # An async generator closed from another task runs its cleanup in a different context
+                pass
+            self._finish(span, start_time, time.perf_counter() - started, error)
+
+    def traced(self, name: str):
+        """
+        Decorator running each call of an async function in a span.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return await function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name: str, duration: float, **attributes):
+        """
+        Record a stage that was timed elsewhere, e.g. the queueing and inference time of a batch.
+        """
+        self._finish(Span(name, _current_span.get(), attributes), time.time() - duration, duration, None)
+
+    def _finish(self, span: Span, start_time: float, duration: float, error: BaseException):
+        span_duration.observe(duration, span=span.name)
+        if error is not None:
+            span_errors.inc(span=span.name)
+        if self.trace_file is None:
+            return
+        record = {
+            "name": span.name,
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "start": start_time,
+            "duration_ms": round(duration * 1000, 3),
+            "status": "ok" if error is None else "error",
+            **({"error": repr(error)} if error is not None else {}),
+            **({"attributes": span.attributes} if span.attributes else {}),
+        }
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.trace_file, "a")
+            self._file.write(line)
+
+
+tracer = Tracer()
+
+# Share of payload log records (full prompts and completions) that are emitted at DEBUG level
+payload_sample_rate = 0.1
+
+def log_payload(logger: logging.Logger, message: str, *args):
+    """
+    Log a large payload at DEBUG level for a sample of calls. The message is only formatted when the
+    record is emitted, so disabled payload logging costs nothing on big conversations.
+    """
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < payload_sample_rate:
+        logger.debug(message, *args)
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import threading
+
+def pooled_account_class(pool_size: int):
+    """
+    O365 account class whose HTTP session keeps a larger pool of keep-alive connections, so concurrent tool
+    calls reuse sockets instead of opening a new TLS connection per request. O365 is imported here, on first
+    use, since it takes a fifth of a second to import.
+    """
+    from O365 import Account
+    from O365.connection import Connection
+    from requests.adapters import HTTPAdapter
+
+    class PooledConnection(Connection):
+        def get_session(self, *args, **kwargs):
+            session = super().get_session(*args, **kwargs)
+            retries = session.get_adapter("https://").max_retries
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            return session
+
+    class PooledAccount(Account):
+        connection_constructor = PooledConnection
+
+    return PooledAccount
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Whether a Graph request failed in a way a later retry may not: a timeout, a connection error, throttling or a server error.
+    """
+    from requests import exceptions
+    if isinstance(error, (exceptions.ConnectionError, exceptions.Timeout)):
+        return True
+    return isinstance(error, exceptions.HTTPError) and error.response is not None and (error.response.status_code == 429 or error.response.status_code >= 500)
+
+
+class MicrosoftAuthenticationError(RuntimeError):
+    """
+    No usable Microsoft token is stored. Signing in is interactive, so it is done once with
+    `python -m src.tools.microsoft.login`, never by the server.
+    """
+
+
+class MicrosoftAccountProvider:
+    """
+    Single O365 account shared by every Microsoft Graph tool.
+
+    The account is created on first use instead of at import or startup, so booting the server does not
+    depend on Graph. All tools share one connection, which means one token refresh and one connection pool.
+    O365 refreshes the access token itself when it expires, as long as the stored token has a refresh token.
+
+    Every request has a `timeout` and is retried `request_retries` times on throttling and server errors,
+    so a tool call returns within the tool timeout and frees its thread instead of hanging on Graph.
+    """
+    scopes = ['basic', 'mailbox', 'calendar']
+    # Keep-alive connections to Graph
+    pool_size = 10
+    # Seconds to connect and for each read of a response, O365 waits forever by default
+    timeout = 10
+    request_retries = 2
+
+    def __init__(self):
+        self._account = None
+        self._lock = threading.Lock()
+
+    def create(self):
+        credentials = (os.environ["MS_CLIENT_ID"], os.environ["MS_CLIENT_SECRET"])
+        return pooled_account_class(self.pool_size)(credentials, timeout=self.timeout, request_retries=self.request_retries)
+
+    def get(self):
+        if self._account is not None:
+            return self._account
+        with self._lock:
+            if self._account is None:
+                account = self.create()
+                # Signing in prompts on the console, which would block every tool call waiting for the lock
+                if account.is_authenticated is False:
+                    raise MicrosoftAuthenticationError("No Microsoft token is stored, sign in with `python -m src.tools.microsoft.login` first")
+                self._account = account
+        return self._account
+
+    async def warm_up(self):
+        """
+        Create and authenticate the account in a worker thread, for a startup path that does not block.
+        A failed attempt is retried on first use.
+        """
+        await asyncio.to_thread(self.get)
+
+
+microsoft_account = MicrosoftAccountProvider()
@@ -0,0 +1,20 @@
+"""
+Sign in to Microsoft once and store the token the server uses for Graph, which it refreshes from then on.
+
+    cd server
+    python -m src.tools.microsoft.login
+"""
+import configparser
+import os
+from .account import microsoft_account
+
+if __name__ == "__main__":
+    config = configparser.ConfigParser()
+    config.read(["../config.cfg"])
+    os.environ["MS_CLIENT_ID"] = config["azure"]["clientId"]
+    os.environ["MS_CLIENT_SECRET"] = config["azure"]["clientSecret"]
+    account = microsoft_account.create()
+    if account.is_authenticated or account.authenticate(scopes=microsoft_account.scopes):
+        print("Signed in to Microsoft, the token is stored for the server")
+    else:
+        raise SystemExit("Signing in to Microsoft failed")
@@ -1,20 +1,99 @@
-from datetime import datetime
-from O365 import Account
-from textwrap import dedent
-import os
-from ..tool import BaseTool
+from datetime import datetime, timedelta, timezone
+from functools import cached_property
+from itertools import islice
+from ..tool import BaseTool, ToolCallError
+from .account import microsoft_account
 
-class MicrosoftGraphCalendarTool(BaseTool):
+def normalize_time(value: str) -> str:
+    """
+    Canonical form of an ISO 8601 timestamp, so equivalent spellings share a cache entry.
+    """
+    try:
+        return datetime.fromisoformat(value.strip()).isoformat()
+    except ValueError:
+        return value.strip()
+
+def odata_string(value: str) -> str:
+    # Single quotes are escaped by doubling them in OData string literals
+    return value.replace("'", "''")
+
+def take(items, budget: int) -> tuple:
+    """
+    The first `budget` items and whether there were more. Only one item past the budget is read, so with a
+    paged Graph result no page after the one holding it is fetched.
+    """
+    taken = list(islice(items, budget + 1))
+    return taken[:budget], len(taken) > budget
+
+def encode_cursor(timestamp: datetime, ids) -> str:
+    return f"{timestamp.isoformat()}|{','.join(sorted(ids))}"
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    The timestamp a cursor continues from and the ids of the results at that timestamp already returned.
+    """
+    timestamp, _, ids = cursor.strip().partition("|")
+    try:
+        return datetime.fromisoformat(timestamp), set(filter(None, ids.split(",")))
+    except ValueError:
+        raise ToolCallError(f"cursor must be copied from a previous result, got {cursor!r}.")
+
+def next_cursor(items: list, time_of, cursor_time: datetime=None, seen_ids: set=frozenset()) -> str:
+    """
+    Cursor continuing after `items`: the time of the last item and the ids of every item returned at that
+    time, so results sharing a timestamp across a page boundary are neither repeated nor skipped.
+    """
+    last = time_of(items[-1])
+    ids = {item.object_id for item in items if time_of(item) == last}
+    if last == cursor_time:
+        ids |= seen_ids
+    return encode_cursor(last, ids)
+
+def shorten(text: str, length: int=120) -> str:
+    text = " ".join((text or "").split())
+    return text if len(text) <= length else text[:length - 1] + "…"
+
+
+class MicrosoftGraphTool(BaseTool):
+    """
+    Base class for tools reading from Microsoft Graph. Queries select only the fields the tool prints, are
+    ordered by Graph, and are read page by page until `max_results` results are found.
+    """
+    # Results per Graph request
+    page_size = 25
+    default_results = 20
+    max_results_limit = 50
+
+    @property
+    def msAccount(self):
+        return microsoft_account.get()
+
+    def result_budget(self, max_results: int=None) -> int:
+        return max(1, min(max_results or self.default_results, self.max_results_limit))
+
+    @property
+    def max_results_schema(self):
+        return {
+            "type": "integer",
+            "description": f"Maximum number of results to return, {self.default_results} by default and at most {self.max_results_limit}.",
+        }
+
+    @property
+    def cursor_schema(self):
+        return {
+            "type": "string",
+            "description": "Cursor from a previous result that had more results, to get the results after it.",
+        }
+
+class MicrosoftGraphCalendarTool(MicrosoftGraphTool):
     name = "microsoft_graph_calendar"
+    cache_ttl = 300
+    date_dependent = True
+    # Events read at most when continuing from a cursor, pages are still only fetched until the results are found
+    max_scanned = 500
 
     def __init__(self):
         super().__init__(self.name)
-        # Microsoft Authentication Initialization
-        credentials = (os.environ["MS_CLIENT_ID"], os.environ["MS_CLIENT_SECRET"])
-        account = Account(credentials)
-        if account.is_authenticated is False:
-            account.authenticate(scopes=['basic', 'mailbox', 'calendar'])
-        self.msAccount = account
 
     @property
     def openai_schema(self):
@@ -23,7 +102,7 @@ class MicrosoftGraphCalendarTool(BaseTool):
             "type": "function",
             "function": {
                 "name": f"{self.name}",
-                "description": f"Get the calendar events from the start time to the end time. Today is {today}.",
+                "description": f"Get the calendar events from the start time to the end time, earliest first. Today is {today}.",
                 "parameters": {
                     "type": "object",
                     "properties": {
@@ -34,7 +113,9 @@ class MicrosoftGraphCalendarTool(BaseTool):
                         "end_time": {
                             "type": "string",
                             "description": "The end time of the time duration to get the calendar events for, represented in ISO 8601 format.",
-                        }
+                        },
+                        "max_results": self.max_results_schema,
+                        "cursor": self.cursor_schema,
                     },
                     "required": ["start_time", "end_time"],
                 },
@@ -42,35 +123,59 @@ class MicrosoftGraphCalendarTool(BaseTool):
         }
         return tool_schema
 
-    def run(self, start_time: str, end_time: str):
-        calendar = self.msAccount.schedule().get_default_calendar()
-        q = calendar.new_query('start').greater_equal(start_time)
-        q.chain('and').on_attribute('end').less_equal(end_time)
-        calendar_events = calendar.get_events(query=q, include_recurring=True)
-        all_events = []
-        for event in calendar_events:
-            all_events.append({
-                "subject": event.subject,
-                "start": event.start.strftime("%Y-%m-%dT%H:%M:%S"),
-                "end": event.end.strftime("%Y-%m-%dT%H:%M:%S"),
-                "location": event.location,
-            })
-        return dedent(f"""
-            Calendar Events from {start_time} to {end_time}:
-            {all_events}
-        """)
-
-class MicrosoftGraphEmailTool(BaseTool):
+    @cached_property
+    def calendar(self):
+        return self.msAccount.schedule().get_default_calendar()
+
+    def cache_key(self, start_time: str, end_time: str, max_results: int=None, cursor: str=None):
+        return (normalize_time(start_time), normalize_time(end_time), self.result_budget(max_results), cursor.strip() if cursor else None)
+
+    def run(self, start_time: str, end_time: str, max_results: int=None, cursor: str=None):
+        budget = self.result_budget(max_results)
+        for name, value in (("start_time", start_time), ("end_time", end_time)):
+            try:
+                datetime.fromisoformat(value)
+            except ValueError:
+                raise ToolCallError(f"{name} must be an ISO 8601 time, got {value!r}.")
+        cursor_time, seen_ids = decode_cursor(cursor) if cursor else (None, set())
+        calendar = self.calendar
+        builder = calendar.new_query()
+        query = builder.select("subject", "start", "end", "location", "isAllDay") & builder.orderby("start/dateTime")
+        # The calendar view expands recurring events into their occurrences within the time range. Continuing
+        # from a cursor, it also returns the events that started earlier and still run, which were shown already.
+        events = calendar.get_events(limit=self.max_scanned if cursor else budget + 1, batch=min(self.page_size, budget + 1), query=query,
+                                     include_recurring=True, start_recurring=cursor_time.isoformat() if cursor else start_time, end_recurring=end_time)
+        if cursor:
+            events = (event for event in events
+                      if event.start > cursor_time or (event.start == cursor_time and event.object_id not in seen_ids))
+        events, truncated = take(events, budget)
+
+        lines = [f"Calendar events from {start_time} to {end_time}: {len(events)}{'+' if truncated else ''}"]
+        for event in events:
+            lines.append(f"- {self.format_time(event)} {shorten(event.subject)}{self.format_location(event.location)}")
+        if truncated:
+            lines.append(f"More events follow. To see them, call again with the same arguments and cursor={next_cursor(events, lambda event: event.start, cursor_time, seen_ids)}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def format_time(event) -> str:
+        if event.is_all_day:
+            return f"{event.start:%Y-%m-%d} all day"
+        if event.start.date() == event.end.date():
+            return f"{event.start:%Y-%m-%d %H:%M}-{event.end:%H:%M}"
+        return f"{event.start:%Y-%m-%d %H:%M} to {event.end:%Y-%m-%d %H:%M}"
+
+    @staticmethod
+    def format_location(location) -> str:
+        name = location.get("displayName") if isinstance(location, dict) else location
+        return f" @ {shorten(name, 60)}" if name else ""
+
+class MicrosoftGraphEmailTool(MicrosoftGraphTool):
     name = "microsoft_graph_email"
+    cache_ttl = 120
 
     def __init__(self):
         super().__init__(self.name)
-        # Microsoft Authentication Initialization
-        credentials = (os.environ["MS_CLIENT_ID"], os.environ["MS_CLIENT_SECRET"])
-        account = Account(credentials)
-        if account.is_authenticated is False:
-            account.authenticate(scopes=['basic', 'mailbox', 'calendar'])
-        self.msAccount = account
 
     @property
     def openai_schema(self):
@@ -78,14 +183,20 @@ class MicrosoftGraphEmailTool(BaseTool):
             "type": "function",
             "function": {
                 "name": f"{self.name}",
-                "description": f"Get the emails from the email inbox.",
+                "description": "Get the emails from the email inbox whose subject contains a keyword, newest first.",
                 "parameters": {
                     "type": "object",
                     "properties": {
                         "keyword": {
                             "type": "string",
                             "description": "The keyword to search for in the email subject.",
-                        }
+                        },
+                        "received_before": {
+                            "type": "string",
+                            "description": "Only return emails received before this time, represented in ISO 8601 format.",
+                        },
+                        "max_results": self.max_results_schema,
+                        "cursor": self.cursor_schema,
                     },
                     "required": ["keyword"],
                 },
@@ -93,19 +204,43 @@ class MicrosoftGraphEmailTool(BaseTool):
         }
         return tool_schema
 
-    def run(self, keyword: str):
-        mailbox = self.msAccount.mailbox()
-        inbox = mailbox.inbox_folder()
-        messages = []
-        q = inbox.new_query('subject').contains(keyword)
-        for message in inbox.get_messages(query=q):
-            messages.append({
-                "subject": message.subject,
-                "from": message.sender.address,
-                "is_read": message.is_read,
-            })
-        return dedent(f"""
-            Emails in the inbox:
-            {messages}
-        """)
+    @cached_property
+    def inbox(self):
+        return self.msAccount.mailbox().inbox_folder()
+
+    def cache_key(self, keyword: str, received_before: str=None, max_results: int=None, cursor: str=None):
+        # Graph subject search is case insensitive
+        return (keyword.strip().lower(), normalize_time(received_before) if received_before else None, self.result_budget(max_results),
+                cursor.strip() if cursor else None)
+
+    def run(self, keyword: str, received_before: str=None, max_results: int=None, cursor: str=None):
+        budget = self.result_budget(max_results)
+        inbox = self.inbox
+        builder = inbox.new_query()
+        try:
+            before = datetime.fromisoformat(received_before) if received_before else datetime.now(timezone.utc) + timedelta(days=1)
+        except ValueError:
+            raise ToolCallError(f"received_before must be an ISO 8601 time, got {received_before!r}.")
+        if cursor:
+            # Emails received at the cursor time that were not returned yet are still to come. The cursor comes
+            # from earlier results, so it is before `received_before` already.
+            cursor_time, seen_ids = decode_cursor(cursor)
+            received = builder.less_equal("receivedDateTime", cursor_time)
+        else:
+            cursor_time, seen_ids = None, set()
+            received = builder.less("receivedDateTime", before)
+        # Graph only sorts a filtered query when the sort property is also filtered on, and first
+        query = (received & builder.contains("subject", odata_string(keyword))
+                 & builder.select("subject", "from", "isRead", "receivedDateTime")
+                 & builder.orderby(("receivedDateTime", False)))
+        messages = inbox.get_messages(limit=budget + 1 + len(seen_ids), batch=min(self.page_size, budget + 1 + len(seen_ids)), query=query)
+        messages = (message for message in messages if message.object_id not in seen_ids)
+        messages, truncated = take(messages, budget)
 
+        lines = [f"Emails with \"{keyword}\" in the subject: {len(messages)}{'+' if truncated else ''}"]
+        for message in messages:
+            sender = message.sender.address if message.sender else "unknown sender"
+            lines.append(f"- {message.received:%Y-%m-%d %H:%M} {sender}{'' if message.is_read else ' (unread)'}: {shorten(message.subject)}")
+        if truncated:
+            lines.append(f"Older emails match too. To see them, call again with the same arguments and cursor={next_cursor(messages, lambda message: message.received, cursor_time, seen_ids)}")
+        return "\n".join(lines)
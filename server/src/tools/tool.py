@@ -1,13 +1,68 @@
 from abc import ABC, abstractmethod
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import asyncio
+import contextvars
+import functools
 import json
+import threading
+from .cache import ToolCache
+from ..telemetry.tracing import tracer
+
+
+class ToolExecutor:
+    """
+    Bounded pool of threads the tools run in, since they call blocking SDKs.
+
+    A run that times out cannot be stopped and keeps its thread until the SDK call returns, which the tools
+    bound with request timeouts of their own. In the default executor such runs would also hold the threads
+    of every other `asyncio.to_thread` user, here at most `workers` of them pile up and further runs queue.
+    Queued runs that time out never start.
+    """
+    workers = 16
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def get(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tool")
+        return self._executor
+
+    async def run(self, fn, timeout: float, **kwargs):
+        """
+        Run `fn(**kwargs)` in the pool, with the caller's context so traces follow, for at most `timeout` seconds.
+        """
+        call = functools.partial(contextvars.copy_context().run, fn, **kwargs)
+        return await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(self.get(), call), timeout=timeout)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+tool_executor = ToolExecutor()
+
 
 class BaseTool(ABC):
     """
     Base class for all tools.
     """
+    # Seconds a single run may take before the model is told the tool timed out
+    timeout = 30
+    # Seconds a result is reused for identical arguments, 0 disables caching
+    cache_ttl = 0
+    cache_size = 128
+    # Whether `openai_schema` mentions the current date and has to be rebuilt when the day rolls over
+    date_dependent = False
+
     def __init__(self, name):
         self.name = name
+        self.cache = ToolCache(self.cache_ttl, self.cache_size) if self.cache_ttl else None
 
     @property
     @abstractmethod
@@ -15,8 +70,126 @@ class BaseTool(ABC):
         pass
 
     @abstractmethod
-    async def run(self, **kwargs):
+    def run(self, **kwargs):
         pass
 
+    async def arun(self, **kwargs):
+        """
+        Run the tool in the tool executor, since tools call blocking SDKs, and give up after `timeout` seconds.
+        Results are served from the tool's cache when it has one.
+        """
+        run = lambda: tool_executor.run(self.run, self.timeout, **kwargs)
+        with tracer.span(f"tool.{self.name}"):
+            if self.cache is None:
+                return await run()
+            return await self.cache.get_or_run(self.cache_key(**kwargs), run)
+
+    def cache_key(self, **kwargs):
+        """
+        Key identifying a call for caching, override to normalize arguments that mean the same thing.
+        """
+        return json.dumps({k: v.strip() if isinstance(v, str) else v for k, v in kwargs.items()}, sort_keys=True)
+
     def parse_function_args(self, tool_call):
         return json.loads(tool_call.function.arguments)
+
+
+class ToolCallError(Exception):
+    """
+    A tool call the model got wrong, such as an unknown tool or invalid arguments. The message is sent
+    back to the model as the tool result so it can correct itself.
+    """
+
+JSON_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list,
+    "object": dict,
+}
+
+def compile_validator(parameters: dict):
+    """
+    Build a function checking tool arguments against the `parameters` JSON schema of a tool. Covers what
+    tool schemas use: property types, enums, required properties and no unknown properties. The returned
+    function gives a list of problems, empty when the arguments are valid.
+    """
+    properties = parameters.get("properties", {})
+    required = tuple(parameters.get("required", ()))
+    checks = {}
+    for name, spec in properties.items():
+        expected = JSON_TYPES.get(spec.get("type"))
+        enum = tuple(spec["enum"]) if "enum" in spec else None
+        checks[name] = (spec.get("type"), expected, enum)
+
+    def validate(args) -> list:
+        if not isinstance(args, dict):
+            return ["arguments must be a JSON object"]
+        problems = [f"missing required argument '{name}'" for name in required if name not in args]
+        for name, value in args.items():
+            if name not in checks:
+                problems.append(f"unknown argument '{name}'")
+                continue
+            type_name, expected, enum = checks[name]
+            # bool is an int in Python but not in JSON
+            if expected is not None and (not isinstance(value, expected) or (isinstance(value, bool) and type_name != "boolean")):
+                problems.append(f"argument '{name}' must be of type {type_name}")
+            elif enum is not None and value not in enum:
+                problems.append(f"argument '{name}' must be one of {list(enum)}")
+        return problems
+
+    return validate
+
+class ToolRegistry:
+    """
+    The tools of an agent, indexed by name. Schemas are built once and only the date dependent ones are
+    rebuilt when the day changes, and each tool's arguments are checked by a validator compiled from its schema.
+    """
+    def __init__(self, tools: list[BaseTool]):
+        self._tools = {tool.name: tool for tool in tools}
+        self._schemas = {tool.name: tool.openai_schema for tool in tools}
+        self._validators = {name: compile_validator(schema["function"].get("parameters", {}))
+                            for name, schema in self._schemas.items()}
+        self._schema_list = list(self._schemas.values())
+        self._date = date.today()
+
+    def __len__(self):
+        return len(self._tools)
+
+    def __iter__(self):
+        return iter(self._tools.values())
+
+    def schemas(self) -> list:
+        """
+        The tool schemas to send to the model.
+        """
+        today = date.today()
+        if today != self._date:
+            for tool in self._tools.values():
+                if tool.date_dependent:
+                    self._schemas[tool.name] = tool.openai_schema
+            self._schema_list = list(self._schemas.values())
+            self._date = today
+        return self._schema_list
+
+    def get(self, name: str) -> BaseTool:
+        tool = self._tools.get(name)
+        if tool is None:
+            raise ToolCallError(f"There is no tool named '{name}'. Available tools: {', '.join(self._tools)}.")
+        return tool
+
+    def resolve(self, tool_call):
+        """
+        Find the tool a model tool call refers to and parse its arguments. Raises ToolCallError when
+        the tool does not exist or the arguments do not match its schema.
+        """
+        tool = self.get(tool_call.function.name)
+        try:
+            args = tool.parse_function_args(tool_call)
+        except ValueError as e:
+            raise ToolCallError(f"The arguments for {tool.name} are not valid JSON: {e}.")
+        problems = self._validators[tool.name](args)
+        if problems:
+            raise ToolCallError(f"Invalid arguments for {tool.name}: {'; '.join(problems)}.")
+        return tool, args